@@ -3,14 +3,20 @@ import os
 import re
 import tkinter as tk
 from tkinter import messagebox
+from typing import Callable, Dict, List
+
+from sqlalchemy import select
 
 from annotation_widgets.event_validation.models import Event
 from annotation_widgets.event_validation.path_manager import EventValidationPathManager
 from annotation_widgets.io import AbstractAnnotationIO
-from file_processing.file_transfer import FileTransferClient, download_file, upload_file
+from file_processing.file_transfer import FileTransferClient, download_files_concurrently, wait_for_downloads
+from file_processing.remote_archive import RemoteArchiveUnzipper
 from file_processing.unzipping import ArchiveUnzipper
-from models import ProjectData, Value
-from utils import save_json, open_json
+from db import get_session
+from export_cache import export_file, iter_fragments, update_fragments, write_json_fragments
+from models import ExportFragment, ProjectData, Value
+from utils import open_json
 
 
 class EventValidationIO(AbstractAnnotationIO):
@@ -24,32 +30,33 @@ class EventValidationIO(AbstractAnnotationIO):
 
     def download_project(self, root: tk.Tk):
         """Downloads data and annotations from the server. Shows loading window while downloading"""
-        if not os.path.isfile(self.pm.archive_path):
-            ftc = FileTransferClient(window_title="Downloading progress", root=root)
-            ftc.download(
-                uid=self.project_data.uid,
-                file_name=os.path.basename(self.pm.archive_path),
-                save_path=self.pm.archive_path,
-            )
-            download_file(
-                uid=self.project_data.uid,
-                file_name=os.path.basename(self.pm.meta_ann_path),
-                save_path=self.pm.meta_ann_path,
-            )
+        # Annotations are downloaded while the archive is transferred
+        annotation_paths = [
+            path for path in (self.pm.meta_ann_path, self.pm.event_validation_results_json_path) 
+            if not os.path.isfile(path)
+        ]
+        downloads = download_files_concurrently(
+            self.project_data.uid, annotation_paths, optional_paths=[self.pm.event_validation_results_json_path]
+        )
+
         if not os.path.isdir(self.pm.videos_path):
-            assert os.path.isfile(self.pm.archive_path)
-            au = ArchiveUnzipper(window_title="Unzip progress", root=root)
-            au.unzip(self.pm.archive_path, self.pm.project_path)
-
-        if not os.path.isfile(self.pm.event_validation_results_json_path):
-            download_file(
-                uid=self.project_data.uid,
-                file_name=os.path.basename(self.pm.event_validation_results_json_path),
-                save_path=self.pm.event_validation_results_json_path,
-                ignore_404=True
-            )
-
-    def overwrite_project(self):
+            # Videos are extracted while the archive is transferred. Servers without Range support send the whole archive
+            rau = RemoteArchiveUnzipper(window_title="Downloading and unzipping progress", root=root)
+            if rau.unzip(self.project_data.uid, self.pm.archive_path, self.pm.project_path) is None:
+                if not os.path.isfile(self.pm.archive_path):
+                    ftc = FileTransferClient(window_title="Downloading progress", root=root)
+                    ftc.download(
+                        uid=self.project_data.uid,
+                        file_name=os.path.basename(self.pm.archive_path),
+                        save_path=self.pm.archive_path,
+                    )
+                assert os.path.isfile(self.pm.archive_path)
+                au = ArchiveUnzipper(window_title="Unzip progress", root=root)
+                au.unzip(self.pm.archive_path, self.pm.project_path)
+
+        wait_for_downloads(downloads)
+
+    def overwrite_project(self, update_callback: Callable = None):
         fields = open_json(self.pm.meta_ann_path)
 
         # Converts list structure into tree structure to avoid explicit index usage further in code.
@@ -95,22 +102,18 @@ class EventValidationIO(AbstractAnnotationIO):
 
         assert len(events) == len(os.listdir(self.pm.videos_path))
 
+        ExportFragment.clear()
         Event.overwrite(events)
 
     def download_and_overwrite_annotations(self):
         """Force download and overwrite annotations in the database"""
 
-        download_file(
-            uid=self.project_data.uid,
-            file_name=os.path.basename(self.pm.event_validation_results_json_path),
-            save_path=self.pm.event_validation_results_json_path,
-            ignore_404=True,
-        )
-        download_file(
-            uid=self.project_data.uid,
-            file_name=os.path.basename(self.pm.meta_ann_path),
-            save_path=self.pm.meta_ann_path,
+        downloads = download_files_concurrently(
+            self.project_data.uid, 
+            [self.pm.event_validation_results_json_path, self.pm.meta_ann_path], 
+            optional_paths=[self.pm.event_validation_results_json_path]
         )
+        wait_for_downloads(downloads)
         self.overwrite_project()
 
     def _export_event_validation_results(self, output_path: str):
@@ -134,16 +137,23 @@ class EventValidationIO(AbstractAnnotationIO):
         """
         fields = json.loads(Value.get_value("fields"))
 
-        result = {"fields": list(fields.keys()), "events": {}}
-
-        for event in Event.all():
-            result["events"][event.uid] = {
-                "answers": json.loads(event.custom_fields),
-                "comment": event.comment
-            }
-
-        save_json(result, output_path)
+        # Only events saved after the previous export are serialized, others are taken from the cache
+        update_fragments(Event, "event", self._serialize_events)
+        with export_file(output_path) as file:
+            file.write(f'{{"fields": {json.dumps(list(fields.keys()))}, "events": ')
+            write_json_fragments(file, iter_fragments(Event, "event", Event.uid))
+            file.write("}")
+
+    @staticmethod
+    def _serialize_events(event_ids: List[int]) -> Dict[int, Dict]:
+        session = get_session()
+        events = session.execute(select(Event.id, Event.custom_fields, Event.comment).where(Event.id.in_(event_ids)))
+        return {
+            event_id: {"answers": json.loads(custom_fields), "comment": comment}
+            for event_id, custom_fields, comment in events
+        }
 
-    def _upload_annotation_results(self):
+    def _upload_annotation_results(self, root: tk.Tk):
         self._export_event_validation_results(output_path=self.pm.event_validation_results_json_path)
-        upload_file(self.project_data.uid, self.pm.event_validation_results_json_path)
+        ftc = FileTransferClient(window_title="Uploading progress", root=root)
+        ftc.upload(self.project_data.uid, self.pm.event_validation_results_json_path)
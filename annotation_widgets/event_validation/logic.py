@@ -138,6 +138,7 @@ class EventValidationLogic(AbstractImageAnnotationLogic):
             self.event.comment = self.comment
             self.event.custom_fields = json.dumps(list(self.answers.values()))
             self.event.save()
+            self.item_changed = False
 
     def load_image(self):
         image_name = f"{self.item_base_names[self.item_id]}.jpg"
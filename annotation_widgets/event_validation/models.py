@@ -1,7 +1,8 @@
 import json
+import time
 from typing import List, Optional
 
-from sqlalchemy import asc, Column, String, Integer
+from sqlalchemy import asc, Column, Float, String, Integer
 
 from db import Base, get_session
 
@@ -13,6 +14,7 @@ class Event(Base):
     uid = Column(String, nullable=False, unique=True)
     comment = Column(String, nullable=True)
     custom_fields = Column(String, nullable=True)
+    modified_at = Column(Float, index=True)  # Time of the last save by the annotator, NULL for downloaded results
 
     def __init__(self, uid):
         self.uid = uid
@@ -48,9 +50,11 @@ class Event(Base):
         if events:
             session.query(cls).delete()
             session.bulk_save_objects(events)
+            session.commit()
 
     def save(self):
         session = get_session()
+        self.modified_at = time.time()
         session.add(self)
         session.commit()
 
@@ -1,6 +1,7 @@
 import os
 import tkinter as tk
 from tkinter import messagebox
+from typing import Callable
 
 from annotation_widgets.image.filtering.models import ClassificationImage
 from annotation_widgets.image.filtering.path_manager import FilteringPathManager
@@ -31,7 +32,7 @@ class ImageFilteringIO(ImageIO):
                 save_path=self.pm.meta_ann_path,
             )
 
-    def overwrite_project(self):
+    def overwrite_project(self, update_callback: Callable = None):
         if os.path.isfile(self.pm.meta_ann_path):
             meta_data = open_json(self.pm.meta_ann_path)
             self.overwrite_labels(labels_data=meta_data["labels"])
@@ -50,6 +51,6 @@ class ImageFilteringIO(ImageIO):
                     result["ids"].append(limage.item_id)
         save_json(result, output_path) 
 
-    def _upload_annotation_results(self):
+    def _upload_annotation_results(self, root: tk.Tk):
         self._export_selected_frames(output_path=self.pm.selected_frames_json_path)
         upload_file(self.project_data.uid, self.pm.selected_frames_json_path)
@@ -135,6 +135,7 @@ class ImageFilteringLogic(AbstractImageAnnotationLogic):
     def save_item(self):
         if self.item_changed:
             self.labeled_image.save()
+            self.item_changed = False
 
     def switch_item(self, item_id: int):
         self.processed_item_ids.add(self.item_id)
@@ -14,8 +14,8 @@ class ClassificationImage(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String, unique=True, nullable=True)
-    item_id = Column(Integer, nullable=True)
-    selected = Column(Boolean, default=False)
+    item_id = Column(Integer, nullable=True, index=True)
+    selected = Column(Boolean, default=False, index=True)
 
     @classmethod
     def get(cls, name: str = None, item_id: int = None):
@@ -21,7 +21,7 @@ class BBox(Figure):
     __tablename__ = 'bbox'
 
     id = Column(Integer, primary_key=True)
-    item_id = Column(Integer, ForeignKey('image.id'))
+    item_id = Column(Integer, ForeignKey('image.id'), index=True)
     x1 = Column(Integer)
     y1 = Column(Integer)
     x2 = Column(Integer)
@@ -0,0 +1,80 @@
+import json
+from typing import Dict, List
+
+from sqlalchemy import select
+
+from db import get_session
+from enums import MaskFormat
+from export_cache import export_file, iter_fragments, update_fragments, write_json_fragments
+from .bboxes.models import BBox
+from .keypoints.models import KeypointGroup
+from .models import LabeledImage, ReviewLabel
+from models import Value
+from .segmentation.masks_encoding import blob_to_annotation
+from .segmentation.models import Mask
+
+
+def normalize_keypoints(keypoints_data: str) -> List[Dict]:
+    """Same points as KeypointGroup.serialize_keypoints gives after loading the group"""
+    return [{"x": point["x"], "y": point["y"], "label": point["label"]} for point in json.loads(keypoints_data)]
+
+
+def get_mask_format() -> MaskFormat:
+    """Format of masks in figures.json of the project, projects downloaded before the setting use RLE strings"""
+    value = Value.get_value("mask_format")
+    return MaskFormat(value) if value is not None else MaskFormat.RLE
+
+
+def serialize_figures(img_ids: List[int]) -> Dict[int, Dict]:
+    """
+    Figures of images in figures.json format by image ids.
+    Figures are read with one query per figure type instead of loading relationships of every image
+    """
+    session = get_session()
+    images = session.execute(
+        select(LabeledImage.id, LabeledImage.trash, LabeledImage.height, LabeledImage.width).where(LabeledImage.id.in_(img_ids))
+    )
+    result = {
+        img_id: {"trash": trash, "bboxes": [], "kgroups": [], "masks": {}, "height": height, "width": width}
+        for img_id, trash, height, width in images
+    }
+
+    bboxes = select(BBox.item_id, BBox.x1, BBox.y1, BBox.x2, BBox.y2, BBox.label).where(BBox.item_id.in_(img_ids)).order_by(BBox.id)
+    for img_id, x1, y1, x2, y2, label in session.execute(bboxes):
+        result[img_id]["bboxes"].append({"x1": x1, "y1": y1, "x2": x2, "y2": y2, "label": label})
+
+    kgroups = select(KeypointGroup.item_id, KeypointGroup.keypoints_data, KeypointGroup.label).where(KeypointGroup.item_id.in_(img_ids)).order_by(KeypointGroup.id)
+    for img_id, keypoints_data, label in session.execute(kgroups):
+        result[img_id]["kgroups"].append({"points": normalize_keypoints(keypoints_data), "label": label})
+
+    # Binary RLE is converted to the RLE string without decoding the mask, COCO RLE requires decoding
+    mask_format = get_mask_format()
+    masks = select(Mask.item_id, Mask.label, Mask.rle_blob, Mask.height, Mask.width).where(Mask.item_id.in_(img_ids)).order_by(Mask.id)
+    for img_id, label, rle_blob, height, width in session.execute(masks):
+        result[img_id]["masks"][label] = blob_to_annotation(rle_blob, height=height, width=width, mask_format=mask_format)
+
+    return result
+
+
+def serialize_review(img_ids: List[int]) -> Dict[int, List[Dict]]:
+    """Review labels of images in review.json format by image ids"""
+    session = get_session()
+    result = {img_id: [] for img_id in img_ids}
+    review_labels = select(ReviewLabel.item_id, ReviewLabel.label, ReviewLabel.x, ReviewLabel.y).where(ReviewLabel.item_id.in_(img_ids)).order_by(ReviewLabel.id)
+    for img_id, label, x, y in session.execute(review_labels):
+        result[img_id].append({"label": label, "x": x, "y": y})
+    return result
+
+
+def export_figures(figures_ann_path: str):
+    """Writes figures.json. Only images saved after the previous export are serialized, others are taken from the cache"""
+    update_fragments(LabeledImage, "figures", serialize_figures)
+    with export_file(figures_ann_path) as file:
+        write_json_fragments(file, iter_fragments(LabeledImage, "figures", LabeledImage.name))
+
+
+def export_review(review_ann_path: str):
+    """Writes review.json with images which have review labels"""
+    update_fragments(LabeledImage, "review", serialize_review)
+    with export_file(review_ann_path) as file:
+        write_json_fragments(file, iter_fragments(LabeledImage, "review", LabeledImage.name, skip_data=("[]",)))
@@ -104,6 +104,10 @@ class AbstractFigureController(ABC):
     def change_label(self, label: Label):
         raise NotImplementedError
 
+    def draw_figures(self, canvas: np.ndarray, figures: List[Figure], labels: Dict[str, Dict[str, Label]]) -> Tuple[np.ndarray, List[Figure]]:
+        """Draws figures which the controller renders at once. Returns the canvas and figures to draw one by one"""
+        return canvas, figures
+
     @abstractmethod
     def draw_additional_elements(self, canvas: np.ndarray, scale_factor: float = None) -> np.ndarray:
         raise NotImplementedError
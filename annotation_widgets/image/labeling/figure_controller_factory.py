@@ -1,7 +1,8 @@
 from annotation_widgets.image.labeling.bboxes.figure_controller import BBoxFigureController
 from annotation_widgets.image.labeling.figure_controller import ObjectFigureController
 from annotation_widgets.image.labeling.keypoints.figure_controller import KGroupFigureController
-from annotation_widgets.image.labeling.segmentation.figure_controller import MaskFigureController
+from annotation_widgets.image.labeling.segmentation.figure_controller import LabelMapFigureController, MaskFigureController
+from config import settings
 from enums import AnnotationMode
 
 
@@ -9,4 +10,10 @@ ControllerByMode = {
     AnnotationMode.OBJECT_DETECTION: BBoxFigureController,
     AnnotationMode.KEYPOINTS: KGroupFigureController,
     AnnotationMode.SEGMENTATION: MaskFigureController
-}
\ No newline at end of file
+}
+
+
+def get_controller_type(mode: AnnotationMode) -> type:
+    if mode is AnnotationMode.SEGMENTATION and settings.label_map_segmentation:
+        return LabelMapFigureController
+    return ControllerByMode[mode]
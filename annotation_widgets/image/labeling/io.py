@@ -1,26 +1,39 @@
 import json
 import os
+import time
 import tkinter as tk
-from typing import Dict, List
+import zipfile
+from typing import Callable, Dict, List
+
+from sqlalchemy import delete, insert
+
 from annotation_widgets.image.io import ImageIO
 from annotation_widgets.image.models import Label
 from api_requests import get_project_data
-from enums import AnnotationStage, FigureType
+from db import get_session
+from enums import AnnotationStage, FigureType, MaskFormat
 from exceptions import MessageBoxException
-from file_processing.file_transfer import FileTransferClient, download_file, upload_file
+from file_processing.file_transfer import FileTransferClient, download_files_concurrently, send_file, wait_for_downloads
+from file_processing.image_store import ImageStoreUpdater, get_archive_key, get_image_store
+from file_processing.integrity import get_manifest_path
+from file_processing.remote_archive import RemoteArchiveUnzipper
 from file_processing.unzipping import ArchiveUnzipper
 from gui_utils import get_loading_window
-from models import Value, ProjectData
-from utils import check_correct_json, get_img_size, open_json, save_json
+from models import ExportFragment, Value, ProjectData
+from utils import check_correct_json, count_json_items, get_img_size, iter_json_items, open_json
 from .bboxes.models import BBox
+from .export import export_figures, export_review, get_mask_format
 from .keypoints.models import KeypointGroup
 from .models import LabeledImage, ReviewLabel
 from .path_manager import LabelingPathManager
+from .segmentation.masks_encoding import annotation_to_blob
 from .segmentation.models import Mask
 
 
 class ImageLabelingIO(ImageIO):
 
+    overwrite_batch_size = 1000  # Number of images inserted in one transaction while overwriting the project
+    supports_delta_sync = True
 
     def change_stage_at_completion(self):
         if self.project_data.stage in [AnnotationStage.ANNOTATE, AnnotationStage.CORRECTION]:
@@ -35,34 +48,40 @@ class ImageLabelingIO(ImageIO):
         """Downloads data and annotations from the server. Shows loading window while downloading"""
 
         loading_window = get_loading_window(text="Downloading annotations...", root=root)
+        annotation_paths = [self.pm.figures_ann_path, self.pm.review_ann_path]
         if not os.path.isfile(self.pm.meta_ann_path) or not check_correct_json(self.pm.meta_ann_path):
-            download_file(
-                uid=self.project_data.uid,
-                file_name=os.path.basename(self.pm.meta_ann_path),
-                save_path=self.pm.meta_ann_path,
-            )
-
-        download_file(
-            uid=self.project_data.uid,
-            file_name=os.path.basename(self.pm.figures_ann_path),
-            save_path=self.pm.figures_ann_path,
-        )
-
-        download_file(
-            uid=self.project_data.uid,
-            file_name=os.path.basename(self.pm.review_ann_path),
-            save_path=self.pm.review_ann_path,
-            ignore_404=True
-        )
-
-        img_ann_number = len(open_json(self.pm.figures_ann_path))
-        if os.path.isdir(self.pm.images_path):
-            img_number = len(os.listdir(self.pm.images_path))
+            annotation_paths.append(self.pm.meta_ann_path)
+        downloads = download_files_concurrently(self.project_data.uid, annotation_paths, optional_paths=[self.pm.review_ann_path])
+
+        if not os.path.isdir(self.pm.images_path):
+            # Annotations are downloaded while the archive is transferred
+            loading_window.destroy()
+            self._download_images(root)
+            wait_for_downloads(downloads)
+            img_ann_number = count_json_items(self.pm.figures_ann_path)
         else:
-            img_number = 0
+            # The number of annotated images shows if the images directory is complete
+            wait_for_downloads(downloads)
+            loading_window.destroy()
+            img_ann_number = count_json_items(self.pm.figures_ann_path)
+            if len(os.listdir(self.pm.images_path)) != img_ann_number:
+                self._download_images(root)
 
-        loading_window.destroy()
-        if not os.path.isdir(self.pm.images_path) or img_number != img_ann_number:
+        img_number = len(os.listdir(self.pm.images_path))
+        if img_number != img_ann_number:
+            raise MessageBoxException(f"The project {self.project_data.id} has a different number of images and annotations. Remove and download it again, and if that doesn't help, ask administrator to fix the project")
+
+    def _download_images(self, root: tk.Tk):
+        # Other stages of the project use the same archive, its images may be already in the local store
+        image_store = get_image_store()
+        archive_key = get_archive_key(self.project_data.uid, os.path.basename(self.pm.archive_path)) if image_store is not None else None
+        if archive_key is not None and image_store.restore_archive(archive_key, self.pm.images_path):
+            return
+
+        # Images are extracted while the archive is transferred. Servers without Range support send the whole archive
+        rau = RemoteArchiveUnzipper(window_title="Downloading and unzipping progress", root=root)
+        member_names = rau.unzip(self.project_data.uid, self.pm.archive_path, self.pm.images_path)
+        if member_names is None:
             ftc = FileTransferClient(window_title="Downloading progress", root=root)
             ftc.download(
                 uid=self.project_data.uid,
@@ -71,14 +90,18 @@ class ImageLabelingIO(ImageIO):
             )
             au = ArchiveUnzipper(window_title="Unzip progress", root=root)
             au.unzip(self.pm.archive_path, self.pm.images_path)
+            with zipfile.ZipFile(self.pm.archive_path) as zip_ref:
+                member_names = [info.filename for info in zip_ref.infolist() if not info.is_dir()]
             if os.path.isfile(self.pm.archive_path):
                 os.remove(self.pm.archive_path)
+            if os.path.isfile(get_manifest_path(self.pm.archive_path)):
+                os.remove(get_manifest_path(self.pm.archive_path))
 
-        img_number = len(os.listdir(self.pm.images_path))
-        if img_number != img_ann_number:
-            raise MessageBoxException(f"The project {self.project_data.id} has a different number of images and annotations. Remove and download it again, and if that doesn't help, ask administrator to fix the project")
+        if archive_key is not None:
+            isu = ImageStoreUpdater(window_title="Saving images to the image store", root=root)
+            isu.add_archive(image_store, archive_key, self.pm.images_path, member_names)
 
-    def overwrite_project(self): 
+    def overwrite_project(self, update_callback: Callable = None): 
         """
         review_ann format:
         {
@@ -94,6 +117,7 @@ class ImageLabelingIO(ImageIO):
             "labels": [
                 {"name": "truck", "color": "yellow", "hotkey": "1", "type": "BBOX", "attributes": "..."},
             ], 
+            "mask_format": "RLE" or "COCO_RLE", optional, "RLE" by default
         }
 
         figures_ann format:
@@ -101,18 +125,24 @@ class ImageLabelingIO(ImageIO):
             "img_name.jpg": {
                 "trash": false, 
                 "bboxes": [], 
-                "masks": {class_name: rle}, 
+                "masks": {class_name: rle}, # "value:count,..." string or {"size": [h, w], "counts": "..."} for COCO_RLE
                 "kgroups": [],
             },
         }
+
+        Images and figures are written with SQLAlchemy Core in batches of executemany inserts, 
+        the ORM (and Mask decoding in particular) is not involved.
         """
         # Set current image id to 0
         Value.update_value("item_id", 0, overwrite=True)
-        figures_data = open_json(self.pm.figures_ann_path)
         meta_data = open_json(self.pm.meta_ann_path)
 
         # Labels
         self.overwrite_labels(labels_data=meta_data["labels"] + meta_data["review_labels"])
+
+        # Masks are exported in the same format as they are imported
+        mask_format = MaskFormat(meta_data.get("mask_format", MaskFormat.RLE.value))
+        Value.update_value("mask_format", mask_format.value, overwrite=True)
     
         # Add blur label
         masks_labels_number = len([label for label in Label.all() if label.type == FigureType.MASK.name])
@@ -127,10 +157,42 @@ class ImageLabelingIO(ImageIO):
             )
             label.save()
 
-        # Figures
-        limages = list()
-        for img_name in os.listdir(self.pm.images_path): 
-            img_info = figures_data.get(img_name)
+        # Ids are assigned explicitly to reference images from figures without reading them back.
+        # They follow sorted file names instead of the unspecified os.listdir order used before. Navigation and export
+        # order images by name and `item_id` is a position in the sorted names, so the numbering seen by users is the same
+        img_ids = {img_name: img_number + 1 for img_number, img_name in enumerate(sorted(os.listdir(self.pm.images_path)))}
+
+        # Review labels. Annotation files are read item by item, so the memory does not depend on the project size
+        review_exists = os.path.isfile(self.pm.review_ann_path)
+        reviewed_img_names = set()
+        if review_exists:
+            for img_name, review_data_for_image in iter_json_items(self.pm.review_ann_path):
+                if img_name in img_ids and len(review_data_for_image) > 0:
+                    reviewed_img_names.add(img_name)
+        # Show all images for review if there are no images with review labels
+        show_all = len(reviewed_img_names) == 0
+
+        session = get_session()
+
+        # Figures are replaced for the whole project, so tables are truncated instead of removing images one by one
+        ExportFragment.clear()
+        for model in [ReviewLabel, BBox, KeypointGroup, Mask, LabeledImage]:
+            session.execute(delete(model.__table__))
+
+        rows = {model: list() for model in [LabeledImage, BBox, KeypointGroup, Mask, ReviewLabel]}
+        processed_img_names = set()
+        start_time = time.time()
+
+        def insert_rows():
+            for model, model_rows in rows.items():
+                if len(model_rows) > 0:
+                    session.execute(insert(model.__table__), model_rows)
+                    model_rows.clear()
+            session.commit()
+
+        def add_image(img_name: str, img_info: Dict):
+            img_id = img_ids[img_name]
+            processed_img_names.add(img_name)
             if img_info is not None:
                 trash_tag = img_info.get("trash", False)
                 bboxes = img_info.get("bboxes", list())
@@ -143,130 +205,146 @@ class ImageLabelingIO(ImageIO):
                 kgroups = list()
                 masks = dict()
                 width, height = get_img_size(os.path.join(self.pm.images_path, img_name))
-            
-            image = LabeledImage.get(name=img_name)
-            if image is not None:
-                image.delete()
 
-            img = LabeledImage(name=img_name, height=height, width=width)
-            
+            rows[LabeledImage].append({
+                "id": img_id,
+                "name": img_name,
+                "height": height,
+                "width": width,
+                "trash": trash_tag,
+                "requires_annotation": show_all or img_name in reviewed_img_names,
+            })
+
             # BBoxes
             for bbox in bboxes:
-                rect = BBox(
-                    x1=bbox["x1"],
-                    y1=bbox["y1"],
-                    x2=bbox["x2"],
-                    y2=bbox["y2"],
-                    label=bbox["label"],
-                )
-                img.bboxes.append(rect)
+                rows[BBox].append({
+                    "item_id": img_id,
+                    "x1": bbox["x1"],
+                    "y1": bbox["y1"],
+                    "x2": bbox["x2"],
+                    "y2": bbox["y2"],
+                    "label": bbox["label"],
+                })
 
             # KGroups
             for kgroup_data in kgroups:
-                kgroup = KeypointGroup(
-                    label=kgroup_data["label"],
-                    keypoints_data=json.dumps(kgroup_data["points"])
-                )
-                img.kgroups.append(kgroup)
-            
+                rows[KeypointGroup].append({
+                    "item_id": img_id,
+                    "label": kgroup_data["label"],
+                    "keypoints_data": json.dumps(kgroup_data["points"]),
+                })
+
             # Masks
             for label_name, rle in masks.items():
-                mask = Mask(
-                    label=label_name,
-                    rle=rle,
-                    height=img.height,
-                    width=img.width,
-                )
-                img.masks.append(mask)
-            
-            # Trash
-            img.trash = trash_tag
-
-            limages.append(img)
-        LabeledImage.save_batch(limages)
-
-        # Review labels
-        if os.path.isfile(self.pm.review_ann_path ):
-            review_data = open_json(self.pm.review_ann_path)
-
-            # Check how many images with review labels
-            number_for_correction = 0
-            for img_name in os.listdir(self.pm.images_path):
-                review_data_for_image = review_data.get(img_name, [])
-                if len(review_data_for_image) > 0:
-                    number_for_correction += 1
-            show_all = number_for_correction == 0
-
-            limages = list()
-            for img_name in os.listdir(self.pm.images_path):
-                image = LabeledImage.get(name=img_name)
-                review_data_for_image = review_data.get(img_name, [])
-
-                image.clear_review_labels()
-                if show_all:
-                    image.requires_annotation = True
-                else:
-                    image.requires_annotation = False
-
-                if len(review_data_for_image) > 0:
-                    image.requires_annotation = True
-
+                rows[Mask].append({
+                    "item_id": img_id,
+                    "label": label_name,
+                    "rle_blob": annotation_to_blob(rle, mask_format),
+                    "height": height,
+                    "width": width,
+                })
+
+            if len(rows[LabeledImage]) >= self.overwrite_batch_size:
+                insert_rows()
+                if update_callback is not None:
+                    processed = len(processed_img_names)
+                    elapsed_time = time.time() - start_time
+                    remaining_time = (len(img_ids) - processed) * elapsed_time / processed
+                    update_callback(processed / len(img_ids) * 100, 0, 0, remaining_time, processing_complete=False)
+
+        # Images are added in the order of figures.json, figures of images without files are ignored
+        for img_name, img_info in iter_json_items(self.pm.figures_ann_path):
+            if img_name in img_ids and img_name not in processed_img_names:
+                add_image(img_name, img_info)
+        for img_name in img_ids:
+            if img_name not in processed_img_names:
+                add_image(img_name, None)
+        insert_rows()
+
+        if review_exists:
+            for img_name, review_data_for_image in iter_json_items(self.pm.review_ann_path):
+                if img_name in img_ids:
                     for item in review_data_for_image:
-                        rl = ReviewLabel(x=item["x"], y=item["y"], label=item["label"])
-                        image.review_labels.append(rl)
-
-                limages.append(image)
+                        rows[ReviewLabel].append({
+                            "item_id": img_ids[img_name],
+                            "x": item["x"],
+                            "y": item["y"],
+                            "label": item["label"],
+                        })
+                if len(rows[ReviewLabel]) >= self.overwrite_batch_size:
+                    insert_rows()
+        insert_rows()
+
+        # Objects loaded before the overwrite refer to the removed rows
+        session.expire_all()
+
+        if update_callback is not None:
+            update_callback(100, 0, 0, 0, processing_complete=True)
+
+    @staticmethod
+    def _serialize_figures(limage: LabeledImage) -> Dict:
+        mask_format = get_mask_format()
+        return {
+            "trash": limage.trash, 
+            "bboxes": [{"x1": bbox.x1, "y1": bbox.y1, "x2": bbox.x2, "y2": bbox.y2, "label": bbox.label} for bbox in limage.bboxes],
+            "kgroups": [{"points": json.loads(kgroup.serialize_keypoints(kgroup.keypoints)), "label": kgroup.label} for kgroup in limage.kgroups],
+            "masks": {mask.label: mask.serialize_annotation(mask_format) for mask in limage.masks},
+            "height": limage.height,
+            "width": limage.width
+        }
 
-            LabeledImage.save_batch(limages)
+    @staticmethod
+    def _serialize_review(limage: LabeledImage) -> List[Dict]:
+        return [{"label": rlabel.label, "x": rlabel.x, "y": rlabel.y} for rlabel in limage.review_labels]
 
     def _export_figures(self, figures_ann_path: str):
-        figures_dict = dict()
-        for limage in LabeledImage.all():
-            figures_dict[limage.name] = {
-                "trash": limage.trash, 
-                "bboxes": [{"x1": bbox.x1, "y1": bbox.y1, "x2": bbox.x2, "y2": bbox.y2, "label": bbox.label} for bbox in limage.bboxes],
-                "kgroups": [{"points": json.loads(kgroup.serialize_keypoints(kgroup.keypoints)), "label": kgroup.label} for kgroup in limage.kgroups],
-                "masks": {mask.label: mask.rle for mask in limage.masks},
-                "height": limage.height,
-                "width": limage.width
-            }
-        save_json(figures_dict, figures_ann_path) 
+        export_figures(figures_ann_path)
 
     def _export_review(self, review_ann_path):
-        review_label_dict = dict()
-        for limage in LabeledImage.all(): 
-            if len(limage.review_labels) > 0:
-                review_label_dict[limage.name] = [
-                    {"label": rlabel.label, "x": rlabel.x, "y": rlabel.y}
-                    for rlabel in limage.review_labels
-                ]
-        save_json(review_label_dict, review_ann_path) 
+        export_review(review_ann_path)
+
+    def upload_delta(self) -> int:
+        """
+        Uploads images saved since the last upload as `figures.patch.json` or `review.patch.json`:
+        {"since": <time of the previous patch>, "until": <time of this patch>, "images": {"img_name.jpg": <same as in the full file>, ...}}
+        In review patch images without review labels have empty lists, so removed labels are removed on the server too
+        """
+        if self.project_data.stage in [AnnotationStage.ANNOTATE, AnnotationStage.CORRECTION]:
+            serialize, patch_path = self._serialize_figures, self.pm.figures_patch_path
+        elif self.project_data.stage is AnnotationStage.REVIEW:
+            serialize, patch_path = self._serialize_review, self.pm.review_patch_path
+        else:
+            return 0
+
+        sync_time = time.time()  # Images saved while the patch is uploaded are sent with the next patch
+        last_sync_time = float(Value.get_value("delta_sync_time") or 0)
+        limages = LabeledImage.modified_since(last_sync_time)
+        if len(limages) == 0:
+            return 0
+
+        patch = {"since": last_sync_time, "until": sync_time, "images": {limage.name: serialize(limage) for limage in limages}}
+        with open(patch_path, "w") as file:
+            json.dump(patch, file, separators=(",", ":"))
+        response = send_file(self.project_data.uid, patch_path)
+        if response.status_code != 200:
+            raise RuntimeError(f"Server responded with status code {response.status_code} while uploading {patch_path}")
+        Value.update_value("delta_sync_time", sync_time)
+        return len(limages)
 
     def download_and_overwrite_annotations(self):
         """Force download and overwrite annotations in the database"""
 
         project_id, project_uid = self.project_data.id, self.project_data.uid
 
-        annotation_stage, annotation_mode = get_project_data(project_uid)
-        
-        download_file(
-            uid=project_uid, 
-            file_name=os.path.basename(self.pm.figures_ann_path), 
-            save_path=self.pm.figures_ann_path, 
-        )
-        download_file(
-            uid=project_uid, 
-            file_name=os.path.basename(self.pm.review_ann_path), 
-            save_path=self.pm.review_ann_path, 
-            ignore_404=True
-        )
-        download_file(
-            uid=project_uid, 
-            file_name=os.path.basename(self.pm.meta_ann_path), 
-            save_path=self.pm.meta_ann_path, 
+        downloads = download_files_concurrently(
+            project_uid, 
+            [self.pm.figures_ann_path, self.pm.review_ann_path, self.pm.meta_ann_path], 
+            optional_paths=[self.pm.review_ann_path]
         )
+        annotation_stage, annotation_mode = get_project_data(project_uid)
+        wait_for_downloads(downloads)
 
-        img_ann_number = len(open_json(self.pm.figures_ann_path))
+        img_ann_number = count_json_items(self.pm.figures_ann_path)
         img_number = len(os.listdir(self.pm.images_path))
 
         if img_number != img_ann_number:
@@ -274,13 +352,15 @@ class ImageLabelingIO(ImageIO):
 
         self.overwrite_project()
 
-    def _upload_annotation_results(self): # The method name is upload results. The method content should reflect its name, don't update Value in it
+    def _upload_annotation_results(self, root: tk.Tk): # The method name is upload results. The method content should reflect its name, don't update Value in it
         if self.project_data.stage in [AnnotationStage.ANNOTATE, AnnotationStage.CORRECTION]:
             self._export_figures(figures_ann_path=self.pm.figures_ann_path)
-            upload_file(self.project_data.uid, self.pm.figures_ann_path)
+            ftc = FileTransferClient(window_title="Uploading progress", root=root)
+            ftc.upload(self.project_data.uid, self.pm.figures_ann_path)
         elif self.project_data.stage is AnnotationStage.REVIEW:
             self._export_review(review_ann_path=self.pm.review_ann_path)
-            upload_file(self.project_data.uid, self.pm.review_ann_path)
+            ftc = FileTransferClient(window_title="Uploading progress", root=root)
+            ftc.upload(self.project_data.uid, self.pm.review_ann_path)
 
     def _remove_after_completion(self):
         if self.project_data.stage is AnnotationStage.REVIEW and ReviewLabel.count_with_image() == 0: 
@@ -15,7 +15,7 @@ from exceptions import MessageBoxException
 from models import ProjectData
 from .drawing import create_class_selection_wheel, get_selected_sector_id
 from .figure_controller import Mode, ObjectFigureController
-from .figure_controller_factory import ControllerByMode
+from .figure_controller_factory import get_controller_type
 from .models import Figure, LabeledImage, ReviewLabel
 from .path_manager import LabelingPathManager
 from config import ColorBGR, settings
@@ -94,7 +94,7 @@ class ImageLabelingLogic(AbstractImageAnnotationLogic):
         if project_data.stage is AnnotationStage.REVIEW:
             self.controller = ObjectFigureController(active_label=active_label)
         else:
-            self.controller = ControllerByMode[project_data.mode](active_label=active_label)
+            self.controller = get_controller_type(project_data.mode)(active_label=active_label)
 
         super().__init__(data_path=data_path, project_data=project_data)
 
@@ -230,6 +230,7 @@ class ImageLabelingLogic(AbstractImageAnnotationLogic):
                         with_border=True
                     )
 
+            self.canvas, figures_to_draw = self.controller.draw_figures(self.canvas, figures_to_draw, labels=self.labels)
             for figure_id, figure in enumerate(sorted(figures_to_draw, key=lambda x: x.surface, reverse=True)):
                 self.canvas = figure.draw_figure(
                     canvas=self.canvas, 
@@ -301,6 +302,7 @@ class ImageLabelingLogic(AbstractImageAnnotationLogic):
                     elif figure_type == FigureType.KGROUP.name:
                         kgroups.append(figure)
                     elif figure_type == FigureType.MASK.name:
+                        figure.ensure_encoded()
                         masks.append(figure)
                     else:
                         raise RuntimeError(f"Unknown figure type {figure_type}")
@@ -311,6 +313,7 @@ class ImageLabelingLogic(AbstractImageAnnotationLogic):
                 self.labeled_image.trash = self.is_trash
 
             self.labeled_image.save()
+            self.item_changed = False  # Images which are only viewed keep their modification time
 
 
     def switch_item(self, item_id: int):
@@ -318,12 +321,19 @@ class ImageLabelingLogic(AbstractImageAnnotationLogic):
         if item_id > len(self.img_names) - 1 or item_id < 0:
             return
         self.save_item()
+        self.release_masks()
         self.controller.clear_history()
         self.item_id = item_id
         self.load_item()
         self.save_state()
 
 
+    def release_masks(self):
+        """Decoded masks of the image are not kept when another image is shown, they are decoded again from RLE if needed"""
+        for figure in self.figures + self.controller.figures:
+            if figure.figure_type == FigureType.MASK.name:
+                figure.release()
+
     def toggle_image_trash_tag(self):
         if self.project_data.stage is AnnotationStage.REVIEW:
             return
@@ -407,10 +417,12 @@ class ImageLabelingLogic(AbstractImageAnnotationLogic):
     def redo(self):
         if self.editing_blocked: return
         self.controller.redo()
+        self.item_changed = True  # Figures may be deleted from the database, the image is saved to update its modification time
 
     def undo(self):
         if self.editing_blocked: return
         self.controller.undo()
+        self.item_changed = True
     
     def copy(self):
         if self.editing_blocked: return
@@ -4,9 +4,10 @@ from annotation_widgets.image.models import Label
 from db import Base, get_session
 
 import json
+import time
 import cv2
 import numpy as np
-from sqlalchemy import Boolean, asc, create_engine, Column, String, Integer, ForeignKey, inspect, func
+from sqlalchemy import Boolean, Float, asc, create_engine, Column, String, Integer, ForeignKey, inspect, func
 from sqlalchemy.orm import relationship, scoped_session, sessionmaker, declarative_base, reconstructor
 from typing import Any, List, Optional, Tuple, Dict
 from config import settings
@@ -21,6 +22,7 @@ class LabeledImage(Base):
     width = Column(Integer)
     trash = Column(Boolean, default=False)
     requires_annotation = Column(Boolean, default=True)
+    modified_at = Column(Float, index=True)  # Time of the last save by the annotator, NULL for downloaded annotations
 
     bboxes = relationship("BBox", back_populates="image")
     kgroups = relationship("KeypointGroup", back_populates="image")
@@ -37,6 +39,11 @@ class LabeledImage(Base):
         session = get_session()
         return list(session.query(cls).order_by(asc(cls.name)))
 
+    @classmethod
+    def modified_since(cls, timestamp: float) -> List["LabeledImage"]:
+        session = get_session()
+        return list(session.query(cls).filter(cls.modified_at > timestamp).order_by(asc(cls.name)))
+
     def __init__(self, name, height, width):
         self.name = name
         self.height = height
@@ -44,13 +51,16 @@ class LabeledImage(Base):
 
     def save(self):
         session = get_session()
+        self.modified_at = time.time()
         session.add(self)
         session.commit()
 
     @classmethod
     def save_batch(cls, limages: List["LabeledImage"]):
         session = get_session()
+        modified_at = time.time()
         for limage in limages:
+            limage.modified_at = modified_at
             session.add(limage)
         session.commit()
 
@@ -153,7 +163,7 @@ class ReviewLabel(Figure):
     __tablename__ = 'review_label'
 
     id = Column(Integer, primary_key=True)
-    item_id = Column(Integer, ForeignKey('image.id', ondelete='CASCADE'))
+    item_id = Column(Integer, ForeignKey('image.id', ondelete='CASCADE'), index=True)
     x = Column(Integer)
     y = Column(Integer)
     label = Column(String) # TODO: Use Label reference instead of str
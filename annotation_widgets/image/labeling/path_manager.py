@@ -16,6 +16,14 @@ class LabelingPathManager(BasePathManager):
     def review_ann_path(self):  # Labeling
         return os.path.join(self.project_path, f"review.json")
 
+    @property
+    def figures_patch_path(self):  # Labeling
+        return os.path.join(self.project_path, f"figures.patch.json")
+
+    @property
+    def review_patch_path(self):  # Labeling
+        return os.path.join(self.project_path, f"review.patch.json")
+
     @property
     def images_path(self):  # Labeling
         return os.path.join(self.project_path, f"images")
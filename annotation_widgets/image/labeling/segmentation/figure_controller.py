@@ -2,16 +2,18 @@ from annotation_widgets.image.models import Label
 import cv2
 from annotation_widgets.image.labeling.models import Figure
 from annotation_widgets.image.labeling.segmentation.models import Mask
-from config import ColorBGR
+from config import ColorBGR, settings
 from annotation_widgets.image.labeling.figure_controller import AbstractFigureController, Mode
-from annotation_widgets.image.labeling.segmentation.masks_encoding import get_empty_rle
+from annotation_widgets.image.labeling.segmentation.masks_encoding import get_empty_rle_blob
+from annotation_widgets.image.labeling.segmentation.label_map import LabelMap
+from annotation_widgets.image.labeling.segmentation.mask_history import LabelMapPatch, MaskHistory, MaskPatch, MaskReplacement
 from annotation_widgets.image.labeling.models import Point
 
 
 import numpy as np
 
 
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 
 class MaskFigureController(AbstractFigureController):
@@ -22,17 +24,38 @@ class MaskFigureController(AbstractFigureController):
         self.adding_mask = True
         self.figures_dict = dict()
         self.lock_distance = 4
+        # Instead of snapshots of all masks only changed regions are kept
+        self.mask_history = MaskHistory(size_bytes=int(settings.mask_history_size_mb * 1024 ** 2))
+
+    def take_snapshot(self):
+        """Edits are added to `mask_history` by the commands themselves"""
+
+    def clear_history(self):
+        self.mask_history.clear()
+
+    @property
+    def history_target(self):
+        """Object changed by commands of the history"""
+        return self.figures_dict
 
     def undo(self):
-        super().undo()
+        self.mask_history.undo(self.history_target)
         self.mode = Mode.IDLE
         self.polygon = list()
 
     def redo(self):
-        super().redo()
+        self.mask_history.redo(self.history_target)
         self.mode = Mode.IDLE
         self.polygon = list()
 
+    def get_empty_mask_kwargs(self, label_name: str) -> Dict:
+        return {
+            "label": label_name,
+            "rle_blob": get_empty_rle_blob(height=self.img_height, width=self.img_width),
+            "height": self.img_height,
+            "width": self.img_width,
+        }
+
     def copy(self):
         if self.figures_dict.get(self.active_label.name) is not None:
             self.serialized_figures_buffer = [{
@@ -41,12 +64,18 @@ class MaskFigureController(AbstractFigureController):
             }]
 
     def paste(self):
+        commands = list()
         for figure in self.serialized_figures_buffer:
-            fig_type = figure["type"]
             fig_kwargs = figure["kwargs"]
-            label = fig_kwargs["label"]
-            self.figures_dict[label] = fig_type(**fig_kwargs)
-        self.take_snapshot()
+            current_figure = self.figures_dict.get(fig_kwargs["label"])
+            command = MaskReplacement(
+                label=fig_kwargs["label"],
+                before=current_figure.serialize() if current_figure is not None else None,
+                after=fig_kwargs,
+            )
+            command.apply(self.figures_dict)
+            commands.append(command)
+        self.mask_history.add(commands)
 
     @property
     def figures(self) -> List[Figure]:
@@ -100,26 +129,26 @@ class MaskFigureController(AbstractFigureController):
     def edit_mask(self, adding: bool):
         self.polygon.append((self.cursor_x, self.cursor_y))
         self.polygon[-1] = self.polygon[0]
+        commands = list()
         figure = self.figures_dict.get(self.active_label.name)
         if figure is None:
-            figure = Mask(
-                label=self.active_label.name,
-                rle=get_empty_rle(height=self.img_height, width=self.img_width),
-                height=self.img_height,
-                width=self.img_width,
-            )
-            self.figures_dict[self.active_label.name] = figure
+            command = MaskReplacement(label=self.active_label.name, before=None, after=self.get_empty_mask_kwargs(self.active_label.name))
+            command.apply(self.figures_dict)
+            commands.append(command)
+            figure = self.figures_dict[self.active_label.name]
 
         # Define your polygon points
         polygon = np.array(self.polygon, np.int32).reshape((-1, 1, 2))
 
-        # Use polygon points to remove/add part of class mask
-        figure.mask = cv2.fillPoly(figure.mask, [polygon], color=1 if adding else 0)
+        # Use polygon points to remove/add part of class mask. RLE of the changed rows is updated when the image is saved.
+        # Only bytes of the changed region are kept for undo
+        region = figure.packed_mask.get_polygon_region(polygon)
+        if region is not None:
+            before = figure.packed_mask.get_bytes(region)
+            figure.fill_polygon(polygon, value=1 if adding else 0)
+            commands.append(MaskPatch(label=figure.label, region=region, before=before, after=figure.packed_mask.get_bytes(region)))
 
-        # Update figure rle
-        figure.encode_mask()
-
-        self.take_snapshot()
+        self.mask_history.add(commands)
 
     def handle_space(self):
         if self.mode is Mode.CREATE:
@@ -134,15 +163,12 @@ class MaskFigureController(AbstractFigureController):
 
     def delete_command(self):
         # Delete class with active label (does not matter where is cursor)
-        if self.figures_dict.get(self.active_label.name) is not None:
-            self.figures_dict[self.active_label.name].delete()
-            self.figures_dict[self.active_label.name] = Mask(
-                label=self.active_label.name,
-                rle=get_empty_rle(height=self.img_height, width=self.img_width),
-                height=self.img_height,
-                width=self.img_width,
-            )
-            self.take_snapshot()
+        figure = self.figures_dict.get(self.active_label.name)
+        if figure is not None:
+            command = MaskReplacement(label=figure.label, before=figure.serialize(), after=self.get_empty_mask_kwargs(self.active_label.name))
+            figure.delete()
+            self.figures_dict[figure.label] = Mask(**command.after)
+            self.mask_history.add([command])
 
     def change_label(self, label: Label):
         self.active_label = label
@@ -165,4 +191,114 @@ class MaskFigureController(AbstractFigureController):
             if self.check_cursor_on_polygon_start():
                 cv2.circle(canvas, self.polygon[0], self.lock_distance, (255, 255, 255), 1)
 
-        return canvas
\ No newline at end of file
+        return canvas
+
+
+class LabelMapFigureController(MaskFigureController):
+    """
+    Segmentation with masks of all classes in one label map of the image, each polygon is filled once and
+    all classes are drawn in one pass. Masks of classes are kept for storage, only rows of the map
+    changed after the previous reading of `figures` are written to them
+    """
+
+    def __init__(self, active_label: Label):
+        super().__init__(active_label)
+        self.label_map: Optional[LabelMap] = None
+        self.masks_list: Optional[List[Mask]] = None
+
+    @property
+    def figures(self) -> List[Figure]:
+        self.update_masks()
+        if self.masks_list is None:
+            self.masks_list = MaskFigureController.figures.fget(self)
+        return self.masks_list
+
+    @figures.setter
+    def figures(self, figures: List[Mask]):
+        MaskFigureController.figures.fset(self, figures)
+        self.label_map = None
+        self.masks_list = None
+
+    @property
+    def history_target(self):
+        return self.get_label_map()
+
+    def get_label_map(self) -> LabelMap:
+        """The map is built on the first drawing or editing of the image, when the size of the image is known"""
+        if self.label_map is None:
+            masks = list(self.figures_dict.values())
+            self.label_map = LabelMap.from_masks(
+                [mask.packed_mask for mask in masks],
+                label_names=[mask.label for mask in masks],
+                height=self.img_height,
+                width=self.img_width,
+            )
+        return self.label_map
+
+    def update_masks(self):
+        """Writes changed rows of the label map to masks of classes"""
+        if self.label_map is None:
+            return
+        dirty_rows = self.label_map.pop_dirty_rows()
+        if dirty_rows is None:
+            return
+        y_min, y_max = dirty_rows
+        for label_name in self.label_map.label_names:
+            figure = self.figures_dict.get(label_name)
+            if figure is None:
+                figure = Mask(**self.get_empty_mask_kwargs(label_name))
+                self.figures_dict[label_name] = figure
+            packed_rows = self.label_map.to_packed_rows(label_name, y_min, y_max)
+            figure.set_packed_bytes((y_min, y_max, 0, packed_rows.shape[1]), packed_rows)
+        self.masks_list = None
+
+    def change_label(self, label: Label):
+        super().change_label(label)
+        self.masks_list = None  # The mask of the active class is the last one
+
+    def replace_label(self, label_name: str, mask: np.ndarray):
+        """Replaces pixels of the class by the mask"""
+        label_map = self.get_label_map()
+        replacement = label_map.get_label_replacement(label_name, mask)
+        if replacement is None:
+            return
+        region, values = replacement
+        before = label_map.get_region(region)
+        label_map.set_region(region, values)
+        self.mask_history.add([LabelMapPatch(region=region, before=before, after=values)])
+
+    def copy(self):
+        self.update_masks()
+        super().copy()
+
+    def paste(self):
+        label_map = self.get_label_map()
+        for figure in self.serialized_figures_buffer:
+            fig_kwargs = figure["kwargs"]
+            if (fig_kwargs["height"], fig_kwargs["width"]) == (label_map.height, label_map.width):
+                self.replace_label(fig_kwargs["label"], Mask(**fig_kwargs).mask)
+
+    def edit_mask(self, adding: bool):
+        self.polygon.append((self.cursor_x, self.cursor_y))
+        self.polygon[-1] = self.polygon[0]
+        polygon = np.array(self.polygon, np.int32).reshape((-1, 1, 2))
+
+        label_map = self.get_label_map()
+        region = label_map.get_polygon_region(polygon)
+        if region is None:
+            return
+        before = label_map.get_region(region)
+        label_map.fill_polygon(polygon, label_name=self.active_label.name, adding=adding)
+        self.mask_history.add([LabelMapPatch(region=region, before=before, after=label_map.get_region(region))])
+
+    def delete_command(self):
+        label_map = self.get_label_map()
+        self.replace_label(self.active_label.name, np.zeros((label_map.height, label_map.width), dtype=np.uint8))
+
+    def draw_figures(self, canvas: np.ndarray, figures: List[Figure], labels: Dict[str, Dict[str, Label]]) -> Tuple[np.ndarray, List[Figure]]:
+        colors = {
+            figure.label: labels[figure.figure_type][figure.label].color_bgr
+            for figure in figures if isinstance(figure, Mask)
+        }
+        canvas = self.get_label_map().paint(canvas, colors=colors, opacity=0.5)  # The same opacity as in Mask.draw_figure
+        return canvas, [figure for figure in figures if not isinstance(figure, Mask)]
@@ -0,0 +1,152 @@
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from annotation_widgets.image.labeling.segmentation.packed_mask import PackedMask
+
+
+Region = Tuple[int, int, int, int]  # First row, end row, first column, end column
+
+
+class LabelMap:
+    """
+    Masks of all classes of the image in one uint16 array with the class id of each pixel, 0 is background.
+    Unlike separate masks of classes, a pixel belongs to one class only, the class drawn later takes the pixel
+    """
+
+    def __init__(self, height: int, width: int):
+        self.height = height
+        self.width = width
+        self.map = np.zeros((height, width), dtype=np.uint16)
+        self.label_ids: Dict[str, int] = dict()
+        self.label_names: List[str] = list()
+        self.dirty_rows: Optional[Tuple[int, int]] = None  # Rows changed after the last `pop_dirty_rows`
+
+    @classmethod
+    def from_masks(cls, masks: List[PackedMask], label_names: List[str], height: int, width: int) -> "LabelMap":
+        label_map = cls(height=height, width=width)
+        for mask, label_name in zip(masks, label_names):
+            label_id = label_map.get_label_id(label_name)
+            occupied_rows = mask.get_occupied_rows()
+            if occupied_rows is None:
+                continue
+            y_min, y_max = occupied_rows
+            rows = label_map.map[y_min:y_max]
+            rows[mask.get_rows(y_min, y_max) > 0] = label_id
+        return label_map
+
+    def get_label_id(self, label_name: str) -> int:
+        """Id of the class in the map, new classes get the next id"""
+        label_id = self.label_ids.get(label_name)
+        if label_id is None:
+            self.label_names.append(label_name)
+            label_id = len(self.label_names)
+            self.label_ids[label_name] = label_id
+        return label_id
+
+    def get_label(self, x: int, y: int) -> Optional[str]:
+        """Class of the pixel, None for background"""
+        label_id = int(self.map[y, x])
+        return self.label_names[label_id - 1] if label_id > 0 else None
+
+    def mark_dirty(self, y_min: int, y_max: int):
+        if self.dirty_rows is not None:
+            y_min, y_max = min(y_min, self.dirty_rows[0]), max(y_max, self.dirty_rows[1])
+        self.dirty_rows = (y_min, y_max)
+
+    def pop_dirty_rows(self) -> Optional[Tuple[int, int]]:
+        dirty_rows, self.dirty_rows = self.dirty_rows, None
+        return dirty_rows
+
+    def get_polygon_region(self, polygon: np.ndarray) -> Optional[Region]:
+        points = polygon.reshape((-1, 2))
+        y_min, y_max = max(int(points[:, 1].min()), 0), min(int(points[:, 1].max()) + 1, self.height)
+        x_min, x_max = max(int(points[:, 0].min()), 0), min(int(points[:, 0].max()) + 1, self.width)
+        if y_min >= y_max or x_min >= x_max:
+            return None
+        return y_min, y_max, x_min, x_max
+
+    def get_region(self, region: Region) -> np.ndarray:
+        y_min, y_max, x_min, x_max = region
+        return self.map[y_min:y_max, x_min:x_max].copy()
+
+    def set_region(self, region: Region, values: np.ndarray):
+        y_min, y_max, x_min, x_max = region
+        self.map[y_min:y_max, x_min:x_max] = values
+        self.mark_dirty(y_min, y_max)
+
+    def fill_polygon(self, polygon: np.ndarray, label_name: str, adding: bool) -> Optional[Region]:
+        """Adds the polygon to the class or removes pixels of the class inside of the polygon. Returns the changed region"""
+        region = self.get_polygon_region(polygon)
+        if region is None:
+            return None
+        label_id = self.get_label_id(label_name)
+        polygon = polygon.reshape((-1, 1, 2)).astype(np.int32)
+        if adding:
+            cv2.fillPoly(self.map, [polygon], color=label_id)
+        else:
+            # Only pixels of the class are removed, pixels of other classes under the polygon are kept
+            y_min, y_max, x_min, x_max = region
+            values = self.map[y_min:y_max, x_min:x_max]
+            polygon_mask = np.zeros(values.shape, dtype=np.uint8)
+            cv2.fillPoly(polygon_mask, [polygon], color=1, offset=(-x_min, -y_min))
+            values[(polygon_mask > 0) & (values == label_id)] = 0
+        self.mark_dirty(region[0], region[1])
+        return region
+
+    def get_label_replacement(self, label_name: str, mask: np.ndarray) -> Optional[Tuple[Region, np.ndarray]]:
+        """
+        Region and its values in which pixels of the class are replaced by pixels of the mask, the map is not changed.
+        None if the class has no pixels and the mask is empty
+        """
+        label_id = self.get_label_id(label_name)
+        rows = np.flatnonzero((self.map == label_id).any(axis=1) | mask.any(axis=1))
+        if len(rows) == 0:
+            return None
+        y_min, y_max = int(rows[0]), int(rows[-1]) + 1
+        values = self.map[y_min:y_max].copy()
+        values[values == label_id] = 0
+        values[mask[y_min:y_max] > 0] = label_id
+        return (y_min, y_max, 0, self.width), values
+
+    def to_packed_rows(self, label_name: str, y_min: int, y_max: int) -> np.ndarray:
+        """Rows of the class mask packed in the same way as PackedMask"""
+        return np.packbits(self.map[y_min:y_max] == self.label_ids[label_name], axis=1)
+
+    @staticmethod
+    def apply_lut(class_ids: np.ndarray, lut: np.ndarray) -> np.ndarray:
+        if class_ids.dtype == np.uint8:
+            return cv2.LUT(class_ids, np.ascontiguousarray(lut[:256]))
+        return np.take(lut, class_ids)
+
+    def paint(self, canvas: np.ndarray, colors: Dict[str, Tuple[int, int, int]], opacity: float) -> np.ndarray:
+        """
+        Returns a copy of the canvas with all classes drawn in one pass, the color of each pixel is taken from the lookup table.
+        Classes without colors are not drawn
+        """
+        canvas = np.copy(canvas)
+        # Color channels and the visibility of classes by class ids, cv2.LUT requires 256 values
+        lut = np.zeros((max(len(self.label_names) + 1, 256), 4), dtype=np.uint8)
+        for label_name, color in colors.items():
+            label_id = self.label_ids.get(label_name)
+            if label_id is not None:
+                lut[label_id] = (*color, 1)
+
+        # cv2.LUT works only with 8 bit images and is much faster than numpy indexing
+        class_ids = self.map.astype(np.uint8) if len(self.label_names) < 256 else self.map
+        visible = self.apply_lut(class_ids, lut[:, 3])
+        occupied_rows = np.flatnonzero(visible.any(axis=1))
+        if len(occupied_rows) == 0:
+            return canvas
+        y_min, y_max = int(occupied_rows[0]), int(occupied_rows[-1]) + 1
+        rows = np.ascontiguousarray(canvas[y_min:y_max, :, :3])  # The alpha channel of BGRA canvases is not changed
+        colored_rows = cv2.merge([self.apply_lut(class_ids[y_min:y_max], lut[:, channel]) for channel in range(3)])
+        blended_rows = cv2.addWeighted(colored_rows, opacity, rows, max(1 - opacity, 0), 0)
+        cv2.copyTo(blended_rows, visible[y_min:y_max], rows)
+        canvas[y_min:y_max, :, :3] = rows
+        return canvas
+
+    @property
+    def nbytes(self) -> int:
+        return self.map.nbytes
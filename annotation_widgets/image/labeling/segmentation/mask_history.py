@@ -0,0 +1,117 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from annotation_widgets.image.labeling.segmentation.label_map import LabelMap
+from annotation_widgets.image.labeling.segmentation.models import Mask
+from annotation_widgets.image.labeling.segmentation.packed_mask import Region
+
+
+class MaskPatch:
+    """Change of one region of a packed mask, keeps only bytes of the region before and after the edit"""
+
+    def __init__(self, label: str, region: Region, before: np.ndarray, after: np.ndarray):
+        self.label = label
+        self.region = region
+        self.before = before
+        self.after = after
+
+    def apply(self, figures_dict: Dict[str, Mask], reverse: bool = False):
+        figures_dict[self.label].set_packed_bytes(self.region, self.before if reverse else self.after)
+
+    @property
+    def nbytes(self) -> int:
+        return self.before.nbytes + self.after.nbytes
+
+
+class MaskReplacement:
+    """Change of the whole mask of the class, for example by deletion or pasting. None means there is no mask"""
+
+    def __init__(self, label: str, before: Optional[Dict], after: Optional[Dict]):
+        self.label = label
+        self.before = before  # Mask.serialize()
+        self.after = after
+
+    def apply(self, figures_dict: Dict[str, Mask], reverse: bool = False):
+        kwargs = self.before if reverse else self.after
+        figure = figures_dict.get(self.label)
+        if kwargs is None:
+            if figure is not None:
+                figure.delete()
+                figures_dict.pop(self.label)
+        elif figure is not None:
+            figure.set_rle_blob(kwargs["rle_blob"], height=kwargs["height"], width=kwargs["width"])
+        else:
+            figures_dict[self.label] = Mask(**kwargs)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(kwargs["rle_blob"]) for kwargs in (self.before, self.after) if kwargs is not None)
+
+
+class LabelMapPatch:
+    """Change of one region of the label map"""
+
+    def __init__(self, region: Tuple[int, int, int, int], before: np.ndarray, after: np.ndarray):
+        self.region = region
+        self.before = before
+        self.after = after
+
+    def apply(self, label_map: LabelMap, reverse: bool = False):
+        label_map.set_region(self.region, self.before if reverse else self.after)
+
+    @property
+    def nbytes(self) -> int:
+        return self.before.nbytes + self.after.nbytes
+
+
+class MaskHistory:
+    """
+    Undo history of mask edits. Each entry is a list of commands applied by one action,
+    only changed regions are kept, so memory depends on the size of edits and not on the size of masks.
+    The oldest entries are removed when the history is larger than `size_bytes`.
+    Commands are applied to the target given to `undo` and `redo`: the dict of masks by labels or the label map
+    """
+
+    def __init__(self, size_bytes: int):
+        self.size_bytes = size_bytes
+        self.entries: List[List] = list()
+        self.position = 0  # Number of applied entries, entries after the position can be redone
+        self.nbytes = 0
+
+    def add(self, commands: List):
+        if len(commands) == 0:
+            return
+        for entry in self.entries[self.position:]:
+            self.nbytes -= self.get_entry_size(entry)
+        self.entries = self.entries[:self.position]
+        self.entries.append(commands)
+        self.nbytes += self.get_entry_size(commands)
+        while self.nbytes > self.size_bytes and len(self.entries) > 1:
+            self.nbytes -= self.get_entry_size(self.entries.pop(0))
+        self.position = len(self.entries)
+
+    @staticmethod
+    def get_entry_size(commands: List) -> int:
+        return sum(command.nbytes for command in commands)
+
+    def undo(self, target) -> bool:
+        if self.position == 0:
+            return False
+        self.position -= 1
+        for command in reversed(self.entries[self.position]):
+            command.apply(target, reverse=True)
+        return True
+
+    def redo(self, target) -> bool:
+        if self.position == len(self.entries):
+            return False
+        for command in self.entries[self.position]:
+            command.apply(target)
+        self.position += 1
+        return True
+
+    def clear(self):
+        self.entries = list()
+        self.position = 0
+        self.nbytes = 0
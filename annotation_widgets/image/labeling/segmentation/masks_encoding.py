@@ -1,88 +1,366 @@
-import os
 import time
+from typing import Dict, Tuple
+import zlib
+
 import cv2
 import numpy as np
-from tqdm import tqdm
 
-from utils import open_json, save_json
+from enums import MaskFormat
+
+
+# Version of the binary format produced by `pack_runs`, stored in the first byte of the blob
+RLE_BLOB_VERSION = 1
+
+
+def mask_to_runs(mask) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns values and lengths of runs of the flattened mask"""
+    flat_mask = np.ravel(mask)  # No copy for contiguous masks
+    # Runs start where the value changes
+    starts = np.concatenate(([0], np.flatnonzero(flat_mask[1:] != flat_mask[:-1]) + 1))
+    run_lengths = np.diff(np.append(starts, len(flat_mask)))
+    run_values = flat_mask[starts]
+    return run_values, run_lengths
+
+
+def merge_runs(values: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Joins neighboring runs with the same value"""
+    run_starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    return values[run_starts], np.add.reduceat(counts, run_starts)
+
+
+def splice_runs(values: np.ndarray, counts: np.ndarray, start: int, flat_span: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns runs of the flattened mask in which pixels from `start` are replaced by `flat_span`.
+    Only the span is encoded again, runs before and after it are cut at its borders and kept
+    """
+    end = start + len(flat_span)
+    run_ends = np.cumsum(counts)
+    run_starts = run_ends - counts
+
+    # Runs ending before the span and the beginning of the run crossing its start
+    head_number = np.searchsorted(run_ends, start, side="right")
+    head_values, head_counts = values[:head_number], counts[:head_number]
+    if head_number < len(counts) and run_starts[head_number] < start:
+        head_values = np.append(head_values, values[head_number])
+        head_counts = np.append(head_counts, start - run_starts[head_number])
+
+    # The end of the run crossing the end of the span and runs after it
+    tail_start = np.searchsorted(run_starts, end, side="left")
+    tail_values, tail_counts = values[tail_start:], counts[tail_start:]
+    if tail_start > 0 and run_ends[tail_start - 1] > end:
+        tail_values = np.insert(tail_values, 0, values[tail_start - 1])
+        tail_counts = np.insert(tail_counts, 0, run_ends[tail_start - 1] - end)
+
+    span_values, span_counts = mask_to_runs(flat_span)
+    return merge_runs(
+        np.concatenate((head_values, span_values, tail_values)).astype(np.uint8),
+        np.concatenate((head_counts, span_counts, tail_counts)).astype(np.int64),
+    )
+
+
+def runs_to_mask(values: np.ndarray, counts: np.ndarray, width: int, height: int) -> np.ndarray:
+    flat_mask = np.repeat(values.astype(np.uint8), counts)
+    return flat_mask.reshape((height, width))
+
+
+def rle_to_runs(encoded_str: str) -> Tuple[np.ndarray, np.ndarray]:
+    # "value:count,value:count,..." is split to numbers in one pass, numpy converts them to integers
+    numbers = np.array(encoded_str.replace(":", ",").split(","), dtype=np.int64)
+    values = numbers[0::2].astype(np.uint8)
+    counts = numbers[1::2]
+    return values, counts
+
+
+def runs_to_rle(values: np.ndarray, counts: np.ndarray) -> str:
+    """Writes "value:count,value:count,..." with digits of all numbers computed at once by numpy"""
+    numbers = np.empty(2 * len(values), dtype=np.int64)
+    numbers[0::2] = values
+    numbers[1::2] = counts
+    if len(numbers) == 0:
+        return ""
+
+    digits_number = np.ones(len(numbers), dtype=np.int64)
+    power = 10
+    while True:
+        has_digit = numbers >= power
+        if not has_digit.any():
+            break
+        digits_number += has_digit
+        power *= 10
+
+    # Each number is followed by ":" after a value and "," after a count, the last "," is cut
+    separator_positions = np.cumsum(digits_number + 1) - 1
+    buffer = np.empty(separator_positions[-1] + 1, dtype=np.uint8)
+    buffer[separator_positions[0::2]] = ord(":")
+    buffer[separator_positions[1::2]] = ord(",")
+
+    # Digits are written from the last one
+    remainders = numbers.copy()
+    for digit_id in range(digits_number.max()):
+        has_digit = digits_number > digit_id
+        buffer[separator_positions[has_digit] - 1 - digit_id] = ord("0") + remainders[has_digit] % 10
+        remainders //= 10
+    return buffer[:-1].tobytes().decode("ascii")
 
 
 def encode_rle(mask):
-    # Ensure the mask is flattened
-    flat_mask = mask.flatten()
-    # Find where the value changes
-    diff = np.diff(flat_mask)
-    # Indices where value changes
-    change_indices = np.where(diff != 0)[0] + 1
-    # Positions to split the flattened array and count runs
-    positions = np.concatenate(([0], change_indices, [len(flat_mask)]))
-    # Calculate run lengths
-    run_lengths = np.diff(positions)
-    # Values at the start of each run
-    run_values = flat_mask[positions[:-1]]
-    # Combine values and run lengths into a string
-    encoded_str = ','.join([f"{val}:{count}" for val, count in zip(run_values, run_lengths)])
-    return encoded_str
+    run_values, run_lengths = mask_to_runs(mask)
+    return runs_to_rle(run_values, run_lengths)
 
 
 def decode_rle(encoded_str, width, height): 
-    # Split the encoded string into pairs of values and counts
-    pairs = encoded_str.split(',')
-    # Separate values and their counts
-    vals_counts = [pair.split(':') for pair in pairs]
-    values = np.array([int(val) for val, _ in vals_counts], dtype=np.uint8)
-    counts = np.array([int(count) for _, count in vals_counts], dtype=int)
-    
-    # Allocate the flat mask array once based on the total length
-    flat_mask = np.zeros(counts.sum(), dtype=np.uint8)
-    
-    # Fill the flat mask using calculated indices
-    start_idx = 0
-    for value, count in zip(values, counts):
-        flat_mask[start_idx:start_idx + count] = value
-        start_idx += count
-    
-    # Reshape the flat mask to the original image shape
-    return flat_mask.reshape((height, width))
+    values, counts = rle_to_runs(encoded_str)
+    return runs_to_mask(values, counts, width=width, height=height)
+
+
+def pack_runs(values: np.ndarray, counts: np.ndarray) -> bytes:
+    """
+    Binary RLE format (zlib compressed):
+        1 byte - format version
+        4 * N bytes - run lengths, little-endian uint32
+        N bytes - run values, uint8
+    """
+    data = np.asarray(counts, dtype="<u4").tobytes() + np.asarray(values, dtype=np.uint8).tobytes()
+    return zlib.compress(bytes([RLE_BLOB_VERSION]) + data)
+
+
+def unpack_runs(blob: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    data = zlib.decompress(blob)
+    if data[0] != RLE_BLOB_VERSION:
+        raise ValueError(f"Unsupported binary RLE version {data[0]}")
+    runs_number = (len(data) - 1) // 5
+    counts = np.frombuffer(data, dtype="<u4", count=runs_number, offset=1).astype(int)
+    values = np.frombuffer(data, dtype=np.uint8, count=runs_number, offset=1 + 4 * runs_number)
+    return values, counts
+
+
+def encode_rle_blob(mask: np.ndarray) -> bytes:
+    return pack_runs(*mask_to_runs(mask))
+
+
+def decode_rle_blob(blob: bytes, width: int, height: int) -> np.ndarray:
+    values, counts = unpack_runs(blob)
+    return runs_to_mask(values, counts, width=width, height=height)
+
+
+def rle_to_blob(encoded_str: str) -> bytes:
+    """Converts RLE string used in figures.json to the binary format stored in the database"""
+    return pack_runs(*rle_to_runs(encoded_str))
+
+
+def blob_to_rle(blob: bytes) -> str:
+    """Converts binary RLE stored in the database to the RLE string used in figures.json"""
+    return runs_to_rle(*unpack_runs(blob))
 
 
 def get_empty_rle(height, width) -> str:
     return f"0:{height*width}"
 
 
+def get_empty_rle_blob(height, width) -> bytes:
+    return pack_runs(np.array([0]), np.array([height * width]))
+
+
+def mask_to_coco_counts(mask: np.ndarray) -> np.ndarray:
+    """
+    Uncompressed COCO RLE counts: lengths of runs of the binary mask flattened in column-major order,
+    the first run is of zeros and may be empty
+    """
+    # Rows of the transposed mask are columns, cv2 transposes much faster than copying of the numpy view
+    values, counts = mask_to_runs(cv2.transpose(np.asarray(mask > 0, dtype=np.uint8)))
+    if len(values) > 0 and values[0] == 1:
+        counts = np.concatenate(([0], counts))
+    return counts.astype(np.int64)
+
+
+def coco_counts_to_mask(counts: np.ndarray, height: int, width: int) -> np.ndarray:
+    values = np.arange(len(counts), dtype=np.uint8) % 2
+    return cv2.transpose(runs_to_mask(values, np.asarray(counts, dtype=np.int64), width=height, height=width))
+
+
+def coco_counts_to_string(counts: np.ndarray) -> str:
+    """
+    Compressed COCO RLE string, the same as pycocotools gives.
+    Each count (the difference with the count two positions before from the 4th count) is written by 5 bits
+    into characters starting from "0", 0x20 bit means that the number continues, 0x10 bit of the last character is the sign
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    if len(counts) == 0:
+        return ""
+    numbers = counts.copy()
+    numbers[3:] -= counts[1:-2]
+
+    # Characters of all numbers are computed at once, one pass for each 5 bits
+    chunks = list()
+    remainders = numbers.copy()
+    more = np.ones(len(numbers), dtype=bool)
+    chars_number = np.zeros(len(numbers), dtype=np.int64)
+    while more.any():
+        chunk = remainders & 0x1F
+        remainders = remainders >> 5
+        chars_number += more
+        next_more = more & np.where(chunk & 0x10, remainders != -1, remainders != 0)
+        chunks.append(np.where(next_more, chunk | 0x20, chunk) + 48)
+        more = next_more
+
+    ends = np.cumsum(chars_number)
+    buffer = np.empty(ends[-1], dtype=np.uint8)
+    starts = ends - chars_number
+    for chunk_id, chunk in enumerate(chunks):
+        has_chunk = chars_number > chunk_id
+        buffer[starts[has_chunk] + chunk_id] = chunk[has_chunk]
+    return buffer.tobytes().decode("ascii")
+
+
+def coco_string_to_counts(encoded_str: str) -> np.ndarray:
+    chars = np.frombuffer(encoded_str.encode("ascii"), dtype=np.uint8).astype(np.int64) - 48
+    if len(chars) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero((chars & 0x20) == 0) + 1
+    starts = np.concatenate(([0], ends[:-1]))
+    chunk_ids = np.arange(len(chars)) - np.repeat(starts, ends - starts)
+    numbers = np.add.reduceat((chars & 0x1F) << (5 * chunk_ids), starts)
+    # Negative numbers are extended by the sign bit of the last character
+    negative = (chars[ends - 1] & 0x10) > 0
+    numbers[negative] -= np.left_shift(1, 5 * (ends - starts)[negative])
+
+    # From the 4th count numbers are differences with the count two positions before
+    counts = numbers.copy()
+    counts[2::2] = np.cumsum(numbers[2::2])
+    counts[1::2] = np.cumsum(numbers[1::2])
+    return counts
+
+
+def encode_coco_rle(mask: np.ndarray) -> Dict:
+    """Compressed COCO RLE: {"size": [height, width], "counts": "..."}"""
+    height, width = mask.shape
+    return {"size": [height, width], "counts": coco_counts_to_string(mask_to_coco_counts(mask))}
+
+
+def decode_coco_rle(rle: Dict) -> np.ndarray:
+    """Decodes compressed or uncompressed (list of counts) COCO RLE"""
+    height, width = rle["size"]
+    counts = rle["counts"]
+    counts = coco_string_to_counts(counts) if isinstance(counts, str) else np.asarray(counts, dtype=np.int64)
+    return coco_counts_to_mask(counts, height=height, width=width)
+
+
+def coco_rle_to_blob(rle: Dict) -> bytes:
+    """Converts COCO RLE to the binary format stored in the database, pixels of the mask get value 1"""
+    return encode_rle_blob(decode_coco_rle(rle))
+
+
+def blob_to_coco_rle(blob: bytes, height: int, width: int) -> Dict:
+    return encode_coco_rle(decode_rle_blob(blob, width=width, height=height))
+
+
+def annotation_to_blob(rle, mask_format: MaskFormat) -> bytes:
+    """Converts mask from figures.json in the format of the project to the binary format stored in the database"""
+    if mask_format is MaskFormat.COCO_RLE:
+        return coco_rle_to_blob(rle)
+    return rle_to_blob(rle)
+
+
+def blob_to_annotation(blob: bytes, height: int, width: int, mask_format: MaskFormat):
+    """Converts binary RLE stored in the database to figures.json format of the project"""
+    if mask_format is MaskFormat.COCO_RLE:
+        return blob_to_coco_rle(blob, height=height, width=width)
+    return blob_to_rle(blob)
+
+
+def get_synthetic_mask(height: int, width: int, seed: int = 0) -> np.ndarray:
+    """Mask with several classes of filled polygons, similar to segmentation of road scenes"""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    for class_id in range(1, 6):
+        for _ in range(8):
+            center = rng.integers((0, 0), (width, height))
+            points = center + rng.normal(scale=min(height, width) / 10, size=(12, 2))
+            cv2.fillPoly(mask, [cv2.convexHull(points.astype(np.int32))], class_id)
+    return mask
+
+
+def reference_encode_rle(mask) -> str:
+    """Encoder of the previous versions, the format of RLE strings must stay the same"""
+    run_values, run_lengths = mask_to_runs(mask)
+    return ','.join([f"{val}:{count}" for val, count in zip(run_values, run_lengths)])
+
+
+def reference_decode_rle(encoded_str, width, height) -> np.ndarray:
+    vals_counts = [pair.split(':') for pair in encoded_str.split(',')]
+    flat_mask = np.zeros(sum(int(count) for _, count in vals_counts), dtype=np.uint8)
+    start_idx = 0
+    for value, count in vals_counts:
+        flat_mask[start_idx:start_idx + int(count)] = int(value)
+        start_idx += int(count)
+    return flat_mask.reshape((height, width))
+
+
+def reference_coco_counts_to_string(counts) -> str:
+    """Port of rleToString from pycocotools, used to check the vectorized encoder"""
+    chars = list()
+    for i, x in enumerate(counts):
+        x = int(x)
+        if i > 2:
+            x -= int(counts[i - 2])
+        more = True
+        while more:
+            c = x & 0x1F
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+
+def benchmark(function, repeats: int) -> float:
+    """Best time of `repeats` runs in milliseconds"""
+    times = list()
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return min(times) * 1000
+
+
 if __name__ == "__main__":
-    source_masks_dir = "/media/vova/data/workspace/kyiv/2024_03_16_debug_annotation/masks/train/crane"
-    output_json_path = "/media/vova/data/workspace/kyiv/2024_03_16_debug_annotation/masks/converted.json"
-    decoded_masks_dir = "/media/vova/data/workspace/kyiv/2024_03_16_debug_annotation/masks/train_decoded/crane"
-
-    os.makedirs(decoded_masks_dir, exist_ok=True)
-
-    # 1. Encode all masks and save to json
-    # encoded_masks = dict()
-    # for mask_name in tqdm(os.listdir(source_masks_dir), desc="Encoding"): # 60it/s
-    #     mask = cv2.imread(os.path.join(source_masks_dir, mask_name), cv2.IMREAD_GRAYSCALE)
-    #     encoded = encode_rle(mask)
-    #     encoded_masks[mask_name] = encoded
-    
-    # save_json(value=encoded_masks, file_path=output_json_path)
-
-    # 2. Open json and decode masks and save them to decoded dir
-    data = open_json(output_json_path)
-
-    decode_speed_total = 0
-    for mask_name, encoded in tqdm(data.items(), desc="Decoding"): # 74.78it/s
-        start = time.time()
-        decoded = decode_rle(encoded, width=1920, height=1080)
-        decode_speed_total += time.time() - start
-        # decoded[decoded>0] = 100
-        # output_pauth = os.path.join(decoded_masks_dir, mask_name)
-        # cv2.imwrite(output_pauth, decoded)
-
-    print(decode_speed_total / len(data)) # 0.0015846541779512787
-
-    # 3. Check difference
-    # for mask_name in os.listdir(source_masks_dir):
-    #     mask = cv2.imread(os.path.join(source_masks_dir, mask_name), cv2.IMREAD_GRAYSCALE)
-    #     decoded_mask = cv2.imread(os.path.join(decoded_masks_dir, mask_name), cv2.IMREAD_GRAYSCALE)
-    #     mask[mask>0] = 100
-    #     print("diff", np.sum(mask-decoded_mask))
+    # Encoding and decoding of synthetic masks compared with the previous implementation
+    repeats = 5
+    print(f"{'resolution':>10} {'runs':>7} | {'encode ms':>9} {'previous':>9} | {'decode ms':>9} {'previous':>9} | {'blob enc':>8} {'blob dec':>8}")
+    for name, (height, width) in {"1080p": (1080, 1920), "4K": (2160, 3840), "8K": (4320, 7680)}.items():
+        mask = get_synthetic_mask(height, width)
+        encoded = encode_rle(mask)
+        assert encoded == reference_encode_rle(mask)
+        assert np.array_equal(decode_rle(encoded, width=width, height=height), mask)
+        blob = encode_rle_blob(mask)
+        assert np.array_equal(decode_rle_blob(blob, width=width, height=height), mask)
+
+        print(
+            f"{name:>10} {len(mask_to_runs(mask)[0]):>7} | "
+            f"{benchmark(lambda: encode_rle(mask), repeats):>9.2f} "
+            f"{benchmark(lambda: reference_encode_rle(mask), repeats):>9.2f} | "
+            f"{benchmark(lambda: decode_rle(encoded, width=width, height=height), repeats):>9.2f} "
+            f"{benchmark(lambda: reference_decode_rle(encoded, width=width, height=height), repeats):>9.2f} | "
+            f"{benchmark(lambda: encode_rle_blob(mask), repeats):>8.2f} "
+            f"{benchmark(lambda: decode_rle_blob(blob, width=width, height=height), repeats):>8.2f}"
+        )
+
+    # COCO RLE of binary masks of one class, the previous way is the pure Python codec of pycocotools
+    print(f"{'resolution':>10} {'runs':>7} | {'coco enc':>9} {'coco dec':>9} | {'string':>9} {'previous':>9}")
+    for name, (height, width) in {"1080p": (1080, 1920), "4K": (2160, 3840), "8K": (4320, 7680)}.items():
+        mask = (get_synthetic_mask(height, width) == 1).astype(np.uint8)
+        coco_rle = encode_coco_rle(mask)
+        counts = mask_to_coco_counts(mask)
+        assert coco_rle["counts"] == reference_coco_counts_to_string(counts)
+        assert np.array_equal(coco_string_to_counts(coco_rle["counts"]), counts)
+        assert np.array_equal(decode_coco_rle(coco_rle), mask)
+        assert decode_rle_blob(coco_rle_to_blob(coco_rle), width=width, height=height).tobytes() == mask.tobytes()
+
+        print(
+            f"{name:>10} {len(counts):>7} | "
+            f"{benchmark(lambda: encode_coco_rle(mask), repeats):>9.2f} "
+            f"{benchmark(lambda: decode_coco_rle(coco_rle), repeats):>9.2f} | "
+            f"{benchmark(lambda: coco_counts_to_string(counts), repeats):>9.2f} "
+            f"{benchmark(lambda: reference_coco_counts_to_string(counts), repeats):>9.2f}"
+        )
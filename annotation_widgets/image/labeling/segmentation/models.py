@@ -1,23 +1,25 @@
 from annotation_widgets.image.labeling.models import Figure, Point
-from annotation_widgets.image.labeling.segmentation.masks_encoding import decode_rle, encode_rle
+from annotation_widgets.image.labeling.segmentation.masks_encoding import blob_to_annotation, blob_to_rle, decode_rle_blob, encode_rle_blob, pack_runs, rle_to_blob, splice_runs, unpack_runs
+from annotation_widgets.image.labeling.segmentation.packed_mask import PackedMask, Region
 from annotation_widgets.image.models import Label
 from db import Base, get_session
 
 import json
 import cv2
 import numpy as np
-from sqlalchemy import Boolean, asc, create_engine, Column, Float, String, Integer, ForeignKey, inspect
+from sqlalchemy import Boolean, asc, create_engine, Column, Float, LargeBinary, String, Integer, ForeignKey, inspect
 from sqlalchemy.orm import relationship, scoped_session, sessionmaker, declarative_base, reconstructor
 from typing import Any, List, Optional, Tuple, Dict
 from config import settings
+from enums import MaskFormat
 
 
 class Mask(Base):
     __tablename__ = 'mask'
 
     id = Column(Integer, primary_key=True)
-    item_id = Column(Integer, ForeignKey('image.id'))
-    rle = Column(Integer)
+    item_id = Column(Integer, ForeignKey('image.id'), index=True)
+    rle_blob = Column(LargeBinary) # Binary RLE, see masks_encoding.pack_runs
     label = Column(String)
     height = Column(Integer)
     width = Column(Integer)
@@ -25,17 +27,28 @@ class Mask(Base):
 
     image = relationship("LabeledImage", back_populates="masks")
 
-    def __init__(self, label: str, rle: str, height: int, width: int):
-        self.rle = rle
+    def __init__(self, label: str, rle: str = None, height: int = None, width: int = None, rle_blob: bytes = None):
+        """
+        Args:
+            rle (str): RLE string in figures.json format. Ignored if rle_blob is specified
+            rle_blob (bytes): Binary RLE in the database format
+        """
+        if rle_blob is not None:
+            self.rle_blob = rle_blob
+        else:
+            self.rle = rle
         self.label = label
         self.height = height
         self.width = width
         self.selected: bool = False
-        self.decode_rle()
+        self.decoded_mask: Optional[PackedMask] = None
+        self.dirty_rows: Optional[Tuple[int, int]] = None  # Rows of the mask changed after the last encoding
 
     @reconstructor
     def init_on_load(self):
-        self.decode_rle()
+        # The mask is decoded only when it is drawn or edited, loading of images and export use only RLE
+        self.decoded_mask: Optional[PackedMask] = None
+        self.dirty_rows: Optional[Tuple[int, int]] = None
         self.selected = False
 
     @property
@@ -46,17 +59,88 @@ class Mask(Base):
     def surface(self) -> int:
         return 1
 
-    def decode_rle(self):
-        self.mask = decode_rle(self.rle, height=self.height, width=self.width)
+    @property
+    def rle(self) -> str:
+        """RLE string in figures.json format"""
+        self.ensure_encoded()
+        return blob_to_rle(self.rle_blob)
+
+    @rle.setter
+    def rle(self, value: str):
+        self.rle_blob = rle_to_blob(value)
+
+    def serialize_annotation(self, mask_format: MaskFormat):
+        """Mask in figures.json format of the project"""
+        self.ensure_encoded()
+        return blob_to_annotation(self.rle_blob, height=self.height, width=self.width, mask_format=mask_format)
+
+    @property
+    def packed_mask(self) -> PackedMask:
+        """Decoded mask with 8 pixels per byte, it is decoded on the first access"""
+        if self.decoded_mask is None:
+            self.decoded_mask = PackedMask.from_mask(decode_rle_blob(self.rle_blob, height=self.height, width=self.width))
+        return self.decoded_mask
+
+    @property
+    def mask(self) -> np.ndarray:
+        """Unpacked copy of the mask, changes of it do not change the figure"""
+        return self.packed_mask.to_mask()
+
+    @mask.setter
+    def mask(self, value: np.ndarray):
+        self.decoded_mask = PackedMask.from_mask(value)
+        self.mark_dirty(0, self.height)
+
+    def set_rle_blob(self, rle_blob: bytes, height: int, width: int):
+        """Replaces the whole mask with encoded one, the decoded mask is dropped"""
+        self.rle_blob = rle_blob
+        self.height = height
+        self.width = width
+        self.decoded_mask = None
+        self.dirty_rows = None
+
+    def release(self):
+        """Keeps only RLE of the mask, for example when another image is shown"""
+        self.ensure_encoded()
+        self.decoded_mask = None
 
     def encode_mask(self):
-        self.rle = encode_rle(self.mask)
+        self.rle_blob = encode_rle_blob(self.mask)
+        self.dirty_rows = None
+
+    def mark_dirty(self, y_min: int, y_max: int):
+        if self.dirty_rows is not None:
+            y_min, y_max = min(y_min, self.dirty_rows[0]), max(y_max, self.dirty_rows[1])
+        self.dirty_rows = (y_min, y_max)
+
+    def fill_polygon(self, polygon: np.ndarray, value: int) -> Optional[Region]:
+        """Draws the polygon on the mask. RLE is updated by `ensure_encoded` only for the changed rows.
+        Returns the changed region of the packed mask"""
+        region = self.packed_mask.fill_polygon(polygon, value)
+        if region is not None:
+            self.mark_dirty(region[0], region[1])
+        return region
+
+    def set_packed_bytes(self, region: Region, bits: np.ndarray):
+        """Restores bytes of the packed mask, for example by undo"""
+        self.packed_mask.set_bytes(region, bits)
+        self.mark_dirty(region[0], region[1])
+
+    def ensure_encoded(self):
+        """Updates RLE with rows changed after the last encoding. Runs of other rows are kept as they are"""
+        if self.dirty_rows is None:
+            return
+        y_min, y_max = self.dirty_rows
+        values, counts = unpack_runs(self.rle_blob)
+        self.rle_blob = pack_runs(*splice_runs(values, counts, start=y_min * self.width, flat_span=self.packed_mask.get_rows(y_min, y_max).ravel()))
+        self.dirty_rows = None
 
     @property
     def state(self):
         return inspect(self)
 
     def save(self):
+        self.ensure_encoded()
         session = get_session()
         session.add(self)
         session.commit()
@@ -72,9 +156,10 @@ class Mask(Base):
         session.commit()
 
     def copy(self) -> "Mask":
+        self.ensure_encoded()
         return Mask(
             label=self.label,
-            rle=self.rle,
+            rle_blob=self.rle_blob,
             height=self.height,
             width=self.width
         )
@@ -108,17 +193,8 @@ class Mask(Base):
 
         b2, g2, r2 = label.color_bgr
 
-        if opacity > 0:
-            canvas_with_mask = np.copy(canvas)
-        else:
-            canvas_with_mask = canvas
-
-        canvas_with_mask[:, :, :3][self.mask > 0] = [b2, g2, r2]
-
-        if opacity > 0:
-            canvas = cv2.addWeighted(canvas_with_mask, opacity, canvas, max(1 - opacity, 0), 0)
-            
-        return canvas
+        return self.packed_mask.paint(canvas, color=(b2, g2, r2), opacity=opacity)
 
     def serialize(self) -> Dict:
-        return {"label": self.label, "rle": self.rle, "height": self.height, "width": self.width}
\ No newline at end of file
+        self.ensure_encoded()
+        return {"label": self.label, "rle_blob": self.rle_blob, "height": self.height, "width": self.width}
\ No newline at end of file
@@ -0,0 +1,94 @@
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+Region = Tuple[int, int, int, int]  # First row, end row, first byte column, end byte column
+
+
+class PackedMask:
+    """
+    Binary mask of one class stored with 8 pixels per byte (np.packbits along rows), 8 times smaller than uint8 mask.
+    Drawing and reading work with the rows and byte columns around the changed region, the full mask is not unpacked
+    """
+
+    def __init__(self, bits: np.ndarray, height: int, width: int):
+        self.bits = bits  # (height, ceil(width / 8)) uint8
+        self.height = height
+        self.width = width
+
+    @classmethod
+    def from_mask(cls, mask: np.ndarray) -> "PackedMask":
+        height, width = mask.shape
+        return cls(np.packbits(mask > 0, axis=1), height=height, width=width)
+
+    @classmethod
+    def empty(cls, height: int, width: int) -> "PackedMask":
+        return cls(np.zeros((height, (width + 7) // 8), dtype=np.uint8), height=height, width=width)
+
+    def to_mask(self) -> np.ndarray:
+        return self.get_rows(0, self.height)
+
+    def get_rows(self, y_min: int, y_max: int) -> np.ndarray:
+        """Unpacked rows as uint8 mask with values 0 and 1"""
+        return np.unpackbits(self.bits[y_min:y_max], axis=1, count=self.width)
+
+    def get_region(self, y_min: int, y_max: int, x_min_byte: int, x_max_byte: int) -> np.ndarray:
+        region = np.unpackbits(self.bits[y_min:y_max, x_min_byte:x_max_byte], axis=1)
+        return region[:, :max(min(self.width - x_min_byte * 8, region.shape[1]), 0)]
+
+    def get_occupied_rows(self) -> Optional[Tuple[int, int]]:
+        """Range of rows with pixels of the class, None for empty mask"""
+        rows = np.flatnonzero(self.bits.any(axis=1))
+        if len(rows) == 0:
+            return None
+        return int(rows[0]), int(rows[-1]) + 1
+
+    def get_polygon_region(self, polygon: np.ndarray) -> Optional[Region]:
+        """Rows and byte columns under the bounding box of the polygon, None if the polygon is outside of the mask"""
+        points = polygon.reshape((-1, 2))
+        y_min, y_max = max(int(points[:, 1].min()), 0), min(int(points[:, 1].max()) + 1, self.height)
+        x_min, x_max = max(int(points[:, 0].min()), 0), min(int(points[:, 0].max()) + 1, self.width)
+        if y_min >= y_max or x_min >= x_max:
+            return None
+        return y_min, y_max, x_min // 8, (x_max + 7) // 8
+
+    def get_bytes(self, region: Region) -> np.ndarray:
+        y_min, y_max, x_min_byte, x_max_byte = region
+        return self.bits[y_min:y_max, x_min_byte:x_max_byte].copy()
+
+    def set_bytes(self, region: Region, bits: np.ndarray):
+        y_min, y_max, x_min_byte, x_max_byte = region
+        self.bits[y_min:y_max, x_min_byte:x_max_byte] = bits
+
+    def fill_polygon(self, polygon: np.ndarray, value: int) -> Optional[Region]:
+        """Fills the polygon with 1 or 0, only the bytes under the bounding box of the polygon are unpacked. Returns the changed region"""
+        region = self.get_polygon_region(polygon)
+        if region is None:
+            return None
+        y_min, y_max, x_min_byte, x_max_byte = region
+        pixels = np.ascontiguousarray(self.get_region(y_min, y_max, x_min_byte, x_max_byte))
+        cv2.fillPoly(pixels, [polygon.reshape((-1, 1, 2)).astype(np.int32)], color=1 if value else 0, offset=(-x_min_byte * 8, -y_min))
+        self.set_bytes(region, np.packbits(pixels, axis=1))
+        return region
+
+    def paint(self, canvas: np.ndarray, color: Tuple[int, int, int], opacity: float) -> np.ndarray:
+        """Returns a copy of the canvas with the mask drawn over it. Only rows with the mask are blended"""
+        canvas = np.copy(canvas)
+        occupied_rows = self.get_occupied_rows()
+        if occupied_rows is None:
+            return canvas
+        y_min, y_max = occupied_rows
+        rows = np.ascontiguousarray(canvas[y_min:y_max, :, :3])  # The alpha channel of BGRA canvases is not changed
+        # Rows are blended with the color at once and copied to the canvas under the mask, indexing by the mask is much slower
+        colored_row = np.tile(np.array(color, dtype=canvas.dtype), (self.width, 1))
+        colored_rows = np.ascontiguousarray(np.broadcast_to(colored_row, rows.shape))
+        blended_rows = cv2.addWeighted(colored_rows, opacity, rows, max(1 - opacity, 0), 0)
+        cv2.copyTo(blended_rows, self.get_rows(y_min, y_max), rows)
+        canvas[y_min:y_max, :, :3] = rows
+        return canvas
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
@@ -1,20 +1,74 @@
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 import os
 import shutil
+import traceback
 from tkinter import messagebox
 import tkinter as tk
+from typing import Callable
 
 from api_requests import complete_task
-from db import configure_database
+from db import close_database, configure_database, release_session
 from enums import AnnotationStage
+from exceptions import MessageBoxException
 from file_processing.file_transfer import upload_file
+from file_processing.progress_bar import ProcessingProgressBar
 from gui_utils import get_loading_window
 from models import ProjectData, Value
 from path_manager import BasePathManager
 from utils import open_json, save_json
 
 
+class ProjectOverwriter(ProcessingProgressBar):
+    def overwrite(self, io: "AbstractAnnotationIO"):
+        self.processed_percent = 0
+        self.processed_gb = 0
+        self.speed = 0
+        self.remaining_time = 0
+        self.processing_complete = False
+
+        def update_progress(percent, size_gb, speed, remaining_time, processing_complete):
+            self.processed_percent = percent
+            self.processed_gb = size_gb
+            self.speed = speed
+            self.remaining_time = remaining_time
+
+        def overwrite_project():
+            try:
+                io.overwrite_project(update_callback=update_progress)
+            finally:
+                release_session()  # The worker thread has its own database session
+
+        executor = ThreadPoolExecutor()
+        future = executor.submit(overwrite_project)
+        self.check_overwrite_completion(future)
+
+        self.root.wait_window(self.root)
+        executor.shutdown(wait=False)
+        try:
+            future.result()  # Waits for the worker and raises its exceptions
+        except Exception as e:
+            raise MessageBoxException(f"Unable to overwrite project {io.project_data.id}. Error: {traceback.format_exc()}")
+
+    def on_window_close(self):
+        """The window can not be closed while the project is overwritten, the database would be left half imported"""
+
+    def check_overwrite_completion(self, future):
+        if future.done():
+            if future.exception() is not None:
+                self.root.destroy()  # The error is shown by `overwrite` after the window is closed
+                return
+            # The progress bar closes the window itself once it sees the completion flag
+            self.processed_percent = 100
+            self.remaining_time = 0
+            self.processing_complete = True
+        else:
+            self.root.after(100, lambda: self.check_overwrite_completion(future))
+
+
 class AbstractAnnotationIO(ABC):
+
+    supports_delta_sync = False  # If True, `upload_delta` is called periodically while the project is opened
     
     def __init__(self, project_data: ProjectData):
         self.project_data: ProjectData = project_data
@@ -48,10 +102,9 @@ class AbstractAnnotationIO(ABC):
         configure_database(self.pm.db_path)
         if self.should_be_overwritten:
             self.download_project(root=root)
-            loading_window = get_loading_window(text="Overwritting project...", root=root)
-            self.overwrite_project()
+            po = ProjectOverwriter(window_title="Overwritting project...", root=root)
+            po.overwrite(self)  # Returns only after the overwrite is completed, raises if it failed
             self.reset_counters()
-            loading_window.destroy()
         self.save_project_data()
         assert not self.should_be_overwritten, f"Current stage is {self.stage}, new stage is {self.project_data.stage}"
      
@@ -69,18 +122,24 @@ class AbstractAnnotationIO(ABC):
         Shows loading window while downloading"""
         raise NotImplementedError()
 
-    def overwrite_project(self):
-        """Overwrites data in database with data from project json files"""
+    def overwrite_project(self, update_callback: Callable = None):
+        """Overwrites data in database with data from project json files.
+        update_callback receives progress in the ProcessingProgressBar format"""
         raise NotImplementedError()
     
     def download_and_overwrite_annotations(self):
         """Force download and overwrite annotations in the database"""
         raise NotImplementedError()
 
-    def _upload_annotation_results(self):
+    def _upload_annotation_results(self, root: tk.Tk):
         """Uploads annotation results to the server"""
         raise NotImplementedError()
 
+    def upload_delta(self) -> int:
+        """Uploads annotations changed since the last upload. Returns the number of uploaded items.
+        Called from a background thread, should not show windows"""
+        raise NotImplementedError()
+
     def _remove_after_completion(self):
         """Override this method to change how project files 
         should be removed after project completion"""
@@ -90,7 +149,7 @@ class AbstractAnnotationIO(ABC):
         loading_window = get_loading_window(text="Finishing project...", root=root)
         if os.path.isfile(self.pm.statistics_path):
             upload_file(self.project_data.uid, self.pm.statistics_path)
-        self._upload_annotation_results()
+        self._upload_annotation_results(root=root)
         complete_task(project_uid=self.project_data.uid, duration_hours=duration_hours)
         self.reset_counters()
         self.change_stage_at_completion()
@@ -99,5 +158,6 @@ class AbstractAnnotationIO(ABC):
         loading_window.destroy()
 
     def remove_project(self):
+        close_database(self.pm.db_path)
         if os.path.isdir(self.pm.project_path):
             shutil.rmtree(self.pm.project_path)
\ No newline at end of file
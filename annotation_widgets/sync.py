@@ -0,0 +1,44 @@
+import threading
+import traceback
+from typing import TYPE_CHECKING
+
+from db import release_session
+
+if TYPE_CHECKING:
+    from annotation_widgets.io import AbstractAnnotationIO
+
+
+class DeltaSynchronizer:
+    """
+    Uploads annotations changed since the last upload in a background thread every `interval_sec` seconds.
+    The thread works with its own database session. Failed uploads are repeated with the next run,
+    because the time of the last upload is updated only after the server accepted the patch.
+    """
+
+    def __init__(self, io: "AbstractAnnotationIO", interval_sec: float):
+        self.io = io
+        self.interval_sec = interval_sec
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def sync(self) -> int:
+        """Returns the number of uploaded items"""
+        return self.io.upload_delta()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval_sec):
+            try:
+                self.sync()
+            except Exception:
+                print(f"Unable to upload changes of project {self.io.project_data.id}: {traceback.format_exc()}")
+            finally:
+                release_session()
+
+    def stop(self):
+        """Stops the timer, the upload in progress is finished first"""
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
@@ -6,6 +6,7 @@ from tkinter import messagebox
 from annotation_widgets.io import AbstractAnnotationIO
 from annotation_widgets.logic import AbstractAnnotationLogic
 from annotation_widgets.models import CheckResult
+from annotation_widgets.sync import DeltaSynchronizer
 from models import ProjectData
 from gui_utils import get_loading_window
 from models import ProjectData
@@ -22,6 +23,11 @@ class AbstractAnnotationWidget(tk.Frame):
 
         self.close_callback: Callable = None
 
+        self.delta_sync: DeltaSynchronizer = None
+        if self.io.supports_delta_sync and settings.delta_sync_interval_min > 0:
+            self.delta_sync = DeltaSynchronizer(io=self.io, interval_sec=settings.delta_sync_interval_min * 60)
+            self.delta_sync.start()
+
     @property
     def items_number(self):
         return self.logic.items_number
@@ -32,6 +38,8 @@ class AbstractAnnotationWidget(tk.Frame):
 
     def close(self):
         self.logic.save_item()
+        if self.delta_sync is not None:
+            self.delta_sync.stop()
         self.destroy()
 
         if self.close_callback:
@@ -80,4 +88,6 @@ class AbstractAnnotationWidget(tk.Frame):
 
     def complete_annotation(self, root: tk.Tk):
         self.logic.stop_tracking()
+        if self.delta_sync is not None:
+            self.delta_sync.stop()  # Remaining changes are not sent as a patch, the whole results supersede it
         self.io.complete_annotation(duration_hours=self.logic.duration_hours, root=root)
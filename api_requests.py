@@ -2,10 +2,10 @@ from json import JSONDecodeError
 from typing import List, Tuple
 from urllib.error import HTTPError
 
-import requests
 from config import settings
 from enums import AnnotationMode, AnnotationStage
 from exceptions import MessageBoxException
+from http_client import NON_IDEMPOTENT_TIMEOUT, client
 from models import ProjectData
 from path_manager import get_local_projects_data
 
@@ -15,19 +15,18 @@ def get_projects_data(only_assigned_to_user: bool = True) -> List[ProjectData]:
 
     data = {'user_token': settings.token}
 
-    for i in range(2):
-        response = requests.post(url, json=data)
+    response = client.post(url, json=data)  # Retried with backoff by the client
 
-        if response.status_code == 200:
-        
-            projects = response.json()["projects"]
-
-            result = list()
-            for project in projects:
-                if only_assigned_to_user and not project.get("assigned_to_user", True):
-                    continue
-                result.append(ProjectData.from_json(project))
-            return result
+    if response.status_code == 200:
+    
+        projects = response.json()["projects"]
+
+        result = list()
+        for project in projects:
+            if only_assigned_to_user and not project.get("assigned_to_user", True):
+                continue
+            result.append(ProjectData.from_json(project))
+        return result
     
     raise MessageBoxException(f"Unable to get projects data. {response.status_code}")
 
@@ -37,7 +36,7 @@ def get_project_data(project_uid: str) -> Tuple[AnnotationStage, AnnotationMode]
     url = f'{settings.api_url}/api/annotation/get_project_data/{project_uid}/'
 
     data = {'user_token': settings.token}
-    response = requests.post(url, json=data)
+    response = client.post(url, json=data)
 
     if response.status_code != 200:
         raise MessageBoxException(response)
@@ -54,7 +53,7 @@ def complete_task(project_uid: int, duration_hours: float):
     url = f'{settings.api_url}/api/annotation/complete_task/{project_uid}/' # Change stage of annotation project
 
     data = {'user_token': settings.token, 'duration_hours': duration_hours}
-    response = requests.post(url, json=data)
+    response = client.post(url, json=data, idempotent=False, timeout=NON_IDEMPOTENT_TIMEOUT)
 
     if response.status_code != 200:
         try: 
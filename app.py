@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 from exceptions import MessageBoxException
 from main import MainWindow
@@ -26,5 +27,8 @@ class Application:
         self.initialize_gui()
 
 
-app = Application()
-app.run()
\ No newline at end of file
+if __name__ == "__main__":
+    # Archives are extracted by worker processes, they import this module without running the application
+    multiprocessing.freeze_support()
+    app = Application()
+    app.run()
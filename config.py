@@ -20,6 +20,28 @@ DEFAULT_SETTINGS = {
         "color_fill_opacity": {"type": "number", "value": 0.1, "min": 0, "max": 1, "step": 0.1},
         "bbox_handler_size": {"type": "number", "value": 3, "min": 1, "max": 10, "step": 1},
         "keypoint_handler_size": {"type": "number", "value": 5, "min": 1, "max": 10, "step": 1},
+    },
+    "database": {
+        # Keep the project database in memory and save it to the disk periodically.
+        # Faster, but the work done after the last snapshot is lost if the tool crashes
+        "in_memory_database": {"type": "boolean", "value": False},
+        "snapshot_interval_sec": {"type": "number", "value": 30, "min": 5, "max": 600, "step": 5},
+    },
+    "sync": {
+        # Annotations changed since the last upload are sent to the server in the background, 0 disables it.
+        # Enable it only if the server accepts `figures.patch.json` and `review.patch.json` uploads
+        "delta_sync_interval_min": {"type": "number", "value": 0, "min": 0, "max": 60, "step": 1},
+        # Images of downloaded projects are kept in a local store, so another stage of the same project
+        # does not download them again. Images of existing projects share disk space with the projects and are not counted,
+        # images which are not used by any project are removed when they take more than the quota. 0 disables the store
+        "image_store_quota_gb": {"type": "number", "value": 20, "min": 0, "max": 1000, "step": 5},
+    },
+    "segmentation": {
+        # Undo history of mask edits keeps only changed regions of masks, the oldest edits are forgotten above the size
+        "mask_history_size_mb": {"type": "number", "value": 64, "min": 1, "max": 1024, "step": 16},
+        # Masks of all classes of the image are edited and drawn as one map of class ids.
+        # A pixel can belong to one class only, overlapping masks are cut when the image is edited
+        "label_map_segmentation": {"type": "boolean", "value": False},
     }
 }
 
@@ -1,11 +1,17 @@
 from abc import ABCMeta
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker, declarative_base
-from typing import Optional
+from contextlib import contextmanager
+import sqlite3
+import threading
+import traceback
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session, scoped_session, sessionmaker, declarative_base
+from sqlalchemy.pool import StaticPool
+from typing import Callable, Dict, Optional
 
-from sqlalchemy.sql import text  # For executing raw SQL statements
 from sqlalchemy.ext.declarative import DeclarativeMeta
 from config import settings
+from migrations import migrate
 
 # Define a new metaclass that combines ABCMeta and DeclarativeMeta
 class ABSQLAlchemyMeta(ABCMeta, DeclarativeMeta):
@@ -14,47 +20,274 @@ class ABSQLAlchemyMeta(ABCMeta, DeclarativeMeta):
 Base = declarative_base(metaclass=ABSQLAlchemyMeta)
 
 
-session_configured = False
-
 class SessionNotConfiguredException(Exception):
     """Custom exception to indicate the session is not configured."""
     pass
 
 
-def get_session():
-    """Session factory to ensure the session is configured before use."""
-    if not session_configured:
-        raise SessionNotConfiguredException("Session is not configured. Please run configure_database() before performing database operations.")
-    return session
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Pragmas are set for every new connection of the pool, because `synchronous` is a per-connection setting"""
+    cursor = dbapi_connection.cursor()
 
+    # In SQLite's NORMAL mode, the engine ensures the rollback journal is securely written to disk for recovery purposes,
+    # but does not wait for the main database file updates to be confirmed,
+    # relying on the operating system to manage these writes.
+    # This setting provides a reasonable balance between performance and durability
+    cursor.execute("PRAGMA synchronous = NORMAL")
 
-def configure_database(database_path):
-    global session
-    global session_configured
+    # Write-Ahead Logging (WAL) journal mode in SQLite
+    # instead of writing changes directly to the main database file, SQLite writes these changes to a separate WAL file in a sequential manner.
+    # When a transaction is committed, SQLite doesn’t immediately apply the changes in the WAL file to the main database file.
+    # Instead, the changes remain in the WAL file, and the database file is updated in the background
+    # or when the WAL file reaches a certain size
+    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.close()
+
+
+class SerializedCursor:
+    """Cursor of SerializedConnection, statements and fetching of rows are executed under the lock of the connection"""
+
+    def __init__(self, connection: "SerializedConnection"):
+        self.connection = connection
+        self.cursor = connection.connection.cursor()
+
+    def execute(self, *args):
+        with self.connection.statement():
+            self.cursor.execute(*args)
+        return self
+
+    def executemany(self, *args):
+        with self.connection.statement():
+            self.cursor.executemany(*args)
+        return self
+
+    def fetchone(self):
+        with self.connection.lock:
+            return self.cursor.fetchone()
+
+    def fetchmany(self, *args):
+        with self.connection.lock:
+            return self.cursor.fetchmany(*args)
+
+    def fetchall(self):
+        with self.connection.lock:
+            return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SerializedConnection:
+    """
+    One SQLite connection used by all threads. Transactions of threads are not mixed: the thread which starts
+    a transaction by a write statement holds the lock until it commits or rolls back, other threads wait.
+    Commit and rollback of a thread without its own transaction do nothing, so they do not affect the transaction of another thread
+    """
+
+    def __init__(self, connection: sqlite3.Connection, on_commit: Callable = None):
+        self.connection = connection
+        self.on_commit = on_commit
+        self.lock = threading.RLock()
+        self.transaction_thread: Optional[int] = None
+
+    @contextmanager
+    def statement(self):
+        self.lock.acquire()
+        try:
+            yield
+        finally:
+            if self.transaction_thread is None and self.connection.in_transaction:
+                self.transaction_thread = threading.get_ident()  # The lock is kept until the end of the transaction
+            else:
+                self.lock.release()
+
+    def cursor(self) -> SerializedCursor:
+        return SerializedCursor(self)
+
+    def end_transaction(self, commit: bool):
+        if self.transaction_thread != threading.get_ident():
+            return
+        try:
+            if commit:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            if not self.connection.in_transaction:
+                self.transaction_thread = None
+                self.lock.release()
+        if commit and self.on_commit is not None:
+            self.on_commit()
+
+    def commit(self):
+        self.end_transaction(commit=True)
+
+    def rollback(self):
+        self.end_transaction(commit=False)
+
+    def close(self):
+        """The connection is closed by its owner, not by the pool"""
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class InMemoryDatabase:
+    """
+    Working copy of the project database in a private in-memory SQLite database.
 
-    database_path += "?check_same_thread=False" # To allow shared connection usage
+    The copy is loaded from the database file at open. All threads use it through one SerializedConnection,
+    because shared-cache in-memory databases fail with "database table is locked" instead of waiting for other connections.
+    A background thread saves it back to the file with the SQLite online backup API every `snapshot_interval_sec` seconds
+    if something was committed, and once more on close. Snapshots are taken between transactions, so they never contain
+    a part of a transaction. Changes made after the last snapshot are lost if the process crashes.
+    """
 
-    engine = create_engine(database_path)
+    def __init__(self, file_path: str, snapshot_interval_sec: float):
+        self.file_path = file_path
+        self.snapshot_interval_sec = snapshot_interval_sec
 
-    with engine.connect() as connection:
+        memory_connection = sqlite3.connect(":memory:", check_same_thread=False)
+        source = sqlite3.connect(self.file_path)
+        source.backup(memory_connection)
+        source.close()
+        self.connection = SerializedConnection(memory_connection, on_commit=self.mark_changed)
 
-        # In SQLite's NORMAL mode, the engine ensures the rollback journal is securely written to disk for recovery purposes, 
-        # but does not wait for the main database file updates to be confirmed, 
-        # relying on the operating system to manage these writes.
-        # This setting provides a reasonable balance between performance and durability
-        connection.execute(text("PRAGMA synchronous = NORMAL")) 
+        self.changed = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
-        # Write-Ahead Logging (WAL) journal mode in SQLite
-        # instead of writing changes directly to the main database file, SQLite writes these changes to a separate WAL file in a sequential manner.
-        # When a transaction is committed, SQLite doesn’t immediately apply the changes in the WAL file to the main database file. 
-        # Instead, the changes remain in the WAL file, and the database file is updated in the background 
-        # or when the WAL file reaches a certain size
-        connection.execute(text("PRAGMA journal_mode = WAL"))
+    def connect(self) -> SerializedConnection:
+        return self.connection
 
+    def mark_changed(self, *args):
+        self.changed = True
 
-    Base.metadata.create_all(engine)  # Make sure all tables are created
-    Session = scoped_session(sessionmaker(bind=engine))
-    session = Session()
-    session_configured = True
+    def snapshot(self):
+        with self.connection.lock:
+            self.changed = False
+            destination = sqlite3.connect(self.file_path)
+            try:
+                self.connection.connection.backup(destination)
+            finally:
+                destination.close()
+
+    def run(self):
+        while not self.stop_event.wait(self.snapshot_interval_sec):
+            if self.changed:
+                try:
+                    self.snapshot()
+                except Exception:
+                    self.changed = True  # Try again with the next snapshot
+                    print(f"Unable to save database snapshot to {self.file_path}: {traceback.format_exc()}")
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.snapshot()
+        self.connection.connection.close()
+
+
+class SessionRegistry:
+    """
+    Owns engines of project databases, keyed by database path.
+    With `in_memory_database` setting the engine works with the in-memory copy of the database.
+
+    Only one project is active at a time. Its sessions are thread-local: the GUI thread and every
+    background worker (overwriting, exporting, prefetching) get their own session from `get_session`.
+    Workers should call `release_session` when they finish to return the connection to the pool.
+    """
+
+    def __init__(self):
+        self.engines: Dict[str, Engine] = dict()
+        self.sessions: Dict[str, scoped_session] = dict()
+        self.memory_databases: Dict[str, InMemoryDatabase] = dict()
+        self.active_path: Optional[str] = None
+        self.lock = threading.Lock()
+
+    def create_engine(self, database_path: str) -> Engine:
+        engine = create_engine(
+            database_path,
+            connect_args={"check_same_thread": False},  # Pooled connections are shared between threads
+        )
+        event.listen(engine, "connect", set_sqlite_pragmas)
+
+        Base.metadata.create_all(engine)  # Make sure all tables are created
+        migrate(engine)  # create_all does not change existing tables, migrations bring them to the current schema
+
+        if settings.in_memory_database:
+            engine.dispose()
+            memory_database = InMemoryDatabase(
+                file_path=make_url(database_path).database,
+                snapshot_interval_sec=float(settings.snapshot_interval_sec)
+            )
+            self.memory_databases[database_path] = memory_database
+            engine = create_engine(
+                "sqlite://",
+                creator=memory_database.connect,
+                poolclass=StaticPool,  # Sessions of all threads use the serialized connection
+            )
+            event.listen(engine, "connect", set_sqlite_pragmas)
+        return engine
+
+    def activate(self, database_path: str):
+        """Makes database of the project active. Engines of other projects are disposed.
+        Opening the same project again starts with new sessions"""
+        with self.lock:
+            for path in list(self.engines):
+                self._dispose(path)
+            self.engines[database_path] = self.create_engine(database_path)
+            self.sessions[database_path] = scoped_session(sessionmaker(bind=self.engines[database_path]))
+            self.active_path = database_path
+
+    def get_session(self) -> Session:
+        """Returns session of the current thread for the active project"""
+        if self.active_path is None:
+            raise SessionNotConfiguredException("Session is not configured. Please run configure_database() before performing database operations.")
+        return self.sessions[self.active_path]()
+
+    def release_session(self):
+        """Closes session of the current thread. Uncommitted changes are rolled back"""
+        if self.active_path is not None:
+            self.sessions[self.active_path].remove()
+
+    def dispose(self, database_path: str = None):
+        """Closes sessions and connections of the database. Closes the active database if path is not specified"""
+        with self.lock:
+            if database_path is None:
+                database_path = self.active_path
+            if database_path in self.engines:
+                self._dispose(database_path)
+
+    def _dispose(self, database_path: str):
+        self.sessions.pop(database_path).remove()
+        self.engines.pop(database_path).dispose()
+        if database_path in self.memory_databases:
+            self.memory_databases.pop(database_path).close()  # Saves the last snapshot
+        if self.active_path == database_path:
+            self.active_path = None
+
+
+registry = SessionRegistry()
+
+
+def get_session() -> Session:
+    """Session factory to ensure the session is configured before use."""
+    return registry.get_session()
+
+
+def release_session():
+    """Should be called by background threads when they finish working with the database"""
+    registry.release_session()
+
+
+def configure_database(database_path):
+    registry.activate(database_path)
 
 
+def close_database(database_path: str = None):
+    registry.dispose(database_path)
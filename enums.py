@@ -32,3 +32,8 @@ class FigureType(Enum):
 class EventViewMode(Enum):
     VIDEO = "VIDEO"
     IMAGE = "IMAGE"
+
+
+class MaskFormat(Enum):
+    RLE = "RLE"  # "value:count,value:count,..." of the row-major mask
+    COCO_RLE = "COCO_RLE"  # Compressed COCO RLE {"size": [height, width], "counts": "..."}
@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+import json
+import os
+from typing import IO, Any, Callable, Dict, Iterator, List, Tuple
+
+from sqlalchemy import and_, delete, exists, insert, select
+
+from db import get_session
+from models import ExportFragment
+
+
+EXPORT_BATCH_SIZE = 500  # Items serialized in one transaction, below the limit of SQLite variables in a query
+
+
+def update_fragments(model, kind: str, serialize_batch: Callable[[List[int]], Dict[int, Any]]) -> int:
+    """
+    Serializes items of the `model` table saved after their fragments were cached. `model` should have `id` and `modified_at`,
+    `serialize_batch` returns JSON values by ids of items. Returns the number of serialized items
+    """
+    session = get_session()
+    up_to_date = exists().where(
+        ExportFragment.kind == kind,
+        ExportFragment.item_id == model.id,
+        ExportFragment.modified_at.is_not_distinct_from(model.modified_at),
+    )
+    # Stamps are read before serialization, so items saved during the export are serialized again next time
+    dirty_items = session.execute(select(model.id, model.modified_at).where(~up_to_date)).all()
+
+    for start in range(0, len(dirty_items), EXPORT_BATCH_SIZE):
+        batch = dirty_items[start:start + EXPORT_BATCH_SIZE]
+        item_ids = [item_id for item_id, _ in batch]
+        values = serialize_batch(item_ids)
+        session.execute(delete(ExportFragment.__table__).where(ExportFragment.kind == kind, ExportFragment.item_id.in_(item_ids)))
+        session.execute(insert(ExportFragment.__table__), [
+            {"kind": kind, "item_id": item_id, "modified_at": modified_at, "data": json.dumps(values[item_id])}
+            for item_id, modified_at in batch
+        ])
+        session.commit()
+    return len(dirty_items)
+
+
+def iter_fragments(model, kind: str, key_column, skip_data: Tuple[str, ...] = ()) -> Iterator[Tuple[str, str]]:
+    """Yields (key, serialized item) ordered by key. Items serialized as one of `skip_data` are skipped"""
+    session = get_session()
+    statement = (
+        select(key_column, ExportFragment.data)
+        .join(ExportFragment, and_(ExportFragment.kind == kind, ExportFragment.item_id == model.id))
+        .order_by(key_column)
+    )
+    for key, data in session.execute(statement.execution_options(yield_per=EXPORT_BATCH_SIZE)):
+        if data not in skip_data:
+            yield key, data
+
+
+def write_json_fragments(file: IO, items: Iterator[Tuple[str, str]]):
+    """Writes a JSON object of serialized items, one item per line"""
+    file.write("{")
+    separator = "\n"
+    for key, data in items:
+        file.write(f"{separator}{json.dumps(key)}: {data}")
+        separator = ",\n"
+    file.write("\n}")
+
+
+@contextmanager
+def export_file(file_path: str) -> Iterator[IO]:
+    """Opens `.tmp` file for writing, which replaces the file when it is complete"""
+    if os.path.dirname(file_path) != "":
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_path = file_path + ".tmp"
+    with open(temp_path, "w") as file:
+        yield file
+    os.replace(temp_path, file_path)
@@ -1,11 +1,27 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import os
 import time
 import traceback
-from typing import Callable
+from typing import Callable, Dict, Iterable, Iterator, List
+import uuid
+import zlib
 from config import settings
 import requests
 from exceptions import MessageBoxException
+from http_client import NON_IDEMPOTENT_TIMEOUT, client
+from file_processing.integrity import IntegrityError, get_manifest_path, load_manifest, sha256_from_headers
 from file_processing.progress_bar import ProcessingProgressBar
+from file_processing.transfer_monitor import TransferMonitor, iter_adaptive_content
+from file_processing.segmented_download import SegmentedDownload, parse_content_range
+
+
+SEGMENT_SIZE = 64 * 1024**2  # Files larger than one segment are downloaded with concurrent Range requests
+DOWNLOAD_WORKERS = 6
+UPLOAD_CHUNK_SIZE = 256 * 1024
+GZIP_LEVEL = 6  # JSON with RLE and indents compresses several times already at fast levels
+
+gzip_upload_support: Dict[str, bool] = dict()  # By upload url
 
 
 class FileTransferClient(ProcessingProgressBar):
@@ -26,11 +42,43 @@ class FileTransferClient(ProcessingProgressBar):
         self.gui_close_event.clear()
 
         executor = ThreadPoolExecutor()
-        future = executor.submit(download_file, uid, file_name, save_path, update_progress, lambda: self.terminate_processing)
+        future = executor.submit(download_file, uid, file_name, save_path, update_progress, lambda: self.terminate_processing, verify=True)
         self.check_download_completion(future, uid, file_name)
 
         self.root.wait_window(self.root)
 
+    def upload(self, uid, file_path):
+        self.processed_percent = 0
+        self.processed_gb = 0
+        self.speed = 0
+        self.remaining_time = 0
+        self.processing_complete = False
+
+        def update_progress(percent, size_gb, speed, remaining_time, processing_complete):
+            self.processed_percent = percent
+            self.processed_gb = size_gb
+            self.speed = speed
+            self.remaining_time = remaining_time
+            self.processing_complete = processing_complete
+
+        executor = ThreadPoolExecutor()
+        future = executor.submit(upload_file, uid, file_path, update_progress)
+        self.check_upload_completion(future)
+
+        self.root.wait_window(self.root)
+
+        # Results must be on the server before the task is completed, so closing the window does not stop the upload
+        try:
+            future.result()
+        except Exception as e:
+            raise MessageBoxException(f"Unable to upload file {file_path}. Error: {traceback.format_exc()}")
+
+    def check_upload_completion(self, future):
+        if future.done():
+            self.root.destroy()
+        else:
+            self.root.after(100, lambda: self.check_upload_completion(future))
+
     def check_download_completion(self, future, uid, file_name):
         if future.done():
             try:
@@ -42,47 +90,188 @@ class FileTransferClient(ProcessingProgressBar):
         else:
             self.root.after(100, lambda: self.check_download_completion(future, uid, file_name))
 
-def download_file(uid, file_name, save_path, update_callback: Callable = None, should_terminate: Callable = None, ignore_404=False):
-    with requests.post(f"{settings.file_url}/download/{uid}/{file_name}", headers={'Authorization': f'Bearer {settings.token}'}, stream=True) as r:
+def download_file(uid, file_name, save_path, update_callback: Callable = None, should_terminate: Callable = None, ignore_404=False, verify=False):
+    """
+    Downloads file to `<save_path>.part` and renames it to save_path when the download is complete.
+    Files larger than one segment are downloaded with concurrent Range requests if the server supports them,
+    such downloads continue from the saved progress after interruption.
+
+    With `verify` the `<file_name>.manifest.json` is downloaded next to the file if the server has it.
+    The file is checked against checksums from the manifest or from the response headers,
+    IntegrityError is raised if the file is still corrupted after downloading damaged segments again.
+    """
+    url = f"{settings.file_url}/download/{uid}/{file_name}"
+    headers = {'Authorization': f'Bearer {settings.token}'}
+    part_path = save_path + ".part"
+
+    manifest = None
+    if verify:
+        download_file(uid, f"{file_name}.manifest.json", get_manifest_path(save_path), ignore_404=True)
+        manifest = load_manifest(save_path)
+    manifest = manifest if manifest is not None else dict()
+    segment_size = manifest.get("segment_size", SEGMENT_SIZE)
+
+    # Servers supporting ranges answer 206 with the total size of the file in Content-Range
+    with client.post(url, headers={**headers, "Range": f"bytes=0-{segment_size - 1}"}, stream=True) as r:
         
-        if r.status_code != 200:
+        if r.status_code not in (200, 206):
             if ignore_404 and r.status_code == 404:
                 return
             else:
                 raise MessageBoxException(f"Unable to download file {uid}:{file_name}. Error: {r.json()}")
-        total_size_in_bytes = int(r.headers.get('content-length', 0))
-        downloaded_size = 0
-        start_time = time.time()
 
+        total_size_in_bytes = parse_content_range(r.headers.get('content-range')) if r.status_code == 206 else None
+        sha256 = manifest.get("sha256") or (sha256_from_headers(r.headers) if verify else None)
+
+        if total_size_in_bytes is not None and "size" in manifest and manifest["size"] != total_size_in_bytes:
+            raise IntegrityError(f"Size of {uid}:{file_name} is {total_size_in_bytes} bytes, manifest expects {manifest['size']}")
+
+        if r.status_code == 206 and total_size_in_bytes is None:
+            # Total size is unknown (`Content-Range: bytes 0-1023/*`), the response contains only the first segment
+            r.close()
+            with client.post(url, headers=headers, stream=True) as full_response:
+                if full_response.status_code != 200:
+                    raise MessageBoxException(f"Unable to download file {uid}:{file_name}. Status code: {full_response.status_code}")
+                completed = stream_to_file(full_response, part_path, update_callback, should_terminate, sha256=sha256)
+        elif total_size_in_bytes is None or total_size_in_bytes <= segment_size:
+            # The response contains the whole file
+            completed = stream_to_file(r, part_path, update_callback, should_terminate, sha256=sha256)
+        else:
+            r.close()
+            download = SegmentedDownload(
+                url=url, 
+                part_path=part_path, 
+                total_size=total_size_in_bytes, 
+                headers=headers, 
+                etag=r.headers.get('etag'),
+                segment_size=segment_size,
+                workers=DOWNLOAD_WORKERS,
+                segment_checksums=manifest.get("segments"),
+                sha256=sha256,
+                update_callback=update_callback,
+                should_terminate=should_terminate,
+            )
+            completed = download.run()
+
+    if not completed:
+        print("Download terminated by user.")
+        return
+    os.replace(part_path, save_path)
+
+
+def download_files_concurrently(uid, save_paths: List[str], optional_paths: Iterable[str] = ()) -> List[Future]:
+    """
+    Starts downloading of small files, such as annotations, in background threads, one request per file.
+    Names of files on the server are names of `save_paths`, files from `optional_paths` may be missing on the server.
+    Other work, like the archive transfer, can be done until `wait_for_downloads` is called
+    """
+    executor = ThreadPoolExecutor(max_workers=max(len(save_paths), 1))
+    futures = [
+        executor.submit(download_file, uid, os.path.basename(save_path), save_path, ignore_404=save_path in optional_paths)
+        for save_path in save_paths
+    ]
+    executor.shutdown(wait=False)  # Threads exit when their downloads are complete
+    return futures
+
+
+def wait_for_downloads(futures: List[Future]):
+    """Waits until all downloads are complete and raises the error of the first failed download"""
+    for future in futures:
+        future.result()
+
+
+def stream_to_file(r: requests.Response, save_path: str, update_callback: Callable = None, should_terminate: Callable = None, sha256: str = None) -> bool:
+    """Writes response content to the file. Returns False if the download is terminated.
+    If `sha256` is specified, the content is hashed while it is written and the file is removed if it does not match"""
+    total_size_in_bytes = int(r.headers.get('content-length', 0))
+    hasher = hashlib.sha256() if sha256 is not None else None
+    monitor = TransferMonitor(url=r.url, direction="download", total_size=total_size_in_bytes, update_callback=update_callback)
+
+    try:
         with open(save_path, 'wb') as file:
-            for data in r.iter_content(1024):
+            for data in iter_adaptive_content(r):
                 if should_terminate is not None and should_terminate():
-                    print("Download terminated by user.")
-                    return
+                    monitor.finish("terminated")
+                    return False
                 file.write(data)
-                if update_callback is not None:
-                    downloaded_size += len(data)
-                    elapsed_time = time.time() - start_time
-                    speed = downloaded_size / elapsed_time / (1024**2)  # Speed in MB/s
-                    remaining_time = (total_size_in_bytes - downloaded_size) / (downloaded_size / elapsed_time)
-                    percent_done = (downloaded_size / total_size_in_bytes) * 100
-                    update_callback(percent_done, downloaded_size / (1024**3), speed, remaining_time, processing_complete=False)
-        if update_callback is not None:
-            update_callback(percent_done, downloaded_size / (1024**3), speed, remaining_time, processing_complete=True)
-
-
-def upload_file(uid, file_path):
-    # Ensure the file exists and is accessible
-    try:
-        files = {'file': open(file_path, 'rb')}
-    except IOError:
-        return "Error: The file does not exist or cannot be accessed."
+                if hasher is not None:
+                    hasher.update(data)
+                monitor.add(len(data))
+        if hasher is not None and hasher.hexdigest() != sha256:
+            os.remove(save_path)
+            raise IntegrityError(f"Checksum of {r.url} does not match")
+    except Exception:
+        monitor.finish("failed")
+        raise
+    monitor.report(processing_complete=True)
+    monitor.finish("complete")
+    return True
+
+
+def check_gzip_upload_support(url: str) -> bool:
+    """Server advertises that it accepts gzip request bodies with `Accept-Encoding` in the OPTIONS response (RFC 7694)"""
+    if url not in gzip_upload_support:
+        try:
+            response = client.request("OPTIONS", url, max_retries=0, headers={'Authorization': f'Bearer {settings.token}'})
+            accept_encoding = response.headers.get("accept-encoding", "")
+            gzip_upload_support[url] = response.ok and "gzip" in [item.split(";")[0].strip().lower() for item in accept_encoding.split(",")]
+        except requests.exceptions.RequestException:
+            gzip_upload_support[url] = False
+    return gzip_upload_support[url]
+
+
+def generate_gzip_multipart(file_path: str, boundary: str, update_callback: Callable = None, url: str = None) -> Iterator[bytes]:
+    """Yields multipart/form-data body with the file compressed on the fly, so the file is never loaded to memory"""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    monitor = TransferMonitor(url=url, direction="upload", total_size=os.path.getsize(file_path), update_callback=update_callback)
+
+    yield compressor.compress(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{os.path.basename(file_path)}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'.encode()
+    )
+    with open(file_path, "rb") as file:
+        while True:
+            data = file.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            compressed = compressor.compress(data)
+            if compressed:
+                yield compressed
+            monitor.add(len(data))  # Progress and speed of the uncompressed file
+    yield compressor.compress(f"\r\n--{boundary}--\r\n".encode())
+    yield compressor.flush()
+    monitor.finish("complete")
+
 
+def send_file(uid, file_path, update_callback: Callable = None) -> requests.Response:
+    """
+    Sends the file as multipart/form-data. If the server supports it, the request body is compressed with gzip
+    while it is sent with chunked transfer encoding, otherwise the file is sent as is
+    """
     full_url = f"{settings.file_url}/upload/{uid}"
-    response = requests.post(full_url, files=files, headers={'Authorization': f'Bearer {settings.token}'})
+    headers = {'Authorization': f'Bearer {settings.token}'}
+    if check_gzip_upload_support(full_url):
+        boundary = uuid.uuid4().hex
+        response = client.post(
+            full_url, 
+            data=generate_gzip_multipart(file_path, boundary, update_callback, url=full_url),  # Generator body is sent chunked
+            headers={**headers, "Content-Type": f"multipart/form-data; boundary={boundary}", "Content-Encoding": "gzip"}, 
+            idempotent=False,
+            timeout=NON_IDEMPOTENT_TIMEOUT,
+        )
+    else:
+        with open(file_path, 'rb') as file:
+            response = client.post(full_url, files={'file': file}, headers=headers, idempotent=False, timeout=NON_IDEMPOTENT_TIMEOUT)
+    return response
 
-    # Close the file to prevent resource leakage
-    files['file'].close()
+
+def upload_file(uid, file_path, update_callback: Callable = None):
+    # Ensure the file exists and is accessible
+    if not os.path.isfile(file_path) or not os.access(file_path, os.R_OK):
+        return "Error: The file does not exist or cannot be accessed."
+
+    start_time = time.time()
+    response = send_file(uid, file_path, update_callback)
 
     if response.status_code != 200:
         try:
@@ -91,6 +280,11 @@ def upload_file(uid, file_path):
             error_message = f"Status code: {response.status_code}"
         raise MessageBoxException(f"Error: Server responded with {error_message} while uploading {file_path}")
 
+    if update_callback is not None:
+        size = os.path.getsize(file_path)
+        elapsed_time = time.time() - start_time
+        update_callback(100, size / (1024**3), size / (elapsed_time + 1e-7) / (1024**2), 0, processing_complete=True)
+
 
 if __name__ == "__main__":
     ft = FileTransferClient()
@@ -0,0 +1,256 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Optional
+
+from config import settings
+from file_processing.integrity import sha256_from_headers, sha256_of_file
+from file_processing.progress_bar import ProcessingProgressBar
+from http_client import client
+from file_processing.segmented_download import parse_content_range
+
+
+class ImageStore:
+    """
+    Content-addressed cache of image files shared by all projects, stored in `<data_dir>/image_store`.
+
+    Files are stored as `objects/<first 2 chars of sha256>/<sha256><extension>` and hardlinked into `images/`
+    of projects, so removing a project does not remove the files from the store and the same images
+    are not stored twice. `archives.json` maps archives to the checksums of their members,
+    so an archive which was downloaded before is restored from the store without a transfer.
+
+    Files linked from projects do not take additional space, the quota applies only to files
+    which are not linked from any project, for example images of removed projects.
+    When they are larger than the quota, least recently used of them are removed.
+    """
+
+    def __init__(self, store_path: str, quota_bytes: int):
+        self.store_path = store_path
+        self.quota_bytes = quota_bytes
+        self.objects_path = os.path.join(store_path, "objects")
+        self.index_path = os.path.join(store_path, "index.json")
+        self.archives_path = os.path.join(store_path, "archives.json")
+        os.makedirs(self.objects_path, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.index: Dict[str, Dict] = self.load(self.index_path)  # Object name: {"size": ..., "last_used": ...}
+        self.archives: Dict[str, Dict[str, str]] = self.load(self.archives_path)  # Archive key: {member name: object name}
+
+    @staticmethod
+    def load(path: str) -> Dict:
+        if os.path.isfile(path):
+            try:
+                with open(path, "r") as file:
+                    return json.load(file)
+            except ValueError:
+                print(f"Image store index {path} is broken and will be recreated")
+        return dict()
+
+    @staticmethod
+    def dump(value: Dict, path: str):
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(value, file, separators=(",", ":"))
+        os.replace(temp_path, path)  # The index is never left half-written
+
+    def save(self):
+        self.dump(self.index, self.index_path)
+        self.dump(self.archives, self.archives_path)
+
+    def get_object_path(self, object_name: str) -> str:
+        return os.path.join(self.objects_path, object_name[:2], object_name)
+
+    @staticmethod
+    def link(source_path: str, destination_path: str):
+        """Hardlinks the file, or copies it if the store and the project are on different file systems"""
+        if os.path.exists(destination_path):
+            os.remove(destination_path)
+        try:
+            os.link(source_path, destination_path)
+        except OSError:
+            shutil.copyfile(source_path, destination_path)
+
+    @staticmethod
+    def get_object_name(file_path: str) -> str:
+        return sha256_of_file(file_path) + os.path.splitext(file_path)[1].lower()
+
+    def add(self, file_path: str, object_name: str):
+        """Adds the file with the object name from `get_object_name` to the store"""
+        object_path = self.get_object_path(object_name)
+        if not os.path.isfile(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            self.link(file_path, object_path)
+        self.index[object_name] = {"size": os.path.getsize(object_path), "last_used": time.time()}
+
+    def add_archive(
+            self,
+            archive_key: str,
+            output_dir: str,
+            member_names: List[str],
+            update_callback: Callable = None,
+            should_terminate: Callable = None
+        ) -> bool:
+        """
+        Adds members extracted from the archive to the store, other files of `output_dir` are not recorded.
+        Members are hashed before the store is locked, `update_callback` receives progress in the ProcessingProgressBar format.
+        Returns False if the archive is not recorded, because some of its members were not extracted or `should_terminate` stopped hashing
+        """
+        member_paths = [os.path.join(output_dir, member_name) for member_name in member_names]
+        if not all(os.path.isfile(member_path) for member_path in member_paths):
+            return False
+        total_size = sum(os.path.getsize(member_path) for member_path in member_paths)
+        processed_size = 0
+        start_time = time.time()
+        speed = 0
+
+        object_names = list()
+        for member_path in member_paths:
+            if should_terminate is not None and should_terminate():
+                return False
+            object_names.append(self.get_object_name(member_path))
+            processed_size += os.path.getsize(member_path)
+            if update_callback is not None:
+                elapsed_time = time.time() - start_time
+                speed = processed_size / (elapsed_time + 1e-7) / (1024**2)  # Speed in MB/s
+                percent_done = processed_size / total_size * 100 if total_size > 0 else 100
+                remaining_time = (total_size - processed_size) / (processed_size / (elapsed_time + 1e-7)) if processed_size else 0
+                update_callback(percent_done, processed_size / (1024**3), speed, remaining_time, processing_complete=False)
+
+        with self.lock:
+            for member_path, object_name in zip(member_paths, object_names):
+                self.add(member_path, object_name)
+            self.archives[archive_key] = dict(zip(member_names, object_names))
+            self.evict()
+            self.save()
+        if update_callback is not None:
+            update_callback(100, processed_size / (1024**3), speed, 0, processing_complete=True)
+        return True
+
+    def restore_archive(self, archive_key: str, output_dir: str) -> bool:
+        """Links members of the archive to `output_dir`. Returns False if some of them are not in the store"""
+        with self.lock:
+            members = self.archives.get(archive_key)
+            if members is None or not all(os.path.isfile(self.get_object_path(object_name)) for object_name in members.values()):
+                return False
+            now = time.time()
+            for member_name, object_name in members.items():
+                destination_path = os.path.join(output_dir, member_name)
+                os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+                self.link(self.get_object_path(object_name), destination_path)
+                self.index[object_name] = {"size": os.path.getsize(destination_path), "last_used": now}
+            self.save()
+            return True
+
+    def trim(self):
+        """Removes unused objects over the quota, for example after projects are removed"""
+        with self.lock:
+            self.evict()
+            self.save()
+
+    def evict(self):
+        """Removes least recently used objects which are not linked from projects, until their size fits the quota.
+        Objects of existing projects do not take additional space, they are kept and not counted"""
+        unlinked_objects = dict()
+        for object_name, item in list(self.index.items()):
+            object_path = self.get_object_path(object_name)
+            if not os.path.isfile(object_path):
+                del self.index[object_name]  # Removed outside of the store
+            elif os.stat(object_path).st_nlink == 1:
+                unlinked_objects[object_name] = item
+
+        total_size = sum(item["size"] for item in unlinked_objects.values())
+        for object_name, item in sorted(unlinked_objects.items(), key=lambda item: item[1]["last_used"]):
+            if total_size <= self.quota_bytes:
+                break
+            os.remove(self.get_object_path(object_name))
+            del self.index[object_name]
+            total_size -= item["size"]
+
+        # Archives with removed members can not be restored anymore
+        self.archives = {
+            archive_key: members for archive_key, members in self.archives.items()
+            if all(object_name in self.index for object_name in members.values())
+        }
+
+
+class ImageStoreUpdater(ProcessingProgressBar):
+    def add_archive(self, image_store: ImageStore, archive_key: str, output_dir: str, member_names: List[str]):
+        """Adds extracted members to the store in a background thread. If the window is closed, the archive is not cached"""
+        self.processed_percent = 0
+        self.processed_gb = 0
+        self.speed = 0
+        self.remaining_time = 0
+        self.processing_complete = False
+
+        def update_progress(percent, size_gb, speed, remaining_time, processing_complete):
+            self.processed_percent = percent
+            self.processed_gb = size_gb
+            self.speed = speed
+            self.remaining_time = remaining_time
+            self.processing_complete = processing_complete
+
+        executor = ThreadPoolExecutor()
+        future = executor.submit(
+            image_store.add_archive, archive_key, output_dir, member_names, update_progress, lambda: self.terminate_processing
+        )
+        self.check_update_completion(future)
+
+        self.root.wait_window(self.root)
+        executor.shutdown(wait=False)
+        try:
+            future.result()  # Waits for the worker if the window was closed by the user
+        except Exception:
+            # Images are already extracted, the project is opened without caching them
+            print(f"Unable to add images of {archive_key} to the image store: {traceback.format_exc()}")
+
+    def check_update_completion(self, future):
+        if future.done():
+            self.root.destroy()
+        else:
+            self.root.after(100, lambda: self.check_update_completion(future))
+
+
+def get_archive_key(uid: str, file_name: str) -> Optional[str]:
+    """
+    Identifies the version of the archive on the server by its size and ETag or checksum, without downloading it.
+    Returns None if the server sends neither of them, such archives are not cached:
+    a regenerated archive of the same size can not be told apart
+    """
+    url = f"{settings.file_url}/download/{uid}/{file_name}"
+    headers = {'Authorization': f'Bearer {settings.token}', "Range": "bytes=0-0"}
+    with client.post(url, headers=headers, stream=True) as r:
+        if r.status_code == 206:
+            size = parse_content_range(r.headers.get("content-range"))
+        elif r.status_code == 200:
+            size = r.headers.get("content-length")
+        else:
+            return None
+        version = r.headers.get("etag") or sha256_from_headers(r.headers)
+    if version is None:
+        return None
+    return f"{uid}/{file_name}:{size}:{version}"
+
+
+image_stores: Dict[str, ImageStore] = dict()
+
+
+def get_image_store() -> Optional[ImageStore]:
+    """Returns the store of the current data_dir, None if it is disabled by zero quota"""
+    quota_gb = float(settings.image_store_quota_gb)
+    if quota_gb <= 0:
+        return None
+    store_path = os.path.join(settings.data_dir, "image_store")
+    if store_path not in image_stores:
+        image_stores[store_path] = ImageStore(store_path, quota_bytes=int(quota_gb * 1024**3))
+    image_stores[store_path].quota_bytes = int(quota_gb * 1024**3)
+    return image_stores[store_path]
+
+
+def trim_image_store():
+    image_store = get_image_store()
+    if image_store is not None:
+        image_store.trim()
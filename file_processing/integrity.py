@@ -0,0 +1,64 @@
+import base64
+import hashlib
+import os
+from typing import Dict, Optional
+
+from utils import open_json
+
+
+HASH_BLOCK_SIZE = 4 * 1024**2
+
+
+class IntegrityError(Exception):
+    """Downloaded or extracted data does not match its checksum"""
+    pass
+
+
+def sha256_of_file(file_path: str, start: int = 0, size: int = None) -> str:
+    """Returns sha256 hex digest of the whole file or of `size` bytes from `start`"""
+    hasher = hashlib.sha256()
+    remaining = size if size is not None else os.path.getsize(file_path) - start
+    with open(file_path, "rb") as file:
+        file.seek(start)
+        while remaining > 0:
+            data = file.read(min(HASH_BLOCK_SIZE, remaining))
+            if not data:
+                break
+            hasher.update(data)
+            remaining -= len(data)
+    return hasher.hexdigest()
+
+
+def sha256_from_headers(headers: Dict) -> Optional[str]:
+    """Returns sha256 hex digest of the file if the server sends it
+    in `X-Checksum-Sha256` (hex) or `Digest: sha-256=<base64>` header"""
+    checksum = headers.get("x-checksum-sha256")
+    if checksum:
+        return checksum.strip().lower()
+    digest = headers.get("digest")
+    if digest:
+        for item in digest.split(","):
+            algorithm, _, value = item.strip().partition("=")
+            if algorithm.lower() == "sha-256" and value:
+                return base64.b64decode(value).hex()
+    return None
+
+
+def get_manifest_path(file_path: str) -> str:
+    """
+    Manifest is stored next to the downloaded file. Format:
+    {
+        "size": 123456,  # Size of the file in bytes
+        "sha256": "...",  # Checksum of the whole file
+        "segment_size": 67108864,  # Size of ranges with checksums in "segments"
+        "segments": ["...", ...],  # Checksums of ranges of the file, all keys are optional
+        "files": {"img_name.jpg": "...", ...}  # Checksums of archive members
+    }
+    """
+    return file_path + ".manifest.json"
+
+
+def load_manifest(file_path: str) -> Optional[Dict]:
+    manifest_path = get_manifest_path(file_path)
+    if os.path.isfile(manifest_path):
+        return open_json(manifest_path)
@@ -0,0 +1,243 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import io
+import os
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Optional
+import zipfile
+
+import requests
+
+from config import settings
+from exceptions import MessageBoxException
+from http_client import RETRY_STATUS_CODES, client
+from file_processing.file_transfer import download_file
+from file_processing.integrity import get_manifest_path, load_manifest
+from file_processing.progress_bar import ProcessingProgressBar
+from file_processing.segmented_download import parse_content_range
+from file_processing.unzipping import extract_member
+
+
+BLOCK_SIZE = 4 * 1024**2
+PREFETCH_BLOCKS = 6
+
+
+class UnzipCancelled(Exception):
+    pass
+
+
+class RemoteArchive(io.RawIOBase):
+    """
+    Read-only seekable file over HTTP Range requests, so `zipfile.ZipFile` can read the archive from the server.
+
+    The file is read in blocks. When a block is requested, the next `prefetch_blocks` blocks are requested
+    in background threads, so sequential reading of members overlaps with the transfer.
+    Blocks behind the read position are dropped, the archive is never stored on disk.
+    """
+
+    def __init__(
+            self,
+            url: str,
+            total_size: int,
+            headers: Dict = None,
+            block_size: int = BLOCK_SIZE,
+            prefetch_blocks: int = PREFETCH_BLOCKS,
+            max_retries: int = 5,
+        ):
+        self.url = url
+        self.total_size = total_size
+        self.headers = headers if headers is not None else dict()
+        self.block_size = block_size
+        self.prefetch_blocks = prefetch_blocks
+        self.max_retries = max_retries
+
+        self.position = 0
+        self.fetched_size = 0  # Number of bytes received from the server
+        self.blocks: "OrderedDict[int, Future]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=prefetch_blocks)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.total_size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        return self.position
+
+    def fetch_block(self, index: int) -> bytes:
+        start = index * self.block_size
+        end = min(start + self.block_size, self.total_size) - 1
+        headers = {**self.headers, "Range": f"bytes={start}-{end}"}
+        for attempt in range(self.max_retries + 1):
+            try:
+                r = client.post(self.url, headers=headers, max_retries=0)
+                if r.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                    time.sleep(2 ** attempt)  # The server is overloaded or restarting
+                    continue
+                if r.status_code != 206:
+                    raise RuntimeError(f"Server does not return a range of {self.url}. Status code: {r.status_code}")
+                with self.lock:
+                    self.fetched_size += len(r.content)
+                return r.content
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(2 ** attempt)
+
+    def get_block(self, index: int) -> bytes:
+        last_index = (self.total_size - 1) // self.block_size
+        with self.lock:
+            for prefetch_index in range(index, min(index + self.prefetch_blocks, last_index) + 1):
+                if prefetch_index not in self.blocks:
+                    self.blocks[prefetch_index] = self.executor.submit(self.fetch_block, prefetch_index)
+            for cached_index in list(self.blocks):
+                # Keep the previous block, headers of members often cross the block border
+                if cached_index < index - 1 or cached_index > index + self.prefetch_blocks:
+                    self.blocks.pop(cached_index).cancel()
+            future = self.blocks[index]
+        return future.result()
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.total_size - self.position
+        size = max(0, min(size, self.total_size - self.position))
+        chunks = list()
+        while size > 0:
+            index, offset = divmod(self.position, self.block_size)
+            data = self.get_block(index)[offset:offset + size]
+            chunks.append(data)
+            self.position += len(data)
+            size -= len(data)
+        return b"".join(chunks)
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        super().close()
+
+
+def get_remote_size(url: str, headers: Dict) -> Optional[int]:
+    """Returns size of the file if the server supports Range requests"""
+    with client.post(url, headers={**headers, "Range": "bytes=0-0"}, stream=True) as r:
+        if r.status_code != 206:
+            return None
+        return parse_content_range(r.headers.get("content-range"))
+
+
+def stream_unzip_archive(uid: str, archive_path: str, output_dir: str, update_callback: Callable = None, should_terminate: Callable = None) -> Optional[List[str]]:
+    """
+    Extracts the archive from the server without downloading it: the central directory is read from the end
+    of the archive and members are fetched by Range requests in the order they are stored.
+    Every member is available on disk as soon as its bytes arrive.
+
+    Members already extracted with the expected size are skipped, so an interrupted extraction continues
+    from the same place. Members are checked against checksums from the download manifest if the server has it.
+
+    `archive_path` is where the archive would be downloaded, only the manifest is stored next to it.
+    Returns names of extracted files, or None if the server does not support Range requests
+    and the caller should download the archive instead.
+    Raises UnzipCancelled if `should_terminate` stops the extraction
+    """
+    file_name = os.path.basename(archive_path)
+    url = f"{settings.file_url}/download/{uid}/{file_name}"
+    headers = {'Authorization': f'Bearer {settings.token}'}
+
+    total_size = get_remote_size(url, headers)
+    if total_size is None:
+        return None
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = get_manifest_path(archive_path)
+    download_file(uid, f"{file_name}.manifest.json", manifest_path, ignore_404=True)
+    manifest = load_manifest(archive_path)
+    checksums = manifest.get("files") if manifest is not None else None
+
+    archive = RemoteArchive(url=url, total_size=total_size, headers=headers)
+    try:
+        with zipfile.ZipFile(archive) as zip_ref:
+            members = sorted(zip_ref.infolist(), key=lambda info: info.header_offset)  # Sequential reading of the archive
+            total_unpacked_size = sum(info.file_size for info in members)
+            processed_size = 0
+            start_time = time.time()
+            speed, remaining_time = 0, 0
+
+            for info in members:
+                if should_terminate is not None and should_terminate():
+                    print("Unzip terminated by user.")
+                    raise UnzipCancelled(f"Extraction of {uid}/{file_name} was cancelled")
+                output_path = os.path.join(output_dir, info.filename)
+                if not (os.path.isfile(output_path) and os.path.getsize(output_path) == info.file_size):
+                    extract_member(zip_ref, info.filename, output_dir, sha256=checksums.get(info.filename) if checksums is not None else None)
+                processed_size += info.file_size
+
+                if update_callback is not None:
+                    elapsed_time = time.time() - start_time
+                    speed = archive.fetched_size / (elapsed_time + 1e-7) / (1024**2)  # Transfer speed in MB/s
+                    percent_done = processed_size / total_unpacked_size * 100 if total_unpacked_size > 0 else 100
+                    remaining_time = (total_unpacked_size - processed_size) / (processed_size / (elapsed_time + 1e-7)) if processed_size else 0
+                    update_callback(percent_done, processed_size / (1024**3), speed, remaining_time, processing_complete=False)
+    finally:
+        archive.close()
+
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+    if update_callback is not None:
+        update_callback(100, processed_size / (1024**3), speed, 0, processing_complete=True)
+    return [info.filename for info in members if not info.is_dir()]
+
+
+class RemoteArchiveUnzipper(ProcessingProgressBar):
+    def unzip(self, uid: str, archive_path: str, output_dir: str) -> Optional[List[str]]:
+        """Returns names of extracted files, None if the archive can not be extracted from the server and should be downloaded"""
+        self.processed_percent = 0
+        self.processed_gb = 0
+        self.speed = 0
+        self.remaining_time = 0
+        self.processing_complete = False
+
+        def update_progress(percent, size_gb, speed, remaining_time, processing_complete):
+            self.processed_percent = percent
+            self.processed_gb = size_gb
+            self.speed = speed
+            self.remaining_time = remaining_time
+            self.processing_complete = processing_complete
+
+        executor = ThreadPoolExecutor()
+        future = executor.submit(stream_unzip_archive, uid, archive_path, output_dir, update_progress, lambda: self.terminate_processing)
+        self.check_unzip_completion(future)
+
+        self.root.wait_window(self.root)
+        executor.shutdown(wait=False)
+        file_name = os.path.basename(archive_path)
+        try:
+            return future.result()  # Waits for the worker if the window was closed by the user
+        except UnzipCancelled:
+            # Extracted members are kept, the next download continues from them
+            raise MessageBoxException(f"Downloading of {uid}/{file_name} was cancelled")
+        except Exception as e:
+            raise MessageBoxException(f"Unable to download and unzip {uid}/{file_name}. Error: {traceback.format_exc()}")
+
+    def check_unzip_completion(self, future):
+        if future.done():
+            self.root.destroy()  # The result is handled by `unzip` after the window is closed
+        else:
+            self.root.after(100, lambda: self.check_unzip_completion(future))
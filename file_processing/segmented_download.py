@@ -0,0 +1,255 @@
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+import hashlib
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+from file_processing.integrity import IntegrityError, sha256_of_file
+from file_processing.transfer_monitor import AdaptiveChunkSize, TransferMonitor, iter_adaptive_content
+from http_client import RETRY_STATUS_CODES, client
+from utils import open_json, save_json
+
+
+@dataclass
+class Segment:
+    start: int
+    end: int  # Inclusive, as in the Range header
+    downloaded: int = 0  # Number of bytes written from the start of the segment
+    sha256: Optional[str] = None  # Expected checksum of the segment
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start + 1
+
+    @property
+    def complete(self) -> bool:
+        return self.downloaded >= self.size
+
+
+def parse_content_range(content_range: str) -> Optional[int]:
+    """Returns total size from the `Content-Range: bytes 0-1023/146515` header"""
+    if content_range is None or "/" not in content_range:
+        return None
+    total = content_range.rsplit("/", 1)[1].strip()
+    return int(total) if total.isdigit() else None
+
+
+class SegmentedDownload:
+    """
+    Downloads a file with concurrent HTTP Range requests.
+
+    The file is preallocated and every segment is written at its offset by a separate thread.
+    Progress of segments is saved to the `<part_path>.json` sidecar, so the download
+    continues from the same place after termination, crash or connection loss.
+
+    Segments are hashed while they are downloaded. Segments which do not match `segment_checksums`
+    are downloaded again. If only the checksum of the whole file is known, it is verified at the end.
+    """
+
+    def __init__(
+            self,
+            url: str,
+            part_path: str,
+            total_size: int,
+            headers: Dict = None,
+            etag: str = None,
+            segment_size: int = 64 * 1024**2,
+            workers: int = 6,
+            max_retries: int = 5,
+            segment_checksums: List[str] = None,
+            sha256: str = None,
+            max_verification_rounds: int = 3,
+            update_callback: Callable = None,
+            should_terminate: Callable = None,
+        ):
+        self.url = url
+        self.part_path = part_path
+        self.state_path = part_path + ".json"
+        self.total_size = total_size
+        self.headers = headers if headers is not None else dict()
+        self.etag = etag
+        self.segment_size = segment_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.segment_checksums = segment_checksums
+        self.sha256 = sha256
+        self.max_verification_rounds = max_verification_rounds
+        self.should_terminate = should_terminate
+
+        self.lock = threading.Lock()
+        self.terminated = False
+        self.hashers: Dict[int, "hashlib._Hash"] = dict()  # Hashers of segments downloaded in this session, by segment start
+        self.segments: List[Segment] = self.load_segments()
+        self.monitor = TransferMonitor(
+            url=url, direction="download", total_size=total_size, update_callback=update_callback, transferred_size=self.downloaded_size
+        )
+        self.state_saving_time = time.time()
+
+    @property
+    def downloaded_size(self) -> int:
+        return sum(segment.downloaded for segment in self.segments)
+
+    def load_segments(self) -> List[Segment]:
+        """Restores segments from the sidecar if it describes the same file"""
+        if os.path.isfile(self.state_path) and os.path.isfile(self.part_path):
+            try:
+                state = open_json(self.state_path)
+                if (
+                    state["total_size"] == self.total_size 
+                    and state["etag"] == self.etag 
+                    and state["segment_size"] == self.segment_size 
+                    and os.path.getsize(self.part_path) == self.total_size
+                ):
+                    return [Segment(**segment) for segment in state["segments"]]
+            except (ValueError, KeyError, TypeError):
+                pass  # Broken sidecar, start from the beginning
+
+        with open(self.part_path, "wb") as file:
+            file.truncate(self.total_size)  # Preallocate the file to write segments at their offsets
+
+        segments = [
+            Segment(start=start, end=min(start + self.segment_size, self.total_size) - 1)
+            for start in range(0, self.total_size, self.segment_size)
+        ]
+        if self.segment_checksums is not None:
+            if len(self.segment_checksums) != len(segments):
+                raise IntegrityError(f"Manifest has {len(self.segment_checksums)} segment checksums, the file has {len(segments)} segments")
+            for segment, checksum in zip(segments, self.segment_checksums):
+                segment.sha256 = checksum
+        return segments
+
+    def save_state(self, interval: float = 0):
+        """Writes progress of segments to the sidecar if it was saved more than `interval` seconds ago"""
+        with self.lock:  # Workers save the state in turns, the sidecar is replaced only by a complete file
+            if time.time() - self.state_saving_time < interval:
+                return
+            state = {
+                "url": self.url,
+                "total_size": self.total_size,
+                "etag": self.etag,
+                "segment_size": self.segment_size,
+                "segments": [asdict(segment) for segment in self.segments]
+            }
+            temp_path = self.state_path + ".tmp"
+            save_json(state, temp_path)
+            os.replace(temp_path, self.state_path)
+            self.state_saving_time = time.time()
+
+    def check_termination(self) -> bool:
+        if not self.terminated and self.should_terminate is not None and self.should_terminate():
+            self.terminated = True
+        return self.terminated
+
+    def download_segment(self, segment: Segment):
+        attempt = 0  # Number of successive requests which did not download anything
+        chunk_size = AdaptiveChunkSize()  # Kept between requests of the segment
+        with open(self.part_path, "r+b") as file:
+            while not segment.complete:
+                if self.check_termination():
+                    return
+                position = segment.start + segment.downloaded
+                if segment.downloaded == 0:
+                    self.hashers[segment.start] = hashlib.sha256()
+                hasher = self.hashers.get(segment.start)  # None if the segment was started before resuming
+                headers = {**self.headers, "Range": f"bytes={position}-{segment.end}"}
+                error = None
+                try:
+                    with client.post(self.url, headers=headers, stream=True, max_retries=0) as r:  # Retried from the last written byte
+                        if r.status_code in RETRY_STATUS_CODES:
+                            # The server is overloaded or restarting, the segment is requested again after a pause
+                            error = RuntimeError(f"Server is unable to return a range of {self.url}. Status code: {r.status_code}")
+                        elif r.status_code != 206:
+                            raise RuntimeError(f"Server does not return a range of {self.url}. Status code: {r.status_code}")
+                        else:
+                            file.seek(position)
+                            for data in iter_adaptive_content(r, chunk_size):
+                                if self.check_termination():
+                                    return
+                                data = data[:segment.size - segment.downloaded]
+                                file.write(data)
+                                if hasher is not None:
+                                    hasher.update(data)
+                                with self.lock:
+                                    segment.downloaded += len(data)
+                                self.monitor.add(len(data))
+                                self.save_state(interval=1)
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+                    error = e
+                if segment.complete:
+                    break
+                # The connection was lost or the response ended before the end of the segment
+                attempt = 0 if segment.start + segment.downloaded > position else attempt + 1
+                if attempt > self.max_retries:
+                    if error is not None:
+                        raise error
+                    raise RuntimeError(f"Server returns no data of {self.url} from byte {position} after {attempt} attempts")
+                self.monitor.add_retry()
+                file.flush()
+                time.sleep(2 ** attempt)  # The segment continues from the last written byte
+
+    def segment_sha256(self, segment: Segment) -> str:
+        hasher = self.hashers.get(segment.start)
+        if hasher is not None:
+            return hasher.hexdigest()
+        return sha256_of_file(self.part_path, start=segment.start, size=segment.size)
+
+    def download_pending_segments(self) -> bool:
+        """Returns False if the download is terminated"""
+        pending_segments = [segment for segment in self.segments if not segment.complete]
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            futures = [executor.submit(self.download_segment, segment) for segment in pending_segments]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in done:
+                if future.exception() is not None:
+                    self.terminated = True  # Stop other segments, their progress is kept in the sidecar
+                    raise future.exception()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.save_state()
+
+        return not self.terminated and all(segment.complete for segment in self.segments)
+
+    def download(self) -> bool:
+        """Downloads segments until all of them match their checksums. Returns False if the download is terminated"""
+        for verification_round in range(self.max_verification_rounds):
+            if not self.download_pending_segments():
+                return False
+            corrupted_segments = [
+                segment for segment in self.segments 
+                if segment.sha256 is not None and self.segment_sha256(segment) != segment.sha256
+            ]
+            if len(corrupted_segments) == 0:
+                break
+            print(f"{len(corrupted_segments)} corrupted segments of {self.url} will be downloaded again")
+            for segment in corrupted_segments:
+                self.monitor.remove(segment.downloaded)
+                segment.downloaded = 0
+            self.save_state()
+        else:
+            raise IntegrityError(f"Segments of {self.url} are corrupted after {self.max_verification_rounds} attempts")
+
+        if self.sha256 is not None and self.segment_checksums is None:
+            # Without checksums of segments the corrupted part can not be found, the file is downloaded from scratch next time
+            if sha256_of_file(self.part_path) != self.sha256:
+                os.remove(self.state_path)
+                os.remove(self.part_path)
+                raise IntegrityError(f"Checksum of {self.url} does not match")
+
+        os.remove(self.state_path)
+        self.monitor.report(processing_complete=True)
+        return True
+
+    def run(self) -> bool:
+        """Returns True if the whole file is downloaded and verified"""
+        try:
+            completed = self.download()
+        except Exception:
+            self.monitor.finish("failed")
+            raise
+        self.monitor.finish("complete" if completed else "terminated")
+        return completed
@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterator
+
+import requests
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError
+
+from config import settings
+from http_client import client
+
+
+REPORT_INTERVAL_SEC = 0.2  # Progress is reported at this rate regardless of the size of chunks
+STALL_THRESHOLD_SEC = 2  # Pause between chunks counted as a stall
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 16 * 1024**2
+CHUNK_TARGET_SEC = 0.1  # Time of reading of one chunk the chunk size is adapted to
+
+metrics_lock = threading.Lock()
+
+
+def get_metrics_log_path() -> str:
+    return os.path.join(settings.data_dir, "transfer_metrics.jsonl")
+
+
+def log_transfer_stats(stats: Dict):
+    """Appends statistics of a transfer as a line of `transfer_metrics.jsonl` in data_dir"""
+    try:
+        with metrics_lock:
+            with open(get_metrics_log_path(), "a") as file:
+                file.write(json.dumps(stats) + "\n")
+    except OSError as e:
+        print(f"Unable to save transfer statistics: {e}")
+
+
+class AdaptiveChunkSize:
+    """Chunk size which takes about `target_sec` to transfer at the measured throughput.
+    Small chunks keep slow connections responsive, large chunks reduce per-chunk overhead on fast links"""
+
+    def __init__(self, initial_size: int = MIN_CHUNK_SIZE, min_size: int = MIN_CHUNK_SIZE, max_size: int = MAX_CHUNK_SIZE, target_sec: float = CHUNK_TARGET_SEC):
+        self.size = initial_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_sec = target_sec
+
+    def update(self, size: int, duration_sec: float) -> int:
+        if size > 0:
+            throughput = size / max(duration_sec, 1e-4)
+            # Grow at most 2 times per chunk, so a single fast chunk from the buffer does not jump to the maximum
+            self.size = int(min(max(throughput * self.target_sec, self.size / 2, self.min_size), self.size * 2, self.max_size))
+        return self.size
+
+
+def iter_adaptive_content(response: requests.Response, chunk_size: AdaptiveChunkSize = None) -> Iterator[bytes]:
+    """Same as `response.iter_content`, but the size of chunks follows the throughput of the connection"""
+    chunk_size = chunk_size if chunk_size is not None else AdaptiveChunkSize()
+    while True:
+        start_time = time.perf_counter()
+        try:
+            data = response.raw.read(chunk_size.size, decode_content=True)
+        # Errors are converted as in iter_content, so callers can retry the same exceptions
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        if not data:
+            break
+        chunk_size.update(len(data), time.perf_counter() - start_time)
+        yield data
+
+
+class TransferMonitor:
+    """
+    Counts bytes of a transfer from any number of threads and reports progress in the ProcessingProgressBar format
+    every `report_interval_sec`. Statistics of the transfer are saved to the metrics log when it finishes.
+    """
+
+    def __init__(
+            self,
+            url: str,
+            direction: str,
+            total_size: int,
+            update_callback: Callable = None,
+            transferred_size: int = 0,
+            report_interval_sec: float = REPORT_INTERVAL_SEC,
+        ):
+        self.url = url
+        self.direction = direction  # "download" or "upload"
+        self.total_size = total_size
+        self.update_callback = update_callback
+        self.report_interval_sec = report_interval_sec
+
+        self.transferred_size = transferred_size
+        self.resumed_size = transferred_size  # Bytes transferred before, for example by the interrupted download
+        self.retries = 0
+        self.stalls = 0
+        self.stalled_sec = 0
+        self.start_time = time.time()
+        self.last_chunk_time = self.start_time
+        self.last_report_time = 0
+        self.lock = threading.Lock()
+
+    def add(self, size: int):
+        now = time.time()
+        with self.lock:
+            self.transferred_size += size
+            pause = now - self.last_chunk_time
+            if pause > STALL_THRESHOLD_SEC:
+                self.stalls += 1
+                self.stalled_sec += pause
+            self.last_chunk_time = now
+            report_due = now - self.last_report_time >= self.report_interval_sec
+            if report_due:
+                self.last_report_time = now
+        if report_due:
+            self.report()
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def remove(self, size: int):
+        """Bytes which will be transferred again, for example segments with wrong checksums"""
+        with self.lock:
+            self.transferred_size -= size
+            self.resumed_size = min(self.resumed_size, self.transferred_size)
+
+    @property
+    def speed(self) -> float:
+        """Speed in MB/s"""
+        return (self.transferred_size - self.resumed_size) / (time.time() - self.start_time + 1e-7) / (1024**2)
+
+    def report(self, processing_complete: bool = False):
+        if self.update_callback is None:
+            return
+        session_size = self.transferred_size - self.resumed_size
+        elapsed_time = time.time() - self.start_time
+        remaining_time = (self.total_size - self.transferred_size) / (session_size / elapsed_time) if session_size > 0 else 0
+        percent_done = self.transferred_size / self.total_size * 100 if self.total_size > 0 else 100
+        self.update_callback(percent_done, self.transferred_size / (1024**3), self.speed, max(remaining_time, 0), processing_complete=processing_complete)
+
+    def finish(self, status: str):
+        """`status` is "complete", "terminated" or "failed" """
+        duration_sec = time.time() - self.start_time
+        log_transfer_stats({
+            "time": self.start_time,
+            "direction": self.direction,
+            "url": self.url,
+            "status": status,
+            "total_bytes": self.total_size,
+            "bytes": self.transferred_size - self.resumed_size,
+            "resumed_bytes": self.resumed_size,
+            "duration_sec": round(duration_sec, 3),
+            "speed_mb_s": round(self.speed, 3),
+            "stalls": self.stalls,
+            "stalled_sec": round(self.stalled_sec, 3),
+            "retries": self.retries,
+            # Requests to the same endpoint in this session, for example all segments of the file
+            "requests": client.get_latency_stats(self.url) if self.url is not None else dict(),
+        })
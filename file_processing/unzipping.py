@@ -1,13 +1,23 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import hashlib
 import os
 import traceback
-from typing import Callable
+from typing import Callable, Dict, List
 import zipfile
 import time
 from exceptions import MessageBoxException
+from file_processing.integrity import HASH_BLOCK_SIZE, IntegrityError, load_manifest
 from file_processing.progress_bar import ProcessingProgressBar
 
 
+UNZIP_WORKERS = os.cpu_count() or 1
+PARALLEL_MIN_MEMBERS = 64  # Smaller archives are extracted in the current process, starting processes takes longer
+TASK_SIZE = 16 * 1024**2  # Unpacked size of members extracted by one task of a worker
+TASK_MAX_MEMBERS = 256
+
+worker_zip_ref: zipfile.ZipFile = None  # Archive handle of the worker process
+
+
 class ArchiveUnzipper(ProcessingProgressBar):
     def unzip(self, archive_path, output_dir):
         
@@ -26,51 +36,177 @@ class ArchiveUnzipper(ProcessingProgressBar):
             self.remaining_time = remaining_time
             self.processing_complete = processing_complete
 
+        manifest = load_manifest(archive_path)
+        checksums = manifest.get("files") if manifest is not None else None
+
         executor = ThreadPoolExecutor()
-        future = executor.submit(unzip_archive, archive_path, output_dir, update_progress, lambda: self.terminate_processing)
-        self.check_download_completion(future, archive_path)
+        future = executor.submit(unzip_archive, archive_path, output_dir, update_progress, lambda: self.terminate_processing, checksums)
+        self.check_unzip_completion(future)
 
         self.root.wait_window(self.root)
+        executor.shutdown(wait=False)
+        try:
+            completed = future.result()  # Waits for the worker if the window was closed by the user
+        except Exception as e:
+            raise MessageBoxException(f"The archive {archive_path} was not unzipped properly. Error: {traceback.format_exc()}")
+        if not completed:
+            # The archive is kept, so unzipping can be started again without downloading it
+            raise MessageBoxException(f"Unzipping of {archive_path} was cancelled")
 
-        while not self.processing_complete:
-            time.sleep(0.05)
-            print('Unzipping is still in progress')
-
-    def check_download_completion(self, future, archive_path):
+    def check_unzip_completion(self, future):
         if future.done():
-            try:
-                future.result()  # This will raise any exceptions caught by the thread
-            except Exception as e:
-                raise MessageBoxException(f"The archive {archive_path} was not unzipped properly. Error: {traceback.format_exc()}")
-
-            self.root.destroy()
+            self.root.destroy()  # The result is handled by `unzip` after the window is closed
         else:
-            
-            self.root.after(100, lambda: self.check_download_completion(future, archive_path))
+            self.root.after(100, lambda: self.check_unzip_completion(future))
+
+
+def extract_member(zip_ref: zipfile.ZipFile, name: str, output_dir: str, sha256: str = None):
+    """Extracts the member and checks its checksum while it is written.
+    CRC32 of the member is checked by zipfile, a damaged member raises IntegrityError and is not left on disk"""
+    if sha256 is None:
+        try:
+            return zip_ref.extract(name, output_dir)
+        except zipfile.BadZipFile as e:
+            raise IntegrityError(f"Member {name} of the archive is corrupted: {e}")
+
+    output_path = os.path.normpath(os.path.join(output_dir, name))
+    if os.path.commonpath([os.path.abspath(output_path), os.path.abspath(output_dir)]) != os.path.abspath(output_dir):
+        raise IntegrityError(f"Member {name} of the archive is outside of the output directory")
+    if name.endswith("/"):
+        os.makedirs(output_path, exist_ok=True)
+        return output_path
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    hasher = hashlib.sha256()
+    try:
+        with zip_ref.open(name) as source, open(output_path, "wb") as target:
+            while True:
+                data = source.read(HASH_BLOCK_SIZE)
+                if not data:
+                    break
+                hasher.update(data)
+                target.write(data)
+    except zipfile.BadZipFile as e:
+        os.remove(output_path)
+        raise IntegrityError(f"Member {name} of the archive is corrupted: {e}")
+    if hasher.hexdigest() != sha256:
+        os.remove(output_path)
+        raise IntegrityError(f"Checksum of the member {name} of the archive does not match")
+    return output_path
+
+
+def open_archive_in_worker(archive_path: str):
+    """Every worker process reads the archive with its own handle"""
+    global worker_zip_ref
+    worker_zip_ref = zipfile.ZipFile(archive_path, 'r')
+
 
+def extract_members_in_worker(file_names: List[str], output_dir: str, checksums: Dict[str, str]) -> int:
+    """Returns the unpacked size of extracted members"""
+    for file in file_names:
+        extract_member(worker_zip_ref, file, output_dir, sha256=checksums.get(file))
+    return sum(worker_zip_ref.getinfo(file).file_size for file in file_names)
 
-def unzip_archive(archive_path: str, output_dir: str, update_callback: Callable, should_terminate: Callable):
+
+def split_into_tasks(members: List[zipfile.ZipInfo]) -> List[List[zipfile.ZipInfo]]:
+    """Groups members into tasks of about TASK_SIZE bytes, so progress is updated often
+    and the overhead of sending tasks to processes stays small"""
+    tasks = [[]]
+    task_size = 0
+    for info in members:
+        if task_size >= TASK_SIZE or len(tasks[-1]) >= TASK_MAX_MEMBERS:
+            tasks.append([])
+            task_size = 0
+        tasks[-1].append(info)
+        task_size += info.file_size
+    return [task for task in tasks if len(task) > 0]
+
+
+def unzip_archive(
+        archive_path: str, 
+        output_dir: str, 
+        update_callback: Callable, 
+        should_terminate: Callable, 
+        checksums: Dict[str, str] = None, 
+        workers: int = None
+    ) -> bool:
+    """
+    Extracts the archive, returns False if unzipping is terminated.
+    `checksums` are sha256 of members by their names from the download manifest.
+    Archives with many members are extracted by `workers` processes, decompression of deflated members is CPU-bound
+    """
     os.makedirs(output_dir, exist_ok=True)
     if not os.path.isfile(archive_path):
         raise FileNotFoundError(f"Archive not found {archive_path}")
+    checksums = checksums if checksums is not None else dict()
+    workers = workers if workers is not None else UNZIP_WORKERS
     with zipfile.ZipFile(archive_path, 'r') as zip_ref:
-        file_names = zip_ref.namelist()
-        total_size = sum(zip_ref.getinfo(name).file_size for name in file_names)
-        processed_size = 0
-        start_time = time.time()
-        
-        for file in file_names:
-            if should_terminate():
-                print("Unzip terminated by user.")
-                return
-            
-            zip_ref.extract(file, output_dir)
-            processed_size += zip_ref.getinfo(file).file_size
-            
-            elapsed_time = time.time() - start_time
-            speed = processed_size / elapsed_time / (1024**2)  # Speed in MB/s
-            percent_done = (processed_size / total_size) * 100
-            remaining_time = (total_size - processed_size) / (processed_size / elapsed_time) if processed_size else 0
-            update_callback(percent_done, processed_size / (1024**3), speed, remaining_time, processing_complete=False)
+        members = zip_ref.infolist()
+    total_size = sum(info.file_size for info in members)
+    processed_size = 0
+    start_time = time.time()
+    speed = 0
+
+    def report_progress():
+        elapsed_time = time.time() - start_time
+        speed = processed_size / (elapsed_time + 1e-7) / (1024**2)  # Speed in MB/s
+        percent_done = (processed_size / total_size) * 100 if total_size > 0 else 100
+        remaining_time = (total_size - processed_size) / (processed_size / elapsed_time) if processed_size else 0
+        update_callback(percent_done, processed_size / (1024**3), speed, remaining_time, processing_complete=False)
+        return speed
 
-        update_callback(100, processed_size / (1024**3), speed, 0, processing_complete=True)
+    if workers <= 1 or len(members) < PARALLEL_MIN_MEMBERS:
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+            for info in members:
+                if should_terminate():
+                    print("Unzip terminated by user.")
+                    return False
+                extract_member(zip_ref, info.filename, output_dir, sha256=checksums.get(info.filename))
+                processed_size += info.file_size
+                speed = report_progress()
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=open_archive_in_worker, initargs=(archive_path,))
+        try:
+            pending = set()
+            for task in split_into_tasks(members):
+                file_names = [info.filename for info in task]
+                task_checksums = {file: checksums[file] for file in file_names if file in checksums}
+                pending.add(executor.submit(extract_members_in_worker, file_names, output_dir, task_checksums))
+            while len(pending) > 0:
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                if should_terminate():
+                    print("Unzip terminated by user.")
+                    return False
+                for future in done:
+                    processed_size += future.result()  # Raises errors of the worker
+                if len(done) > 0:
+                    speed = report_progress()
+        finally:
+            # Tasks which are not started yet are cancelled, running tasks finish their members
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    update_callback(100, processed_size / (1024**3), speed, 0, processing_complete=True)
+    return True
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    # Benchmark of extraction of a synthetic archive with 10k deflated members
+    number_of_members = 10000
+    with tempfile.TemporaryDirectory() as temp_dir:
+        archive_path = os.path.join(temp_dir, "archive.zip")
+        compressible_part = bytes(range(256)) * 160
+        with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_DEFLATED) as zip_ref:
+            for i in range(number_of_members):
+                # Partly compressible content, similar to the ratio of image files
+                zip_ref.writestr(f"img_{i:05d}.jpg", os.urandom(24 * 1024) + compressible_part)
+        unpacked_size = number_of_members * 64 * 1024
+        print(f"Archive: {number_of_members} members, {os.path.getsize(archive_path) / 1024**2:.1f} MB packed, {unpacked_size / 1024**2:.1f} MB unpacked")
+
+        for workers in (1, max(UNZIP_WORKERS, 2)):
+            output_dir = os.path.join(temp_dir, f"output_{workers}")
+            start_time = time.time()
+            unzip_archive(archive_path, output_dir, update_callback=lambda *args, **kwargs: None, should_terminate=lambda: False, workers=workers)
+            elapsed_time = time.time() - start_time
+            assert len(os.listdir(output_dir)) == number_of_members
+            print(f"{workers} workers: {elapsed_time:.2f} s, {unpacked_size / 1024**2 / elapsed_time:.1f} MB/s, {number_of_members / elapsed_time:.0f} files/s")
@@ -0,0 +1,140 @@
+from dataclasses import asdict, dataclass
+import re
+import threading
+import time
+from typing import Dict, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+# Uploads and task completion are not retried after the request is sent, and the server
+# may process them for a long time before it responds, so only the connection time is limited
+NON_IDEMPOTENT_TIMEOUT = (10, None)
+
+
+@dataclass
+class LatencyStats:
+    count: int = 0  # Number of responses
+    errors: int = 0  # Number of requests failed without a response
+    retries: int = 0
+    total_sec: float = 0
+    max_sec: float = 0
+
+    @property
+    def mean_sec(self) -> float:
+        return self.total_sec / self.count if self.count > 0 else 0
+
+
+def get_endpoint_name(url: str) -> str:
+    """Path of the url with ids replaced, so requests to the same endpoint share statistics:
+    /download/987cfc9c-1dfa-4547-b89f-8df9abed92d6/archive.zip -> /download/{id}/archive.zip"""
+    path = urlparse(url).path or "/"
+    return re.sub(r"/(\d+|[0-9a-fA-F\-]{32,36})(?=/|$)", "/{id}", path)
+
+
+class HttpClient:
+    """
+    Shared HTTP client of the API and the file service.
+
+    Connections are kept alive in the pool of the session and reused by all threads.
+    Failed requests are retried with exponential backoff. Requests which may change the state
+    on the server (`idempotent=False`) are retried only if the connection was not established.
+    Latency of every request is collected per endpoint, with time to the response headers for streamed responses.
+    """
+
+    def __init__(
+            self,
+            pool_size: int = 32,
+            timeout: Tuple[float, float] = (10, 60),
+            max_retries: int = 3,
+            backoff_factor: float = 0.5,
+        ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)  # Segmented downloads use many connections to one host
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.stats: Dict[str, LatencyStats] = dict()
+        self.lock = threading.Lock()
+
+    def get_stats(self, endpoint: str) -> LatencyStats:
+        with self.lock:
+            if endpoint not in self.stats:
+                self.stats[endpoint] = LatencyStats()
+            return self.stats[endpoint]
+
+    def record(self, endpoint: str, duration_sec: float = None, retry: bool = False):
+        stats = self.get_stats(endpoint)
+        with self.lock:
+            if duration_sec is None:
+                stats.errors += 1
+            else:
+                stats.count += 1
+                stats.total_sec += duration_sec
+                stats.max_sec = max(stats.max_sec, duration_sec)
+            if retry:
+                stats.retries += 1
+
+    @staticmethod
+    def is_connection_not_established(error: requests.exceptions.RequestException) -> bool:
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], "reason", None) if len(error.args) > 0 else None
+        return isinstance(reason, NewConnectionError)
+
+    def request(self, method: str, url: str, idempotent: bool = True, max_retries: int = None, **kwargs) -> requests.Response:
+        max_retries = self.max_retries if max_retries is None else max_retries
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = get_endpoint_name(url)
+
+        for attempt in range(max_retries + 1):
+            retry = attempt < max_retries
+            start_time = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                retry = retry and (idempotent or self.is_connection_not_established(e))
+                self.record(endpoint, retry=retry)
+                if not retry:
+                    raise
+            else:
+                retry = retry and idempotent and response.status_code in RETRY_STATUS_CODES
+                self.record(endpoint, time.perf_counter() - start_time, retry=retry)
+                if not retry:
+                    return response
+                response.close()
+            time.sleep(self.backoff_factor * 2 ** attempt)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def probe(self, url: str, timeout: float = 3) -> bool:
+        """Returns True if the server answers anything. HEAD request without retries, the body is not transferred"""
+        try:
+            self.request("HEAD", url, max_retries=0, timeout=timeout, allow_redirects=False).close()
+        except requests.exceptions.RequestException:
+            return False
+        return True
+
+    def get_latency_stats(self, url: str = None) -> Dict[str, Dict]:
+        """Statistics by endpoints, only of the endpoint of `url` if it is specified"""
+        endpoint = get_endpoint_name(url) if url is not None else None
+        with self.lock:
+            return {
+                endpoint_name: {**asdict(stats), "mean_sec": stats.mean_sec} for endpoint_name, stats in self.stats.items()
+                if endpoint is None or endpoint_name == endpoint
+            }
+
+
+client = HttpClient()
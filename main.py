@@ -21,6 +21,8 @@ from config import settings
 import subprocess
 
 
+from db import close_database
+from file_processing.image_store import trim_image_store
 from path_manager import BasePathManager, get_local_projects_data
 from utils import check_url_rechable
 from tkinter import PhotoImage
@@ -140,12 +142,14 @@ class MainWindow(tk.Tk):
         project_data: ProjectData = ps.select()
         if project_data is not None: 
             pm = BasePathManager(project_id=project_data.id)
-            if os.path.isdir(pm.project_path):
-                shutil.rmtree(pm.project_path)
             if self.annotation_widget is not None:
                 if self.annotation_widget.project_id == project_data.id:
                     self.remove_annotation_widget()
                     self.title(f"Annotation tool")
+            close_database(pm.db_path)
+            if os.path.isdir(pm.project_path):
+                shutil.rmtree(pm.project_path)
+            trim_image_store()
             messagebox.showinfo("Project removed", f"Project {project_data.id} removed")
 
     def complete_project(self):
@@ -175,6 +179,7 @@ class MainWindow(tk.Tk):
                 pm = BasePathManager(project_id=project_data.id)
                 if os.path.isdir(pm.project_path):
                     shutil.rmtree(pm.project_path)
+            trim_image_store()
 
 
     def open_settings(self):
@@ -189,6 +194,7 @@ class MainWindow(tk.Tk):
     def on_window_close(self):
         if self.annotation_widget is not None:
             self.annotation_widget.close()
+        close_database()
         self.destroy()
 
     def update_tool(self):
@@ -0,0 +1,115 @@
+from typing import Callable, List, NamedTuple
+
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql import text  # For executing raw SQL statements
+
+from annotation_widgets.image.labeling.segmentation.masks_encoding import rle_to_blob
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[Connection], None]
+
+
+def table_exists(connection: Connection, table_name: str) -> bool:
+    row = connection.execute(
+        text("SELECT name FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table_name}
+    ).first()
+    return row is not None
+
+
+def column_exists(connection: Connection, table_name: str, column_name: str) -> bool:
+    columns = connection.execute(text(f"PRAGMA table_info({table_name})")).fetchall()
+    return any(column[1] == column_name for column in columns)
+
+
+def create_index(connection: Connection, table_name: str, column_name: str):
+    """Creates index with the same name as SQLAlchemy gives to `Column(..., index=True)`,
+    so databases created by `create_all` and migrated databases have identical schema"""
+    if table_exists(connection, table_name):
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table_name}_{column_name} ON {table_name} ({column_name})"))
+
+
+def add_secondary_indexes(connection: Connection):
+    create_index(connection, "bbox", "item_id")
+    create_index(connection, "keypoint_group", "item_id")
+    create_index(connection, "mask", "item_id")
+    create_index(connection, "review_label", "item_id")
+    create_index(connection, "value", "name")
+    create_index(connection, "classification_image", "item_id")
+    create_index(connection, "classification_image", "selected")
+
+
+def convert_masks_to_blob(connection: Connection, batch_size: int = 500):
+    """Moves RLE strings from `mask.rle` to binary `mask.rle_blob`.
+    SQLite can not drop columns in older versions, so `mask.rle` is kept with NULL values"""
+    if not table_exists(connection, "mask"):
+        return
+    if not column_exists(connection, "mask", "rle_blob"):
+        connection.execute(text("ALTER TABLE mask ADD COLUMN rle_blob BLOB"))
+    if not column_exists(connection, "mask", "rle"):
+        return
+
+    last_id = -1
+    while True:
+        rows = connection.execute(
+            text("SELECT id, rle FROM mask WHERE id > :last_id AND rle IS NOT NULL ORDER BY id LIMIT :limit"),
+            {"last_id": last_id, "limit": batch_size}
+        ).fetchall()
+        if len(rows) == 0:
+            break
+        connection.execute(
+            text("UPDATE mask SET rle_blob = :rle_blob, rle = NULL WHERE id = :id"),
+            [{"id": mask_id, "rle_blob": rle_to_blob(str(rle))} for mask_id, rle in rows]
+        )
+        last_id = rows[-1][0]
+
+
+def add_image_modification_time(connection: Connection):
+    if table_exists(connection, "image") and not column_exists(connection, "image", "modified_at"):
+        connection.execute(text("ALTER TABLE image ADD COLUMN modified_at FLOAT"))
+    create_index(connection, "image", "modified_at")
+
+
+def add_event_modification_time(connection: Connection):
+    if table_exists(connection, "event") and not column_exists(connection, "event", "modified_at"):
+        connection.execute(text("ALTER TABLE event ADD COLUMN modified_at FLOAT"))
+    create_index(connection, "event", "modified_at")
+
+
+# Append new migrations to the end of the list with the next version number.
+# Migrations should not fail on databases just created by `create_all` with the latest models
+MIGRATIONS: List[Migration] = [
+    Migration(version=1, description="Secondary indexes on lookup columns", apply=add_secondary_indexes),
+    Migration(version=2, description="Binary storage of mask RLE", apply=convert_masks_to_blob),
+    Migration(version=3, description="Modification time of labeled images", apply=add_image_modification_time),
+    Migration(version=4, description="Modification time of events", apply=add_event_modification_time),
+]
+
+
+def get_schema_version(connection: Connection) -> int:
+    version = connection.execute(text("SELECT MAX(version) FROM schema_version")).scalar()
+    return version if version is not None else 0
+
+
+def migrate(engine: Engine) -> int:
+    """Applies migrations which are not applied to the database yet.
+    Each migration is applied in a separate transaction together with the version update.
+    Returns the schema version of the database"""
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL, description VARCHAR)"))
+        version = get_schema_version(connection)
+
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        with engine.begin() as connection:
+            migration.apply(connection)
+            connection.execute(
+                text("INSERT INTO schema_version (version, description) VALUES (:version, :description)"),
+                {"version": migration.version, "description": migration.description}
+            )
+        version = migration.version
+
+    return version
@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from typing import Optional, Dict
 
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import Column, Float, String, Integer, delete
 
 from db import Base, get_session
 from enums import AnnotationMode, AnnotationStage
@@ -11,7 +11,7 @@ class Value(Base):
     __tablename__ = 'value'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, index=True)
     value = Column(String)
 
     @classmethod
@@ -46,6 +46,27 @@ class Value(Base):
         session.commit()
 
 
+class ExportFragment(Base):
+    """
+    Serialized JSON of one item of an exported file, for example figures of an image. 
+    The fragment is valid while `modified_at` is equal to `modified_at` of the item, 
+    so only items saved after the previous export are serialized again
+    """
+    __tablename__ = 'export_fragment'
+
+    kind = Column(String, primary_key=True)  # Exported file, for example "figures" or "review"
+    item_id = Column(Integer, primary_key=True)
+    modified_at = Column(Float)
+    data = Column(String)
+
+    @classmethod
+    def clear(cls):
+        """Fragments must be removed when items are overwritten, because ids of new items are the same"""
+        session = get_session()
+        session.execute(delete(cls.__table__))
+        session.commit()
+
+
 @dataclass
 class ProjectData:
     id: int
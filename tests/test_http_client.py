@@ -0,0 +1,146 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import socket
+import threading
+
+import pytest
+import requests
+
+import http_client
+from http_client import HttpClient
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers with the next action of `server.actions`: a status code, or None to drop the connection without a response"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self):
+        self.server.requests.append(self.command)
+        length = int(self.headers.get("Content-Length", 0))
+        if length > 0:
+            self.rfile.read(length)
+        status_code = self.server.actions.pop(0) if len(self.server.actions) > 0 else 200
+        if status_code is None:
+            self.close_connection = True
+            return
+        self.send_response(status_code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_HEAD = handle_request
+    do_GET = handle_request
+    do_POST = handle_request
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.actions = list()
+    server.requests = list()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Backoff delays of the client, the tests do not wait for them"""
+    delays = list()
+    monkeypatch.setattr(http_client.time, "sleep", delays.append)
+    return delays
+
+
+def get_url(server: ThreadingHTTPServer) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}/api/tasks/"
+
+
+@pytest.mark.parametrize("status_code", [429, 503])
+def test_overloaded_server_is_retried_with_backoff(server, sleeps, status_code):
+    server.actions = [status_code, status_code]
+    response = HttpClient(max_retries=3, backoff_factor=0.5).get(get_url(server))
+    assert response.status_code == 200
+    assert len(server.requests) == 3
+    assert sleeps == [0.5, 1.0]
+
+
+def test_last_response_is_returned_when_retries_are_exhausted(server, sleeps):
+    server.actions = [503, 503, 503]
+    response = HttpClient(max_retries=2).get(get_url(server))
+    assert response.status_code == 503
+    assert len(server.requests) == 3
+
+
+def test_client_errors_are_not_retried(server, sleeps):
+    server.actions = [404]
+    response = HttpClient().get(get_url(server))
+    assert response.status_code == 404
+    assert len(server.requests) == 1
+
+
+def test_non_idempotent_request_is_not_retried_after_response(server, sleeps):
+    server.actions = [503]
+    response = HttpClient().post(get_url(server), json={"duration_hours": 1}, idempotent=False)
+    assert response.status_code == 503
+    assert len(server.requests) == 1
+
+
+def test_non_idempotent_request_is_not_retried_after_connection_is_established(server, sleeps):
+    server.actions = [None]
+    with pytest.raises(requests.exceptions.ConnectionError):
+        HttpClient().post(get_url(server), json={"duration_hours": 1}, idempotent=False)
+    assert len(server.requests) == 1
+    assert sleeps == []
+
+
+def test_idempotent_request_is_retried_after_connection_loss(server, sleeps):
+    server.actions = [None]
+    response = HttpClient().get(get_url(server))
+    assert response.status_code == 200
+    assert len(server.requests) == 2
+
+
+def test_non_idempotent_request_is_retried_if_connection_is_not_established(sleeps):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]  # Nothing listens on the port after the socket is closed
+    with pytest.raises(requests.exceptions.ConnectionError):
+        HttpClient(max_retries=2).post(f"http://127.0.0.1:{port}/api/tasks/", idempotent=False)
+    assert len(sleeps) == 2
+
+
+def test_probe(server, sleeps):
+    assert HttpClient().probe(get_url(server))
+    server.actions = [503]
+    assert HttpClient().probe(get_url(server))  # Any answer means the server is reachable
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    assert not HttpClient().probe(f"http://127.0.0.1:{port}/")
+
+
+def test_latency_stats_are_collected_per_endpoint(server, sleeps):
+    http = HttpClient()
+    server.actions = [503]
+    http.get(get_url(server) + "987cfc9c-1dfa-4547-b89f-8df9abed92d6/")
+    http.get(get_url(server) + "12/")
+    stats = http.get_latency_stats()
+    assert list(stats) == ["/api/tasks/{id}/"]
+    assert stats["/api/tasks/{id}/"]["count"] == 3
+    assert stats["/api/tasks/{id}/"]["retries"] == 1
+    assert stats["/api/tasks/{id}/"]["mean_sec"] > 0
+    assert http.get_latency_stats(get_url(server) + "34/") == stats
+    assert http.get_latency_stats(get_url(server)) == dict()
+
+
+def test_failed_requests_are_counted_as_errors(server, sleeps):
+    http = HttpClient(max_retries=1)
+    server.actions = [None, None]
+    with pytest.raises(requests.exceptions.ConnectionError):
+        http.get(get_url(server))
+    stats = http.get_latency_stats(get_url(server))["/api/tasks/"]
+    assert (stats["count"], stats["errors"], stats["retries"]) == (0, 2, 1)
@@ -0,0 +1,89 @@
+import os
+import shutil
+
+import pytest
+
+from file_processing.image_store import ImageStore
+
+
+IMAGE_SIZE = 1000
+
+
+def make_images(images_path: str, prefix: str, number: int):
+    os.makedirs(images_path, exist_ok=True)
+    member_names = [f"{prefix}_{i}.jpg" for i in range(number)]
+    for member_name in member_names:
+        with open(os.path.join(images_path, member_name), "wb") as file:
+            file.write(os.urandom(IMAGE_SIZE))
+    return member_names
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ImageStore(str(tmp_path / "image_store"), quota_bytes=3 * IMAGE_SIZE)
+
+
+def test_images_of_existing_projects_are_not_counted(store, tmp_path):
+    images_path = str(tmp_path / "project_1" / "images")
+    member_names = make_images(images_path, "a", 5)  # Larger than the quota
+    assert store.add_archive("a", images_path, member_names)
+    assert len(store.index) == 5
+
+    restored_path = str(tmp_path / "project_2" / "images")
+    assert store.restore_archive("a", restored_path)
+    assert sorted(os.listdir(restored_path)) == sorted(member_names)
+
+
+def test_least_recently_used_images_of_removed_projects_are_evicted(store, tmp_path):
+    old_images_path = str(tmp_path / "project_1" / "images")
+    old_member_names = make_images(old_images_path, "old", 2)
+    store.add_archive("old", old_images_path, old_member_names)
+
+    new_images_path = str(tmp_path / "project_2" / "images")
+    new_member_names = make_images(new_images_path, "new", 2)
+    store.add_archive("new", new_images_path, new_member_names)
+
+    shutil.rmtree(old_images_path)
+    shutil.rmtree(new_images_path)
+    store.trim()  # 4 unused images, the quota fits 3 of them
+
+    assert len(store.index) == 3
+    assert "old" not in store.archives
+    assert "new" in store.archives
+
+
+def test_only_unused_images_are_limited_by_quota(store, tmp_path):
+    old_images_path = str(tmp_path / "project_1" / "images")
+    store.add_archive("old", old_images_path, make_images(old_images_path, "old", 3))
+    shutil.rmtree(old_images_path)
+
+    new_images_path = str(tmp_path / "project_2" / "images")
+    store.add_archive("new", new_images_path, make_images(new_images_path, "new", 5))
+
+    # Images of the existing project are kept, unused images still fit the quota
+    assert len(store.index) == 8
+    assert set(store.archives) == {"old", "new"}
+
+    shutil.rmtree(new_images_path)
+    store.trim()
+    assert sum(item["size"] for item in store.index.values()) <= store.quota_bytes
+    assert list(store.archives) == []
+
+
+def test_archive_with_missing_members_is_not_recorded(store, tmp_path):
+    images_path = str(tmp_path / "project_1" / "images")
+    member_names = make_images(images_path, "a", 2)
+    assert not store.add_archive("a", images_path, member_names + ["missing.jpg"])
+    assert store.archives == dict()
+
+
+def test_terminated_hashing_does_not_record_archive(store, tmp_path):
+    images_path = str(tmp_path / "project_1" / "images")
+    member_names = make_images(images_path, "a", 3)
+    progress = list()
+    terminated = store.add_archive(
+        "a", images_path, member_names, update_callback=lambda *args, **kwargs: progress.append(args), should_terminate=lambda: len(progress) > 0
+    )
+    assert not terminated
+    assert store.archives == dict()
+    assert store.index == dict()
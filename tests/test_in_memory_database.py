@@ -0,0 +1,78 @@
+import sqlite3
+import threading
+
+import pytest
+
+from config import settings
+from db import close_database, configure_database, get_session, release_session
+from models import Value
+
+
+@pytest.fixture
+def in_memory_database(tmp_path, monkeypatch):
+    monkeypatch.setitem(settings.data["database"]["in_memory_database"], "value", True)
+    monkeypatch.setitem(settings.data["database"]["snapshot_interval_sec"], "value", 0.01)
+    db_path = str(tmp_path / "project.sqlite")
+    configure_database("sqlite:///" + db_path)
+    yield db_path
+    close_database()
+
+
+def run_threads(targets, errors):
+    def run(target):
+        try:
+            target()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            release_session()
+
+    threads = [threading.Thread(target=run, args=(target,)) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_concurrent_reads_writes_and_snapshots(in_memory_database):
+    """Threads write, read and the snapshot thread saves the database at the same time, like the GUI and the delta sync"""
+    iterations = 200
+    errors = list()
+
+    def write(prefix):
+        def target():
+            for i in range(iterations):
+                Value.update_value(f"{prefix}_{i}", i)
+        return target
+
+    def read():
+        session = get_session()
+        for _ in range(iterations):
+            session.query(Value).count()
+            Value.get_value("writer_a_0")
+
+    run_threads([write("writer_a"), write("writer_b"), read, read], errors)
+    assert errors == []
+
+    close_database()
+    with sqlite3.connect(in_memory_database) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM value").fetchone()[0] == 2 * iterations
+
+
+def test_rollback_of_another_thread_keeps_transaction(in_memory_database):
+    """A thread without its own transaction can not roll back the transaction of another thread"""
+    session = get_session()
+    session.add(Value(name="pending", value="1"))
+    session.flush()  # The transaction of this thread is started but not committed
+
+    def other_thread():
+        session = get_session()
+        session.rollback()
+        release_session()
+
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    thread.join()
+
+    session.commit()
+    assert Value.get_value("pending") == "1"
@@ -0,0 +1,65 @@
+import json
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from config import settings
+from db import close_database, configure_database
+from enums import AnnotationMode, AnnotationStage
+from models import ProjectData
+from annotation_widgets.image.labeling.io import ImageLabelingIO
+from annotation_widgets.image.labeling.logic import ImageLabelingLogic
+from annotation_widgets.image.labeling.models import LabeledImage
+
+
+IMG_NAMES = ["img_0.jpg", "img_1.jpg", "img_2.jpg"]
+
+
+@pytest.fixture
+def logic(tmp_path, monkeypatch):
+    monkeypatch.setitem(settings.data["general"]["data_dir"], "value", str(tmp_path))
+    project_data = ProjectData(id=1, uid="uid", stage=AnnotationStage.ANNOTATE, mode=AnnotationMode.OBJECT_DETECTION)
+    io = ImageLabelingIO(project_data)
+    os.makedirs(io.pm.images_path)
+    for img_name in IMG_NAMES:
+        cv2.imwrite(os.path.join(io.pm.images_path, img_name), np.zeros((40, 60, 3), dtype=np.uint8))
+    with open(io.pm.figures_ann_path, "w") as file:
+        json.dump({img_name: {"trash": False, "bboxes": [], "kgroups": [], "masks": {}, "width": 60, "height": 40} for img_name in IMG_NAMES}, file)
+    with open(io.pm.meta_ann_path, "w") as file:
+        json.dump({"labels": [{"name": "car", "color": "red", "hotkey": "1", "type": "BBOX"}], "review_labels": []}, file)
+
+    configure_database(io.pm.db_path)
+    io.overwrite_project()
+    yield ImageLabelingLogic(io.pm.images_path, project_data)
+    close_database()
+
+
+def get_modification_times():
+    return {limage.name: limage.modified_at for limage in LabeledImage.all()}
+
+
+def test_viewed_images_are_not_saved(logic):
+    initial_times = get_modification_times()
+    for item_id in [1, 2, 0]:
+        logic.switch_item(item_id)
+    assert get_modification_times() == initial_times
+
+
+def test_only_edited_image_is_saved(logic):
+    logic.toggle_image_trash_tag()
+    logic.switch_item(1)
+    modification_times = get_modification_times()
+    assert modification_times["img_0.jpg"] is not None
+
+    logic.switch_item(2)
+    logic.switch_item(0)
+    assert get_modification_times() == modification_times
+
+
+def test_undo_marks_image_changed(logic):
+    logic.undo()
+    assert logic.item_changed
+    logic.switch_item(1)
+    assert not logic.item_changed
@@ -0,0 +1,140 @@
+import zlib
+
+import numpy as np
+import pytest
+
+from annotation_widgets.image.labeling.segmentation.masks_encoding import (
+    blob_to_rle,
+    coco_counts_to_string,
+    coco_string_to_counts,
+    decode_coco_rle,
+    decode_rle,
+    decode_rle_blob,
+    encode_coco_rle,
+    encode_rle,
+    encode_rle_blob,
+    get_empty_rle,
+    get_empty_rle_blob,
+    get_synthetic_mask,
+    mask_to_coco_counts,
+    mask_to_runs,
+    reference_coco_counts_to_string,
+    rle_to_blob,
+    splice_runs,
+    unpack_runs,
+)
+
+
+def baseline_encode_rle(mask) -> str:
+    """Encoder of the first version of the tool, figures.json of existing projects are written by it"""
+    flat_mask = mask.flatten()
+    change_indices = np.where(np.diff(flat_mask) != 0)[0] + 1
+    positions = np.concatenate(([0], change_indices, [len(flat_mask)]))
+    run_lengths = np.diff(positions)
+    run_values = flat_mask[positions[:-1]]
+    return ','.join([f"{val}:{count}" for val, count in zip(run_values, run_lengths)])
+
+
+def baseline_decode_rle(encoded_str, width, height) -> np.ndarray:
+    vals_counts = [pair.split(':') for pair in encoded_str.split(',')]
+    values = np.array([int(val) for val, _ in vals_counts], dtype=np.uint8)
+    counts = np.array([int(count) for _, count in vals_counts], dtype=int)
+    flat_mask = np.zeros(counts.sum(), dtype=np.uint8)
+    start_idx = 0
+    for value, count in zip(values, counts):
+        flat_mask[start_idx:start_idx + count] = value
+        start_idx += count
+    return flat_mask.reshape((height, width))
+
+
+def get_masks():
+    height, width = 48, 64
+    masks = {
+        "empty": np.zeros((height, width), dtype=np.uint8),
+        "full": np.ones((height, width), dtype=np.uint8),
+        "synthetic": get_synthetic_mask(height, width),
+        "random": np.random.default_rng(0).integers(0, 3, size=(height, width), dtype=np.uint8),
+        "large_value": np.full((height, width), 255, dtype=np.uint8),
+    }
+    edges = np.zeros((height, width), dtype=np.uint8)
+    edges[0, :] = 1  # Run from the first pixel
+    edges[:, -1] = 2  # Runs crossing ends of rows
+    edges[-1, -5:] = 3  # Run to the last pixel
+    masks["edges"] = edges
+    masks["single_pixel"] = np.zeros((1, 1), dtype=np.uint8)
+    return masks
+
+
+MASKS = get_masks()
+
+
+@pytest.mark.parametrize("name", MASKS)
+def test_rle_string_is_the_same_as_baseline(name):
+    mask = MASKS[name]
+    height, width = mask.shape
+    encoded_str = encode_rle(mask)
+    assert encoded_str == baseline_encode_rle(mask)
+    assert np.array_equal(decode_rle(encoded_str, width=width, height=height), mask)
+    assert np.array_equal(baseline_decode_rle(encoded_str, width=width, height=height), mask)
+
+
+@pytest.mark.parametrize("name", MASKS)
+def test_blob_round_trip(name):
+    mask = MASKS[name]
+    height, width = mask.shape
+    blob = encode_rle_blob(mask)
+    assert np.array_equal(decode_rle_blob(blob, width=width, height=height), mask)
+    assert blob_to_rle(blob) == baseline_encode_rle(mask)
+    assert blob_to_rle(rle_to_blob(baseline_encode_rle(mask))) == baseline_encode_rle(mask)
+
+
+def test_empty_rle():
+    assert get_empty_rle(3, 4) == baseline_encode_rle(np.zeros((3, 4), dtype=np.uint8))
+    assert blob_to_rle(get_empty_rle_blob(3, 4)) == "0:12"
+
+
+def test_blob_of_unknown_version_is_rejected():
+    blob = encode_rle_blob(MASKS["synthetic"])
+    data = zlib.decompress(blob)
+    with pytest.raises(ValueError):
+        unpack_runs(zlib.compress(bytes([data[0] + 1]) + data[1:]))
+
+
+@pytest.mark.parametrize("name", ["empty", "full", "synthetic", "random", "edges"])
+@pytest.mark.parametrize("rows", [(0, 1), (0, 5), (20, 30), (47, 48), (0, 48)])
+def test_splice_rows(name, rows):
+    mask = MASKS[name]
+    height, width = mask.shape
+    y_min, y_max = rows
+    edited_mask = mask.copy()
+    edited_mask[y_min:y_max] = get_synthetic_mask(height, width, seed=1)[y_min:y_max]
+
+    values, counts = splice_runs(*mask_to_runs(mask), start=y_min * width, flat_span=edited_mask[y_min:y_max].ravel())
+    expected_values, expected_counts = mask_to_runs(edited_mask)
+    assert np.array_equal(values, expected_values)
+    assert np.array_equal(counts, expected_counts)  # Neighbouring runs with the same value are merged
+
+
+@pytest.mark.parametrize("name", MASKS)
+def test_coco_round_trip(name):
+    mask = MASKS[name] > 0
+    rle = encode_coco_rle(mask)
+    assert rle["size"] == list(mask.shape)
+    assert rle["counts"] == reference_coco_counts_to_string(mask_to_coco_counts(mask))
+    assert np.array_equal(decode_coco_rle(rle), mask.astype(np.uint8))
+    uncompressed_rle = {"size": rle["size"], "counts": mask_to_coco_counts(mask).tolist()}
+    assert np.array_equal(decode_coco_rle(uncompressed_rle), mask.astype(np.uint8))
+
+
+def test_coco_counts_start_with_zeros():
+    mask = np.array([[0, 1], [1, 1]], dtype=np.uint8)  # Column-major order: 0, 1, 1, 1
+    assert mask_to_coco_counts(mask).tolist() == [1, 3]
+    assert mask_to_coco_counts(np.ones((2, 2), dtype=np.uint8)).tolist() == [0, 4]
+    assert encode_coco_rle(mask)["counts"] == "13"
+
+
+def test_coco_string_with_negative_differences():
+    counts = np.array([5, 1000, 3, 2, 70000, 1, 1, 40])
+    encoded_str = coco_counts_to_string(counts)
+    assert encoded_str == reference_coco_counts_to_string(counts)
+    assert coco_string_to_counts(encoded_str).tolist() == counts.tolist()
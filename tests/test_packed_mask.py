@@ -0,0 +1,54 @@
+import cv2
+import numpy as np
+import pytest
+
+from annotation_widgets.image.labeling.segmentation.label_map import LabelMap
+from annotation_widgets.image.labeling.segmentation.packed_mask import PackedMask
+
+
+COLOR = (10, 200, 90)
+OPACITY = 0.4
+
+
+def baseline_paint(canvas: np.ndarray, mask: np.ndarray, color, opacity: float) -> np.ndarray:
+    """Drawing of masks of the first version of the tool"""
+    canvas_with_mask = np.copy(canvas)
+    canvas_with_mask[:, :, :3][mask > 0] = color
+    blended = cv2.addWeighted(canvas_with_mask, opacity, canvas, max(1 - opacity, 0), 0)
+    canvas = np.copy(canvas)
+    canvas[mask > 0] = blended[mask > 0]
+    return canvas
+
+
+def get_mask(height: int, width: int) -> np.ndarray:
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.circle(mask, (width // 2, height // 2), min(height, width) // 3, 1, -1)
+    return mask
+
+
+@pytest.mark.parametrize("channels", [3, 4])
+def test_mask_is_painted_as_in_baseline(channels):
+    height, width = 30, 43
+    canvas = np.random.default_rng(0).integers(0, 256, size=(height, width, channels), dtype=np.uint8)
+    mask = get_mask(height, width)
+
+    painted = PackedMask.from_mask(mask).paint(canvas, color=COLOR, opacity=OPACITY)
+    expected = baseline_paint(canvas, mask, COLOR, OPACITY)
+    assert painted.shape == canvas.shape
+    assert np.abs(painted.astype(int) - expected).max() <= 1
+    assert np.array_equal(painted[mask == 0], canvas[mask == 0])
+    if channels == 4:
+        assert np.array_equal(painted[:, :, 3], canvas[:, :, 3])
+
+
+@pytest.mark.parametrize("channels", [3, 4])
+def test_label_map_is_painted_as_in_baseline(channels):
+    height, width = 30, 43
+    canvas = np.random.default_rng(0).integers(0, 256, size=(height, width, channels), dtype=np.uint8)
+    mask = get_mask(height, width)
+    label_map = LabelMap.from_masks([PackedMask.from_mask(mask)], ["car"], height=height, width=width)
+
+    painted = label_map.paint(canvas, colors={"car": COLOR}, opacity=OPACITY)
+    expected = baseline_paint(canvas, mask, COLOR, OPACITY)
+    assert painted.shape == canvas.shape
+    assert np.abs(painted.astype(int) - expected).max() <= 1
@@ -0,0 +1,32 @@
+import os
+import zipfile
+
+import pytest
+
+from file_processing.unzipping import PARALLEL_MIN_MEMBERS, unzip_archive
+
+
+@pytest.fixture
+def archive_path(tmp_path):
+    archive_path = str(tmp_path / "archive.zip")
+    with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_DEFLATED) as zip_ref:
+        for i in range(PARALLEL_MIN_MEMBERS):
+            zip_ref.writestr(f"img_{i}.jpg", os.urandom(1024))
+    return archive_path
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_archive_is_extracted(tmp_path, archive_path, workers):
+    progress = list()
+    output_dir = str(tmp_path / "images")
+    assert unzip_archive(archive_path, output_dir, lambda *args, **kwargs: progress.append(kwargs), lambda: False, workers=workers)
+    assert len(os.listdir(output_dir)) == PARALLEL_MIN_MEMBERS
+    assert progress[-1]["processing_complete"]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_terminated_unzipping_is_reported(tmp_path, archive_path, workers):
+    progress = list()
+    output_dir = str(tmp_path / "images")
+    assert not unzip_archive(archive_path, output_dir, lambda *args, **kwargs: progress.append(kwargs), lambda: True, workers=workers)
+    assert not any(item["processing_complete"] for item in progress)
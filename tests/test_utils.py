@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from utils import JSONObjectReader, count_json_items, iter_json_items
+
+
+VALUES = {
+    "empty": {},
+    "nested": {"a": {"b": [1, {"c": [2, 3]}], "d": {}}, "e": []},
+    "brackets_in_strings": {"a{": "}]\",[{", "b": ["\\", "\\\"}", "{["], "c:": ":,", "\"": "\\\\\""},
+    "scalars": {"a": 1, "b": -2.5e-3, "c": True, "d": None, "e": "", "f": 12},
+    "annotations": {
+        f"img_{i}.jpg": {"trash": False, "bboxes": [[1, 2, 3, 4, "car"]], "masks": {"car": "0:120,1:5,0:30"}} for i in range(50)
+    },
+}
+
+
+def write_json(tmp_path, value, indent=None) -> str:
+    file_path = str(tmp_path / "value.json")
+    with open(file_path, "w") as file:
+        json.dump(value, file, indent=indent)
+    return file_path
+
+
+@pytest.mark.parametrize("name", VALUES)
+@pytest.mark.parametrize("indent", [None, 4])
+@pytest.mark.parametrize("read_size", [1, 7, 1024])
+def test_items_are_read_in_parts(tmp_path, name, indent, read_size):
+    file_path = write_json(tmp_path, VALUES[name], indent)
+    assert dict(JSONObjectReader(file_path, read_size=read_size).items()) == VALUES[name]
+    assert count_json_items(file_path, read_size=read_size) == len(VALUES[name])
+
+
+def test_count_json_items(tmp_path):
+    file_path = write_json(tmp_path, VALUES["annotations"], indent=4)
+    assert count_json_items(file_path) == 50
+    assert sum(1 for _ in iter_json_items(file_path)) == 50
+
+
+@pytest.mark.parametrize("content", ['{"a": [1, 2}', '{"a": "}', '{"a": 1'])
+def test_truncated_file_is_rejected(tmp_path, content):
+    file_path = str(tmp_path / "value.json")
+    with open(file_path, "w") as file:
+        file.write(content)
+    with pytest.raises(ValueError):
+        count_json_items(file_path)
@@ -1,16 +1,136 @@
 from datetime import datetime
 import json
 import os
-from typing import Tuple
+import re
+from typing import Any, Iterator, Tuple
 
+import numpy as np
 from PIL import Image
-import requests
+
+from http_client import client
 
 def open_json(detections_file):
     with open(detections_file, "r") as file:
         value = json.load(file)
     return value
 
+
+JSON_READ_SIZE = 1024**2
+JSON_DELIMITERS = ",:]} \t\n\r"
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+JSON_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+JSON_NON_STRUCTURAL = bytes(set(range(256)) - set(b"{}[]:"))
+json_decoder = json.JSONDecoder()
+
+
+class JSONObjectReader:
+    """
+    Reads items of the top-level JSON object of the file one by one, keeping in memory only the current item
+    and a part of the file. Used for annotation files, which are too large to be loaded at once
+    """
+
+    def __init__(self, file_path: str, read_size: int = JSON_READ_SIZE):
+        self.file_path = file_path
+        self.read_size = read_size
+        self.file = None
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self, size: int):
+        data = self.file.read(size)
+        self.eof = len(data) == 0
+        self.buffer = self.buffer[self.pos:] + data  # Parsed part of the buffer is dropped
+        self.pos = 0
+
+    def skip_whitespace(self) -> str:
+        """Returns the next character after whitespace, empty string at the end of the file"""
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self.read_more(self.read_size)
+
+    def expect(self, char: str):
+        if self.skip_whitespace() != char:
+            raise ValueError(f"Expected '{char}' at {self.pos} in {self.file_path}")
+        self.pos += 1
+
+    def decode(self) -> Any:
+        self.skip_whitespace()
+        read_size = self.read_size
+        while True:
+            try:
+                value, end = json_decoder.raw_decode(self.buffer, self.pos)
+                # A number is complete only if it is followed by a delimiter, "12" may be a part of "12.5"
+                if self.eof or end < len(self.buffer) and self.buffer[end] in JSON_DELIMITERS:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Larger parts are read for large values, so they are not decoded again too many times
+            self.read_more(read_size)
+            read_size *= 2
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        with open(self.file_path, "r") as self.file:
+            self.expect("{")
+            if self.skip_whitespace() == "}":
+                return
+            while True:
+                key = self.decode()
+                self.expect(":")
+                yield key, self.decode()
+                next_char = self.skip_whitespace()
+                self.pos += 1
+                if next_char == "}":
+                    return
+                if next_char != ",":
+                    raise ValueError(f"Expected ',' or '}}' at {self.pos - 1} in {self.file_path}")
+
+
+def iter_json_items(file_path: str) -> Iterator[Tuple[str, Any]]:
+    """Same as `open_json(file_path).items()` for JSON objects, but the file is not loaded to memory"""
+    return JSONObjectReader(file_path).items()
+
+
+def split_json_strings(text: str) -> Tuple[str, str]:
+    """Returns the text without strings and the beginning of the string which is not terminated in the text"""
+    if "\\" not in text:
+        parts = text.split('"')
+        # Parts with odd indices are strings, the last one is unterminated if the number of quotes is odd
+        return "".join(parts[0::2]), "" if len(parts) % 2 == 1 else '"' + parts[-1]
+    text = JSON_STRING.sub("", text)
+    # Quotes after the first remaining one are escaped quotes of the same unterminated string
+    split_pos = text.find('"')
+    return (text, "") if split_pos == -1 else (text[:split_pos], text[split_pos:])
+
+
+def count_json_items(file_path: str, read_size: int = JSON_READ_SIZE) -> int:
+    """
+    Number of keys of the JSON object in the file. Values are not decoded: strings are removed from each read part
+    and the keys are found as colons at the first nesting level of brackets
+    """
+    depth = 0
+    keys_number = 0
+    string_start = ""
+    with open(file_path, "r") as file:
+        while True:
+            data = file.read(read_size)
+            if len(data) == 0:
+                break
+            text, string_start = split_json_strings(string_start + data)
+            codes = np.frombuffer(text.encode().translate(None, JSON_NON_STRUCTURAL), dtype=np.uint8)
+            steps = (codes == ord("{")).astype(np.int64) + (codes == ord("[")) - (codes == ord("}")) - (codes == ord("]"))
+            depths = depth + np.cumsum(steps)
+            keys_number += int(np.count_nonzero((codes == ord(":")) & (depths == 1)))
+            depth = int(depths[-1]) if len(depths) > 0 else depth
+    if depth != 0 or string_start != "":
+        raise ValueError(f"Unexpected end of {file_path}")
+    return keys_number
+
+
 def save_json(
     value,
     file_path,
@@ -63,11 +183,7 @@ class HistoryBuffer:
 
 
 def check_url_rechable(url) -> bool:
-    try:
-        response = requests.get(url)
-    except requests.exceptions.RequestException as e:
-        return False
-    return True
+    return client.probe(url)
 
 
 def check_correct_json(json_path: str) -> bool: